@@ -1,3 +1,15 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Chat
+
+
+@admin.register(Chat)
+class ChatAdmin(admin.ModelAdmin):
+    # Only the retention policy is edited here: participants change through
+    # the API, which keeps the dashboard and unread counters in step.
+    list_display = ['id', 'manager', 'client', 'retention_days']
+    list_select_related = ['manager', 'client']
+    fields = ['retention_days']
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import re
+import struct
+import tempfile
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .background import BackgroundQueue
+from .models import AttachmentBlob
+
+# Bytes of a file's head read by the metadata extraction.
+SNIFF_SIZE = 64 * 1024
+
+SIGNATURES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class AttachmentTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Файл слишком большой.'
+    default_code = 'too_large'
+
+
+class LengthRequired(APIException):
+    status_code = status.HTTP_411_LENGTH_REQUIRED
+    default_detail = 'Нужен заголовок Content-Length.'
+    default_code = 'length_required'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def blob_path(sha256):
+    """Content-addressed location: ``<root>/ab/cd/abcd...``."""
+    return os.path.join(settings.CHAT_ATTACHMENT_ROOT, sha256[:2],
+                        sha256[2:4], sha256)
+
+
+def store_upload(stream, max_size=None):
+    """
+    Copy ``stream`` to the attachment storage in
+    ``CHAT_ATTACHMENT_CHUNK_SIZE`` chunks, hashing on the way, and return
+    its ``AttachmentBlob``. Content that is already stored is kept once.
+    Raises ``AttachmentTooLarge`` past ``max_size`` bytes.
+    """
+    max_size = max_size or settings.CHAT_ATTACHMENT_MAX_SIZE
+    chunk_size = settings.CHAT_ATTACHMENT_CHUNK_SIZE
+    tmp_dir = os.path.join(settings.CHAT_ATTACHMENT_ROOT, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise AttachmentTooLarge()
+                digest.update(chunk)
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+
+    sha256 = digest.hexdigest()
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.unlink(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Atomic: a concurrent upload of the same content writes the same
+        # bytes.
+        os.replace(tmp.name, path)
+    blob, _ = AttachmentBlob.objects.get_or_create(
+        sha256=sha256, defaults={'size': size})
+    return blob
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` (inclusive) of a single-range ``Range`` header, or
+    None to send the whole file (no header, or a form that is not
+    supported, such as multiple ranges). Raises ``RangeNotSatisfiable``.
+    """
+    match = RANGE_RE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The last ``last`` bytes.
+        length = int(last)
+        if not length or not size:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def iter_range(path, start, end):
+    chunk_size = settings.CHAT_ATTACHMENT_CHUNK_SIZE
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def image_size(content_type, head):
+    """``(width, height)`` from the header of a PNG, GIF or JPEG image."""
+    if content_type == 'image/png' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if content_type == 'image/gif' and len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+    if content_type == 'image/jpeg':
+        offset = 2
+        while offset + 9 < len(head):
+            if head[offset] != 0xFF:
+                return None
+            marker = head[offset + 1]
+            length = struct.unpack('>H', head[offset + 2:offset + 4])[0]
+            # Start-of-frame markers, except DHT, JPG and DAC.
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(
+                    '>HH', head[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + length
+    return None
+
+
+def extract_metadata(blob):
+    with open(blob_path(blob.sha256), 'rb') as file:
+        head = file.read(SNIFF_SIZE)
+    content_type = next((name for signature, name in SIGNATURES
+                         if head.startswith(signature)),
+                        'application/octet-stream')
+    metadata = {'content_type': content_type}
+    dimensions = image_size(content_type, head)
+    if dimensions is not None:
+        metadata['width'], metadata['height'] = dimensions
+    return metadata
+
+
+class AttachmentProcessor(BackgroundQueue):
+    """Extracts the metadata of newly stored blobs off the upload request."""
+    thread_name = 'chat-attachments'
+
+    def apply(self, batch):
+        blobs = AttachmentBlob.objects.filter(pk__in=list(batch),
+                                              metadata__isnull=True)
+        for blob in blobs:
+            AttachmentBlob.objects.filter(pk=blob.pk).update(
+                metadata=extract_metadata(blob))
+
+
+attachment_processor = AttachmentProcessor()
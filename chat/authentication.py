@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+class TokenCache:
+    """
+    Bounded in-process cache of ``key -> (user, token)`` with a TTL and LRU
+    eviction. Entries are dropped by signal handlers when a token is
+    deleted or a user or profile changes; other processes pick up such
+    changes once the TTL expires.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.keys_by_user = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, user_id, value = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, user_id, value):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (self.clock() + self.ttl, user_id, value)
+            self.keys_by_user.setdefault(user_id, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in list(self.keys_by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self.keys_by_user[entry[1]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_user[entry[1]]
+
+
+token_cache = TokenCache(settings.CHAT_AUTH_CACHE_SIZE,
+                         settings.CHAT_AUTH_CACHE_TTL)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    ``TokenAuthentication`` that loads the user and the profile in one
+    query and keeps them in ``token_cache``.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            model = self.get_model()
+            try:
+                token = model.objects.select_related(
+                    'user__profile').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cached = (token.user, token)
+            token_cache.set(key, token.user_id, cached)
+
+        user, token = cached
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+        return (user, token)
+
+
+class ProfileModelBackend(ModelBackend):
+    """Loads the profile together with the session user."""
+
+    def get_user(self, user_id):
+        try:
+            user = get_user_model()._default_manager.select_related(
+                'profile').get(pk=user_id)
+        except get_user_model().DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
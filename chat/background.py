@@ -0,0 +1,100 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundQueue:
+    """
+    In-process queue of work done off the request path by a worker thread.
+
+    Items are submitted under a key; an item submitted while another with
+    the same key is still queued is combined with it by ``merge``. The
+    worker wakes up ``get_interval()`` seconds after the first pending
+    item and hands everything queued by then to ``apply``. Pending items
+    are applied when the process exits. With ``CHAT_BACKGROUND_ASYNC``
+    off (as in tests) ``submit`` applies the item inline.
+    """
+    thread_name = 'chat-background'
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.pending = {}
+        self.in_flight = 0
+        self.thread = None
+
+    def get_interval(self):
+        return 0
+
+    def merge(self, queued, item):
+        return item
+
+    def apply(self, batch):
+        """Process ``batch``, a map ``key -> item``."""
+        raise NotImplementedError
+
+    def submit(self, key, item):
+        if not settings.CHAT_BACKGROUND_ASYNC:
+            self.apply({key: item})
+            return
+        with self.condition:
+            queued = self.pending.get(key)
+            self.pending[key] = (item if queued is None
+                                 else self.merge(queued, item))
+            if self.thread is None:
+                self.start()
+            self.condition.notify()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name=self.thread_name)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.pending or self.stopped.is_set())
+                if self.stopped.is_set():
+                    return
+            # Let further items pile up before processing.
+            self.stopped.wait(self.get_interval())
+            with self.condition:
+                batch, self.pending = self.pending, {}
+                self.in_flight += 1
+            try:
+                self.apply(batch)
+            except Exception:
+                logger.exception('%s failed to process %d items',
+                                 self.thread_name, len(batch))
+            finally:
+                close_old_connections()
+                with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+
+    def flush(self):
+        """Apply everything submitted so far before returning."""
+        with self.condition:
+            batch, self.pending = self.pending, {}
+            self.condition.wait_for(lambda: not self.in_flight)
+        if batch:
+            self.apply(batch)
+
+    def stop(self):
+        """Stop the worker thread and flush the pending items."""
+        with self.condition:
+            thread, self.thread = self.thread, None
+            self.stopped.set()
+            self.condition.notify_all()
+        if thread is not None:
+            thread.join()
+            atexit.unregister(self.stop)
+        self.flush()
@@ -0,0 +1,484 @@
+import io
+import math
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import dashboard, sharding
+from .attachments import store_upload
+from .models import (Attachment, Chat, ChatReadState, Message, Profile,
+                     SyncEvent, message_preview)
+from .pagination import MessageCursorPagination
+from .renderers import FastJSONRenderer
+from .serializers import MessageSerializer, serialize_message_rows
+from .throttling import MessageThrottle
+
+WORDS = ('заказ', 'счёт', 'доставка', 'оплата', 'упаковка', 'накладная',
+         'скидка', 'договор', 'поставка', 'плёнка', 'коробка', 'срок',
+         'цена', 'образец', 'тираж', 'макет', 'здравствуйте', 'спасибо')
+
+
+def random_text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+
+def seed(managers, chats, messages, batch_size=5000, seed=0, log=None):
+    """
+    Fill the database with ``managers`` managers owning ``chats`` chats in
+    total and ``messages`` messages spread over them. Inserts go through
+    ``bulk_create`` and skip the per-message signals.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda text: None)
+    chats_per_manager = max(1, math.ceil(chats / managers))
+    prefix = f'bench{seed}-{int(time.time())}'
+
+    with transaction.atomic():
+        manager_users = User.objects.bulk_create(
+            [User(username=f'{prefix}-manager-{i}', password='!')
+             for i in range(managers)], batch_size=batch_size)
+        client_users = User.objects.bulk_create(
+            [User(username=f'{prefix}-client-{i}', password='!')
+             for i in range(chats_per_manager)], batch_size=batch_size)
+        Profile.objects.bulk_create(
+            [Profile(user=user, role='manager') for user in manager_users]
+            + [Profile(user=user, role='client') for user in client_users],
+            batch_size=batch_size)
+        chat_rows = Chat.objects.bulk_create([
+            Chat(manager=manager, client=client_users[i])
+            for index, manager in enumerate(manager_users)
+            for i in range(min(chats_per_manager,
+                               chats - index * chats_per_manager))
+        ], batch_size=batch_size)
+    log(f'{len(manager_users)} managers, {len(client_users)} clients, '
+        f'{len(chat_rows)} chats')
+
+    created = 0
+    while created < messages:
+        size = min(batch_size, messages - created)
+        batch = []
+        for _ in range(size):
+            chat = rng.choice(chat_rows)
+            batch.append(Message(
+                chat_id=chat.pk,
+                sender_id=rng.choice((chat.manager_id, chat.client_id)),
+                text=random_text(rng)))
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+        created += size
+        log(f'{created}/{messages} messages')
+
+    # Participants have read most of their chats.
+    def latest_ids(alias, chat_ids):
+        return list(Message.objects.using(alias).filter(
+            chat_id__in=chat_ids).values_list('chat_id').annotate(Max('id')))
+
+    last_ids = {}
+    for rows in sharding.scatter(latest_ids, sharding.group_by_shard(
+            [chat.pk for chat in chat_rows])).values():
+        last_ids.update(rows)
+
+    # Messages were inserted without signals: record the last ones.
+    def fetch_messages(alias, chat_ids):
+        return list(Message.objects.using(alias).filter(
+            id__in=[last_ids[chat_id] for chat_id in chat_ids]))
+
+    last_messages = {}
+    for found in sharding.scatter(fetch_messages, sharding.group_by_shard(
+            last_ids)).values():
+        last_messages.update((message.chat_id, message) for message in found)
+    for chat in chat_rows:
+        message = last_messages.get(chat.pk)
+        if message is not None:
+            chat.last_message = message_preview(message)
+            chat.last_activity_at = message.timestamp
+    Chat.objects.bulk_update(chat_rows, ['last_message', 'last_activity_at'],
+                             batch_size=batch_size)
+
+    ChatReadState.objects.bulk_create([
+        ChatReadState(chat_id=chat.pk, user_id=user_id,
+                      last_read_message_id=max(
+                          0, last_ids.get(chat.pk, 0) - rng.randint(0, 20)))
+        for chat in chat_rows
+        for user_id in (chat.manager_id, chat.client_id)
+    ], batch_size=batch_size)
+    dashboard.rebuild(log)
+    return {'managers': len(manager_users), 'clients': len(client_users),
+            'chats': len(chat_rows), 'messages': messages}
+
+
+class Scenario:
+    """
+    One endpoint call, parametrised by a random chat of the dataset.
+    ``prepare(chat, rng)`` runs untimed before every call and sets up what
+    the call consumes, e.g. a chat to delete, as ``bench_*`` attributes of
+    the chat. With ``content_type`` the data is sent as a raw body.
+    """
+
+    def __init__(self, name, method, path, data=None, as_client=False,
+                 prepare=None, content_type=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.as_client = as_client
+        self.prepare = prepare
+        self.content_type = content_type
+
+    def request(self, client, chat, rng):
+        path = self.path(chat, rng)
+        data = self.data(chat, rng) if self.data else None
+        call = getattr(client, self.method.lower())
+        if self.content_type is not None:
+            response = call(path, data, content_type=self.content_type)
+        else:
+            response = call(path, data, format='json')
+        if response.streaming:
+            # Exports and downloads do their work while being read.
+            for _ in response.streaming_content:
+                pass
+            response.close()
+        return response
+
+
+def prepare_client(chat, rng):
+    """A client without a chat with the chat's manager yet."""
+    client = User.objects.create_user(
+        username=f'bench-client-{chat.manager_id}-{rng.getrandbits(64)}')
+    Profile.objects.create(user=client, role='client')
+    chat.bench_new_client_id = client.pk
+
+
+def prepare_chat(chat, rng):
+    """An empty chat of the chat's manager."""
+    prepare_client(chat, rng)
+    chat.bench_new_chat_id = Chat.objects.create(
+        manager_id=chat.manager_id, client_id=chat.bench_new_client_id).pk
+
+
+def prepare_message(chat, rng):
+    """A message sent by the chat's manager."""
+    chat.bench_message_id = Message.objects.create(
+        chat=chat, sender=chat.manager, text=random_text(rng)).pk
+
+
+def prepare_attachment(chat, rng):
+    """An attachment of a message sent by the chat's manager."""
+    prepare_message(chat, rng)
+    blob = store_upload(io.BytesIO(random_text(rng).encode()))
+    chat.bench_attachment_id = Attachment.objects.create(
+        chat=chat, message_id=chat.bench_message_id, uploader=chat.manager,
+        blob=blob, filename='bench.txt', content_type='text/plain').pk
+
+
+def attachments_path(chat, suffix=''):
+    return (f'/chats/{chat.pk}/messages/{chat.bench_message_id}/'
+            f'attachments/{suffix}')
+
+
+SCENARIOS = [
+    Scenario('chat-list', 'GET', lambda chat, rng: '/chats/'),
+    Scenario('chat-detail', 'GET', lambda chat, rng: f'/chats/{chat.pk}/'),
+    Scenario('chat-create', 'POST', lambda chat, rng: '/chats/',
+             lambda chat, rng: {'client': chat.bench_new_client_id},
+             prepare=prepare_client),
+    Scenario('chat-update', 'PATCH', lambda chat, rng: f'/chats/{chat.pk}/',
+             lambda chat, rng: {'client': chat.client_id}),
+    Scenario('chat-delete', 'DELETE',
+             lambda chat, rng: f'/chats/{chat.bench_new_chat_id}/',
+             prepare=prepare_chat),
+    Scenario('chat-export', 'GET',
+             lambda chat, rng: f'/chats/{chat.pk}/export/'),
+    Scenario('chat-export-all', 'GET', lambda chat, rng: '/chats/export/'),
+    Scenario('chat-broadcast', 'POST', lambda chat, rng: '/chats/broadcast/',
+             lambda chat, rng: {'text': random_text(rng),
+                                'all_clients': True}),
+    Scenario('total-unread-count', 'GET',
+             lambda chat, rng: '/chats/total_unread_count/'),
+    Scenario('total-unread-count-client', 'GET',
+             lambda chat, rng: '/chats/total_unread_count/',
+             as_client=True),
+    Scenario('message-list', 'GET',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/'),
+    Scenario('message-list-before', 'GET',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/'
+                               f'?before={chat.bench_before_cursor}'
+             if chat.bench_before_cursor
+             else f'/chats/{chat.pk}/messages/'),
+    Scenario('message-detail', 'GET',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/'
+                               f'{chat.bench_last_message_id}/'),
+    Scenario('message-create', 'POST',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/',
+             lambda chat, rng: {'text': random_text(rng)}),
+    Scenario('message-update', 'PATCH',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/'
+                               f'{chat.bench_message_id}/',
+             lambda chat, rng: {'text': random_text(rng)},
+             prepare=prepare_message),
+    Scenario('message-delete', 'DELETE',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/'
+                               f'{chat.bench_message_id}/',
+             prepare=prepare_message),
+    Scenario('message-read', 'POST',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/read/',
+             as_client=True),
+    Scenario('message-archive', 'GET',
+             lambda chat, rng: f'/chats/{chat.pk}/messages/archive/'),
+    Scenario('attachment-upload', 'POST',
+             lambda chat, rng: attachments_path(chat) + '?filename=bench.txt',
+             lambda chat, rng: random_text(rng).encode(),
+             prepare=prepare_message, content_type='text/plain'),
+    Scenario('attachment-list', 'GET',
+             lambda chat, rng: attachments_path(chat),
+             prepare=prepare_attachment),
+    Scenario('attachment-detail', 'GET',
+             lambda chat, rng: attachments_path(
+                 chat, f'{chat.bench_attachment_id}/'),
+             prepare=prepare_attachment),
+    Scenario('attachment-download', 'GET',
+             lambda chat, rng: attachments_path(
+                 chat, f'{chat.bench_attachment_id}/download/'),
+             prepare=prepare_attachment),
+    Scenario('sync', 'GET',
+             lambda chat, rng: f'/sync/?since={chat.bench_sync_cursor}'),
+    Scenario('messages-bulk', 'POST',
+             lambda chat, rng: '/messages/bulk/',
+             lambda chat, rng: {'messages': [
+                 {'chat': chat.pk, 'text': random_text(rng)}
+                 for _ in range(50)]}),
+    Scenario('messages-search', 'GET',
+             lambda chat, rng: f'/messages/search/?q={rng.choice(WORDS)}'),
+    Scenario('manager-dashboard-list', 'GET',
+             lambda chat, rng: '/dashboard/managers/'),
+    Scenario('manager-dashboard', 'GET',
+             lambda chat, rng: f'/dashboard/managers/{chat.manager_id}/'),
+    Scenario('metrics', 'GET', lambda chat, rng: '/metrics'),
+]
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def sample_chats(count, rng):
+    """
+    Random chats to call the endpoints with, together with everything the
+    scenarios need, so that no setup query runs while timing.
+    """
+    ids = list(Chat.objects.values_list('id', flat=True))
+    if not ids:
+        raise ValueError('The database has no chats, seed it first.')
+    chats = list(Chat.objects.filter(
+        id__in=rng.sample(ids, min(count, len(ids)))
+    ).select_related('manager', 'client'))
+    paginator = MessageCursorPagination()
+    for chat in chats:
+        history = Message.objects.for_chat(chat).order_by(
+            '-timestamp', '-id')
+        latest = history.first()
+        older = history[paginator.page_size:paginator.page_size + 1].first()
+        chat.bench_last_message_id = latest.pk if latest else 0
+        chat.bench_before_cursor = paginator.encode_cursor(
+            older or latest) if latest else ''
+        latest_event = SyncEvent.objects.filter(
+            user_id=chat.manager_id).aggregate(Max('id'))['id__max'] or 0
+        chat.bench_sync_cursor = max(0, latest_event - 100)
+        for user in (chat.manager, chat.client):
+            user.bench_token = Token.objects.get_or_create(user=user)[0].key
+    return chats
+
+
+def run(iterations=100, warmup=10, names=None, seed=0, log=None):
+    """
+    Call every scenario ``warmup + iterations`` times against the current
+    database. Query counts come from the warm-up calls, latencies from the
+    measured ones, so that capturing queries does not skew the timings.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda text: None)
+    chats = sample_chats(max(iterations, 1), rng)
+
+    def client_for(user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {user.bench_token}')
+        return client
+
+    results = {}
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not names or scenario.name in names]
+    # The synthetic load would run into the message throttles, whose cost
+    # is measured by ``throttle_overhead`` instead.
+    with override_settings(ALLOWED_HOSTS=['testserver'],
+                           CHAT_MESSAGE_THROTTLES={},
+                           CHAT_METRICS_TOKEN=None):
+        for scenario in scenarios:
+            queries = []
+            timings = []
+            errors = 0
+            for index in range(warmup + iterations):
+                chat = rng.choice(chats)
+                client = client_for(chat.client if scenario.as_client
+                                    else chat.manager)
+                if scenario.prepare:
+                    scenario.prepare(chat, rng)
+                if index < warmup:
+                    with CaptureQueriesContext(connection) as captured:
+                        response = scenario.request(client, chat, rng)
+                    queries.append(len(captured))
+                else:
+                    started = time.perf_counter()
+                    response = scenario.request(client, chat, rng)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code >= 400:
+                    errors += 1
+            results[scenario.name] = {
+                'method': scenario.method,
+                'iterations': iterations,
+                'errors': errors,
+                'queries_max': max(queries, default=0),
+                'queries_mean': round(statistics.fmean(queries), 2)
+                if queries else 0,
+                'mean_ms': round(statistics.fmean(timings), 3)
+                if timings else 0,
+                'p50_ms': round(percentile(timings, 50), 3)
+                if timings else 0,
+                'p90_ms': round(percentile(timings, 90), 3)
+                if timings else 0,
+                'p99_ms': round(percentile(timings, 99), 3)
+                if timings else 0,
+            }
+            log(f"{scenario.name}: p50={results[scenario.name]['p50_ms']}ms "
+                f"p99={results[scenario.name]['p99_ms']}ms "
+                f"queries={results[scenario.name]['queries_max']}")
+
+    return {
+        'created_at': timezone.now().isoformat(),
+        'dataset': {
+            'users': User.objects.count(),
+            'chats': Chat.objects.count(),
+            'messages': sum(Message.objects.using(alias).count()
+                            for alias in sharding.shard_aliases()),
+        },
+        'endpoints': results,
+    }
+
+
+def compare(current, baseline, threshold=0.2):
+    """
+    Regressions of ``current`` against ``baseline``: p50/p90 latency
+    growing by more than ``threshold`` or more SQL queries per request.
+    """
+    regressions = []
+    for name, base in baseline['endpoints'].items():
+        result = current['endpoints'].get(name)
+        if result is None:
+            continue
+        for key in ('p50_ms', 'p90_ms'):
+            if base[key] and result[key] > base[key] * (1 + threshold):
+                regressions.append(
+                    f'{name}: {key} {base[key]} -> {result[key]}')
+        if result['queries_max'] > base['queries_max']:
+            regressions.append(f"{name}: queries {base['queries_max']} -> "
+                               f"{result['queries_max']}")
+    return regressions
+
+
+def serialization_throughput(messages=5000, repeat=5, seed=0):
+    """
+    Render one page of ``messages`` in memory through the original
+    ``MessageSerializer`` + ``JSONRenderer`` and through the fast path, and
+    report the best time of ``repeat`` runs for each. Raises
+    ``ValueError`` if the outputs differ.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    history = [
+        Message(id=pk, chat_id=1, sender_id=rng.choice((1, 2)),
+                text=random_text(rng),
+                timestamp=now - timedelta(seconds=messages - pk,
+                                          microseconds=rng.randint(0, 999)))
+        for pk in range(1, messages + 1)
+    ]
+    rows = [{'id': message.id, 'chat_id': message.chat_id,
+             'sender_id': message.sender_id, 'text': message.text,
+             'timestamp': message.timestamp} for message in history]
+    read_cursors = {1: {1: messages // 2, 2: messages - 10}}
+    paths = {
+        'serializer': lambda: JSONRenderer().render(MessageSerializer(
+            history, many=True, context={'read_cursors': read_cursors}).data),
+        'rows': lambda: JSONRenderer().render(
+            serialize_message_rows(rows, read_cursors)),
+        'rows-fast-renderer': lambda: FastJSONRenderer().render(
+            serialize_message_rows(rows, read_cursors)),
+    }
+
+    outputs = {name: render() for name, render in paths.items()}
+    if len(set(outputs.values())) != 1:
+        raise ValueError('Fast path output differs from MessageSerializer.')
+
+    results = {}
+    for name, render in paths.items():
+        best = min(timeit(render) for _ in range(repeat))
+        results[name] = {
+            'seconds': round(best, 6),
+            'messages_per_second': round(messages / best),
+            'speedup': round(results['serializer']['seconds'] / best, 2)
+            if results else 1.0,
+        }
+    return results
+
+
+def timeit(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def throttle_overhead(iterations=10000):
+    """
+    Mean cost in microseconds of the message throttle checks done per
+    ``POST /chats/<id>/messages/``, against the configured cache, for a
+    role without limits, a request that takes a token and one that is
+    rejected.
+    """
+    user = User(pk=-1, username='throttle-benchmark')
+    Profile(user=user, role='client')
+    request = APIRequestFactory().post('/chats/1/messages/')
+    request.user = user
+    view = type('View', (), {
+        'get_message_charges': lambda self, request: {-1: 1}})()
+    throttle = MessageThrottle()
+
+    def check():
+        for _ in range(iterations):
+            throttle.allow_request(request, view)
+
+    configs = {
+        'unconfigured': {},
+        'allowed': {'client': {scope: {'rate': '1/s', 'burst': iterations}
+                               for scope in ('user', 'chat')}},
+        'rejected': {'client': {scope: {'rate': '1/day', 'burst': 1}
+                                for scope in ('user', 'chat')}},
+    }
+    results = {}
+    for name, config in configs.items():
+        with override_settings(CHAT_MESSAGE_THROTTLES=config):
+            cache.delete_many(['chat:throttle:user:-1',
+                               'chat:throttle:chat:-1:-1'])
+            results[name] = round(timeit(check) / iterations * 1e6, 2)
+    cache.delete_many(['chat:throttle:user:-1', 'chat:throttle:chat:-1:-1'])
+    return results
@@ -0,0 +1,134 @@
+from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.db.models import Q
+
+from . import sharding
+from .models import Chat, Message, SyncEvent
+from .serializers import BulkMessageSerializer
+from .signals import messages_created
+
+
+def ingest_messages(user, items):
+    """
+    Validate and insert a batch of messages sent by ``user``. Returns one
+    result per item, in order: ``created``, ``duplicate`` (an idempotency
+    key that has already been used), ``forbidden`` or ``invalid``.
+    """
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        serializer = BulkMessageSerializer(data=item)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'status': 'invalid',
+                              'errors': serializer.errors}
+
+    chats = Chat.objects.filter(
+        Q(manager=user) | Q(client=user),
+        id__in={data['chat'] for _, data in valid},
+    ).in_bulk()
+    for index, data in valid:
+        if data['chat'] not in chats:
+            results[index] = {'index': index, 'status': 'forbidden',
+                              'errors': {'chat': ["Вы не участник чата."]}}
+    valid = [(index, data) for index, data in valid if data['chat'] in chats]
+
+    try:
+        _insert(user, chats, valid, results)
+    except IntegrityError:
+        # A concurrent retry has used one of the keys in the meantime;
+        # the second attempt reports it as a duplicate.
+        _insert(user, chats, valid, results)
+    return results
+
+
+def _insert(user, chats, valid, results):
+    keys = {data['idempotency_key'] for _, data in valid
+            if data.get('idempotency_key')}
+    existing = {}
+    if keys:
+        # A sender writes to chats on any shard, so every shard is asked.
+        def lookup(alias, _):
+            return list(Message.objects.using(alias).filter(
+                sender=user, idempotency_key__in=keys
+            ).values_list('idempotency_key', 'id'))
+
+        for found in sharding.scatter(
+                lookup, dict.fromkeys(sharding.shard_aliases())).values():
+            existing.update(found)
+
+    pending = []
+    repeated = []
+    batch_keys = {}
+    for index, data in valid:
+        key = data.get('idempotency_key') or None
+        if key in existing:
+            results[index] = {'index': index, 'status': 'duplicate',
+                              'id': existing[key]}
+        elif key in batch_keys:
+            repeated.append((index, batch_keys[key]))
+        else:
+            message = Message(chat=chats[data['chat']], sender=user,
+                              text=data['text'], idempotency_key=key)
+            pending.append((index, message))
+            if key is not None:
+                batch_keys[key] = message
+
+    with sharding.atomic(message.chat_id for _, message in pending):
+        created = Message.objects.bulk_create(
+            [message for _, message in pending])
+        messages_created.send(sender=Message, messages=created)
+
+    for index, message in pending:
+        results[index] = {'index': index, 'status': 'created',
+                          'id': message.id}
+    for index, message in repeated:
+        results[index] = {'index': index, 'status': 'duplicate',
+                          'id': message.id}
+
+
+def broadcast_message(manager, text, client_ids=None, create_missing=False):
+    """
+    Send ``text`` from ``manager`` to the chats with ``client_ids``, or to
+    all of the manager's chats when ``client_ids`` is None. Chats are
+    looked up with one query; with ``create_missing`` the chats with
+    clients that have none yet are created. Returns ``(messages,
+    created_chat_ids, missing_client_ids)``.
+    """
+    chats = Chat.objects.filter(manager=manager)
+    if client_ids is not None:
+        chats = chats.filter(client_id__in=client_ids)
+    chats = {chat.client_id: chat for chat in chats}
+    missing = sorted(set(client_ids or ()) - set(chats))
+
+    # The shards of the chats created below are not known yet.
+    with sharding.atomic():
+        created_chats = []
+        if missing and create_missing:
+            clients = set(User.objects.filter(
+                pk__in=missing, profile__role='client'
+            ).values_list('pk', flat=True))
+            Chat.objects.bulk_create(
+                [Chat(manager=manager, client_id=client_id)
+                 for client_id in clients], ignore_conflicts=True)
+            # Ids are not returned with ignore_conflicts; chats created
+            # concurrently are picked up as well.
+            created_chats = list(Chat.objects.filter(
+                manager=manager, client_id__in=clients))
+            SyncEvent.objects.bulk_create([
+                SyncEvent(user_id=user_id, chat_id=chat.pk, kind='chat',
+                          object_id=chat.pk)
+                for chat in created_chats
+                for user_id in (chat.manager_id, chat.client_id)
+            ])
+            for chat in created_chats:
+                chats[chat.client_id] = chat
+            missing = sorted(set(missing) - clients)
+
+        messages = Message.objects.bulk_create([
+            Message(chat=chat, sender=manager, text=text)
+            for chat in chats.values()
+        ])
+        messages_created.send(sender=Message, messages=messages)
+    return messages, [chat.pk for chat in created_chats], missing
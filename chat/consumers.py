@@ -0,0 +1,105 @@
+import asyncio
+import io
+import json
+from importlib import import_module
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.asgi import ASGIRequest
+from django.http.request import validate_host
+from django.utils.functional import SimpleLazyObject
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from .fanout import get_fanout
+from .views import ChatViewSet
+
+WEBSOCKET_PATH = '/ws/chats/'
+
+# Application-level close codes, see RFC 6455, section 7.4.2.
+CLOSE_NOT_FOUND = 4404
+CLOSE_FORBIDDEN = 4403
+
+
+def origin_allowed(request):
+    origin = request.META.get('HTTP_ORIGIN')
+    if origin is None:
+        return True
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    return validate_host(urlparse(origin).hostname or '', allowed_hosts)
+
+
+def authenticate_websocket(scope):
+    """
+    Resolve the user of a WebSocket handshake with the authentication
+    classes of ``ChatViewSet``. Browsers cannot set headers on a WebSocket,
+    so the token may also be passed as ``?token=<key>``.
+    """
+    request = ASGIRequest(dict(scope, method='GET'), io.BytesIO())
+    if not origin_allowed(request):
+        return None
+    token = request.GET.get('token')
+    if token and 'HTTP_AUTHORIZATION' not in request.META:
+        request.META['HTTP_AUTHORIZATION'] = f'Token {token}'
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    request.user = SimpleLazyObject(lambda: get_user(request))
+
+    drf_request = Request(request, authenticators=[
+        authenticator() for authenticator in ChatViewSet.authentication_classes
+    ])
+    try:
+        user = drf_request.user
+    except APIException:
+        return None
+    if not user.is_authenticated:
+        return None
+    return user
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Pushes ``message.created``, ``messages.read`` and ``unread.changed``
+    events to the authenticated user. Anything the client sends is ignored.
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if scope['path'] != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    user = await sync_to_async(authenticate_websocket)(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+    await send({'type': 'websocket.accept'})
+
+    fanout = get_fanout()
+    subscription = fanout.subscribe(user.pk)
+    incoming = asyncio.ensure_future(receive())
+    outgoing = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {incoming, outgoing}, return_when=asyncio.FIRST_COMPLETED)
+            if incoming in done:
+                if incoming.result()['type'] == 'websocket.disconnect':
+                    return
+                incoming = asyncio.ensure_future(receive())
+            if outgoing in done:
+                await send({
+                    'type': 'websocket.send',
+                    'text': json.dumps(outgoing.result(), cls=JSONEncoder,
+                                       ensure_ascii=False),
+                })
+                outgoing = asyncio.ensure_future(subscription.get())
+    finally:
+        incoming.cancel()
+        outgoing.cancel()
+        fanout.unsubscribe(subscription)
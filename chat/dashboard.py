@@ -0,0 +1,328 @@
+import bisect
+import math
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.utils import timezone
+
+from . import sharding
+from .models import (Chat, ChatReadState, ChatStats, ManagerStats, Message,
+                     Profile)
+from .serializers import format_timestamp
+
+# Upper bounds, in seconds, of the first-response time histogram buckets;
+# one more bucket takes everything slower.
+RESPONSE_TIME_BUCKETS = (30, 60, 120, 300, 600, 900, 1800, 3600, 7200,
+                         14400, 28800, 86400, 172800, 604800)
+
+CHAT_STATS_FIELDS = ('manager_id', 'client_id', 'unread_count',
+                     'last_client_message_id', 'awaiting_since')
+
+# Rows read per database round trip while replaying the message history.
+REBUILD_CHUNK_SIZE = 5000
+
+
+def add_response(stats, seconds):
+    """Count a first-response time of ``seconds`` in ``stats``."""
+    if not stats.response_histogram:
+        stats.response_histogram = [0] * (len(RESPONSE_TIME_BUCKETS) + 1)
+    stats.response_histogram[
+        bisect.bisect_left(RESPONSE_TIME_BUCKETS, seconds)] += 1
+    stats.response_count += 1
+    stats.response_seconds += seconds
+
+
+def response_histogram(stats):
+    return stats.response_histogram or [0] * (len(RESPONSE_TIME_BUCKETS) + 1)
+
+
+def median_response_time(histogram):
+    """
+    Median of a first-response time histogram, in seconds, interpolated
+    linearly within its bucket. None without responses.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = total / 2
+    seen = 0
+    for index, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = RESPONSE_TIME_BUCKETS[index - 1] if index else 0
+            if index == len(RESPONSE_TIME_BUCKETS):
+                return float(lower)
+            upper = RESPONSE_TIME_BUCKETS[index]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+
+
+def advance(stats, message_id, sender_id, timestamp, last_read=0):
+    """
+    Account for a message in ``stats``, a ``ChatStats``. Messages of a chat
+    have to be passed in id order. Returns the first-response time, in
+    seconds, that the message completes, or None.
+
+    Both the signal receivers and ``compute_stats`` go through here, so a
+    rebuild replays exactly what was recorded incrementally.
+    """
+    if sender_id == stats.client_id:
+        if message_id > last_read:
+            stats.unread_count += 1
+        stats.last_client_message_id = max(stats.last_client_message_id,
+                                           message_id)
+        if stats.awaiting_since is None:
+            stats.awaiting_since = timestamp
+    elif sender_id == stats.manager_id and stats.awaiting_since is not None:
+        seconds = max((timestamp - stats.awaiting_since).total_seconds(), 0)
+        stats.awaiting_since = None
+        return seconds
+    return None
+
+
+def record_messages(messages):
+    """Update the dashboard for newly created ``messages``."""
+    by_chat = {}
+    for message in messages:
+        by_chat.setdefault(message.chat_id, []).append(message)
+    stats_rows = ChatStats.objects.using(DEFAULT_DB_ALIAS)
+    # Usually already inside the transaction that creates the messages.
+    with transaction.atomic(using=DEFAULT_DB_ALIAS, savepoint=False):
+        rows = stats_rows.select_for_update().in_bulk(list(by_chat))
+        changed = []
+        missing = []
+        responses = {}
+        for chat_id, chat_messages in by_chat.items():
+            stats = rows.get(chat_id)
+            if stats is None:
+                # A chat from before the dashboard; ``rebuild`` fills in
+                # its history.
+                chat = chat_messages[0].chat
+                stats = ChatStats(chat_id=chat_id, manager_id=chat.manager_id,
+                                  client_id=chat.client_id)
+                missing.append(stats)
+            before = [getattr(stats, field) for field in CHAT_STATS_FIELDS]
+            for message in sorted(chat_messages, key=lambda m: m.id):
+                seconds = advance(stats, message.id, message.sender_id,
+                                  message.timestamp)
+                if seconds is not None:
+                    responses.setdefault(stats.manager_id, []).append(seconds)
+            if chat_id in rows and before != [
+                    getattr(stats, field) for field in CHAT_STATS_FIELDS]:
+                changed.append(stats)
+        if changed:
+            stats_rows.bulk_update(changed, CHAT_STATS_FIELDS[2:])
+        if missing:
+            stats_rows.bulk_create(missing, ignore_conflicts=True)
+        managers = ManagerStats.objects.using(DEFAULT_DB_ALIAS)
+        for manager_id, times in responses.items():
+            stats = managers.select_for_update().filter(
+                manager_id=manager_id).first()
+            if stats is None:
+                managers.bulk_create([ManagerStats(manager_id=manager_id)],
+                                     ignore_conflicts=True)
+                stats = managers.select_for_update().get(
+                    manager_id=manager_id)
+            for seconds in times:
+                add_response(stats, seconds)
+            stats.save(update_fields=['response_count', 'response_seconds',
+                                      'response_histogram'])
+
+
+def record_read(chat, user, last_read_message_id):
+    """Update the unread backlog of ``chat`` after ``user`` has read it."""
+    if user.pk != chat.manager_id:
+        return
+    rows = ChatStats.objects.using(DEFAULT_DB_ALIAS).filter(chat_id=chat.pk)
+    # Usually everything has been read, which needs no count.
+    if not rows.filter(
+            last_client_message_id__lte=last_read_message_id).update(
+            unread_count=0):
+        rows.update(unread_count=Message.objects.for_chat(chat).filter(
+            sender_id=chat.client_id, id__gt=last_read_message_id).count())
+
+
+def refresh_chat(chat):
+    """
+    Recompute the counters of ``chat`` from its messages, after messages
+    were deleted or the participants changed. Recorded response times are
+    kept.
+    """
+    messages = Message.objects.for_chat(chat)
+    client_messages = messages.filter(sender_id=chat.client_id)
+    last_read = ChatReadState.objects.using(DEFAULT_DB_ALIAS).filter(
+        chat_id=chat.pk, user_id=chat.manager_id).values_list(
+        'last_read_message_id', flat=True).first() or 0
+    last_reply = messages.filter(sender_id=chat.manager_id).aggregate(
+        last=Max('id'))['last'] or 0
+    ChatStats.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        chat_id=chat.pk, defaults={
+            'manager_id': chat.manager_id,
+            'client_id': chat.client_id,
+            'unread_count': client_messages.filter(id__gt=last_read).count(),
+            'last_client_message_id': client_messages.aggregate(
+                last=Max('id'))['last'] or 0,
+            'awaiting_since': client_messages.filter(
+                id__gt=last_reply).aggregate(first=Min('timestamp'))['first'],
+        })
+
+
+def compute_stats(log=None):
+    """
+    Dashboard rows computed from scratch by replaying every message:
+    ``({chat_id: ChatStats}, {manager_id: ManagerStats})``, unsaved.
+    """
+    chats = {
+        chat_id: ChatStats(chat_id=chat_id, manager_id=manager_id,
+                           client_id=client_id)
+        for chat_id, manager_id, client_id in Chat.objects.using(
+            DEFAULT_DB_ALIAS).values_list('id', 'manager_id', 'client_id')
+    }
+    cursors = dict(ChatReadState.objects.using(DEFAULT_DB_ALIAS).filter(
+        user_id=F('chat__manager_id')).values_list(
+        'chat_id', 'last_read_message_id'))
+    managers = {}
+    for alias in sharding.shard_aliases():
+        alias = alias or DEFAULT_DB_ALIAS
+        # Ids grow with time, so walking the primary key replays every
+        # chat in order.
+        rows = Message.objects.using(alias).order_by('id').values_list(
+            'chat_id', 'id', 'sender_id', 'timestamp').iterator(
+            chunk_size=REBUILD_CHUNK_SIZE)
+        for count, (chat_id, message_id, sender_id,
+                    timestamp) in enumerate(rows, 1):
+            stats = chats.get(chat_id)
+            if stats is None:
+                continue
+            seconds = advance(stats, message_id, sender_id, timestamp,
+                              cursors.get(chat_id, 0))
+            if seconds is not None:
+                manager = managers.get(stats.manager_id)
+                if manager is None:
+                    manager = managers[stats.manager_id] = ManagerStats(
+                        manager_id=stats.manager_id)
+                add_response(manager, seconds)
+            if log is not None and not count % (REBUILD_CHUNK_SIZE * 20):
+                log(f'{alias}: replayed {count} messages')
+    return chats, managers
+
+
+def rebuild(log=None):
+    """
+    Replace the dashboard tables with rows computed from the messages.
+    Returns ``(chats, managers)``, the numbers of rows written.
+    """
+    chats, managers = compute_stats(log)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        ChatStats.objects.using(DEFAULT_DB_ALIAS).all().delete()
+        ChatStats.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            chats.values(), batch_size=REBUILD_CHUNK_SIZE)
+        ManagerStats.objects.using(DEFAULT_DB_ALIAS).all().delete()
+        ManagerStats.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            managers.values(), batch_size=REBUILD_CHUNK_SIZE)
+    return len(chats), len(managers)
+
+
+def verify(log=None):
+    """
+    Compare the dashboard tables with rows computed from the messages and
+    return the differences, one line each.
+    """
+    chats, managers = compute_stats(log)
+    problems = []
+    stored = ChatStats.objects.using(DEFAULT_DB_ALIAS).in_bulk()
+    for chat_id, expected in chats.items():
+        row = stored.pop(chat_id, None)
+        if row is None:
+            problems.append(f'chat {chat_id}: no stats')
+            continue
+        for field in CHAT_STATS_FIELDS:
+            if getattr(row, field) != getattr(expected, field):
+                problems.append(f'chat {chat_id}: {field} is '
+                                f'{getattr(row, field)}, expected '
+                                f'{getattr(expected, field)}')
+    problems.extend(f'chat {chat_id}: stats of a deleted chat'
+                    for chat_id in stored)
+
+    stored = ManagerStats.objects.using(DEFAULT_DB_ALIAS).in_bulk()
+    for manager_id in sorted(set(stored) | set(managers)):
+        row = stored.get(manager_id) or ManagerStats(manager_id=manager_id)
+        expected = managers.get(manager_id) or ManagerStats(
+            manager_id=manager_id)
+        if (row.response_count != expected.response_count
+                or response_histogram(row) != response_histogram(expected)
+                or not math.isclose(row.response_seconds,
+                                    expected.response_seconds,
+                                    rel_tol=1e-9, abs_tol=1e-6)):
+            problems.append(
+                f'manager {manager_id}: {row.response_count} responses '
+                f'{response_histogram(row)}, expected {expected.response_count} '
+                f'{response_histogram(expected)}')
+    return problems
+
+
+def manager_summaries(manager_ids=None):
+    """
+    Dashboard of the managers ``manager_ids`` (all managers by default),
+    read from the summary tables only.
+    """
+    profiles = Profile.objects.filter(role='manager')
+    if manager_ids is not None:
+        profiles = profiles.filter(user_id__in=manager_ids)
+    usernames = dict(profiles.order_by('user_id').values_list(
+        'user_id', 'user__username'))
+    chat_stats = ChatStats.objects.filter(manager_id__in=list(usernames))
+    totals = {
+        row['manager_id']: row for row in chat_stats.values(
+            'manager_id').annotate(
+            chats=Count('pk'),
+            open_chats=Count('pk', filter=Q(awaiting_since__isnull=False)),
+            clients_with_unread=Count('pk', filter=Q(unread_count__gt=0)),
+            unread_count=Sum('unread_count'),
+            oldest_awaiting_since=Min('awaiting_since'))
+    }
+    responses = ManagerStats.objects.in_bulk(list(usernames))
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    summaries = []
+    for manager_id, username in usernames.items():
+        total = totals.get(manager_id, {})
+        stats = responses.get(manager_id) or ManagerStats(
+            manager_id=manager_id)
+        oldest = total.get('oldest_awaiting_since')
+        median = median_response_time(stats.response_histogram)
+        summaries.append({
+            'manager': manager_id,
+            'username': username,
+            'chats': total.get('chats', 0),
+            'open_chats': total.get('open_chats', 0),
+            'clients_with_unread': total.get('clients_with_unread', 0),
+            'unread_count': total.get('unread_count') or 0,
+            'oldest_awaiting_since': format_timestamp(oldest, tz)
+            if oldest else None,
+            'responses': stats.response_count,
+            'median_first_response_seconds': round(median, 1)
+            if median is not None else None,
+            'mean_first_response_seconds': round(
+                stats.response_seconds / stats.response_count, 1)
+            if stats.response_count else None,
+        })
+    return summaries
+
+
+def client_backlog(manager_id):
+    """
+    Chats of a manager with unread or unanswered client messages, the
+    largest backlog first.
+    """
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    return [
+        {'chat': chat_id, 'client': client_id, 'unread_count': unread_count,
+         'awaiting_since': format_timestamp(awaiting_since, tz)
+         if awaiting_since else None}
+        for chat_id, client_id, unread_count, awaiting_since
+        in ChatStats.objects.filter(manager_id=manager_id).filter(
+            Q(unread_count__gt=0) | Q(awaiting_since__isnull=False)
+        ).order_by('-unread_count', F('awaiting_since').asc(nulls_last=True),
+                   'chat_id').values_list(
+            'chat_id', 'client_id', 'unread_count', 'awaiting_since')
+    ]
@@ -0,0 +1,86 @@
+import csv
+import json
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Message
+from .serializers import format_timestamp
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+EXPORT_COLUMNS = ('chat', 'id', 'sender', 'timestamp', 'text')
+
+
+def parse_export_cursor(value):
+    """
+    ``(chat_id, message_id)`` of an export cursor ``"<chat_id>:<message_id>"``,
+    i.e. the ``chat`` and ``id`` of the last exported message.
+    """
+    chat_id, message_id = value.split(':')
+    return int(chat_id), int(message_id)
+
+
+def export_rows(chat_ids, after=None, chunk_size=None):
+    """
+    Messages of ``chat_ids`` as export records ordered by ``(chat, id)``,
+    starting after the ``(chat_id, message_id)`` cursor ``after``. Rows are
+    fetched with ``iterator()``, so memory use does not depend on the size
+    of the histories.
+    """
+    chunk_size = chunk_size or settings.CHAT_EXPORT_CHUNK_SIZE
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    for chat_id in sorted(chat_ids):
+        queryset = Message.objects.for_chat(chat_id)
+        if after is not None:
+            if chat_id < after[0]:
+                continue
+            if chat_id == after[0]:
+                queryset = queryset.filter(id__gt=after[1])
+        rows = queryset.order_by('id').values_list(
+            'id', 'sender_id', 'timestamp', 'text').iterator(
+            chunk_size=chunk_size)
+        for message_id, sender_id, timestamp, text in rows:
+            yield {'chat': chat_id, 'id': message_id, 'sender': sender_id,
+                   'timestamp': format_timestamp(timestamp, tz),
+                   'text': text}
+
+
+class LineBuffer:
+    """File-like target for ``csv.writer`` returning what is written."""
+
+    def write(self, value):
+        return value
+
+
+def render_export(records, export_format, chunk_size=None, header=True):
+    """
+    Encode ``records`` as NDJSON or CSV (with a header row unless
+    ``header`` is off), yielding text in pieces of up to ``chunk_size``
+    records.
+    """
+    chunk_size = chunk_size or settings.CHAT_EXPORT_CHUNK_SIZE
+    if export_format == 'csv':
+        writer = csv.writer(LineBuffer())
+        if header:
+            yield writer.writerow(EXPORT_COLUMNS)
+
+        def encode(record):
+            return writer.writerow([record[column]
+                                    for column in EXPORT_COLUMNS])
+    else:
+        def encode(record):
+            # U+2028/U+2029 are escaped for readers splitting on them.
+            return json.dumps(record, ensure_ascii=False).replace(
+                '\u2028', '\\u2028').replace('\u2029', '\\u2029') + '\n'
+
+    lines = []
+    for record in records:
+        lines.append(encode(record))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
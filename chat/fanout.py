@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class BaseFanout:
+    """
+    Delivers events to the WebSocket connections of users.
+
+    ``publish`` and ``subscribed`` may be called from any thread;
+    ``subscribe`` and ``unsubscribe`` are called from the event loop
+    serving the connection. A backend shared between processes (e.g. on
+    top of Redis pub/sub) only has to implement these four methods.
+    """
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, user_ids, event):
+        raise NotImplementedError
+
+    def subscribed(self, user_ids):
+        """
+        The users of ``user_ids`` with a live connection, so that events
+        that are costly to build are only built for them.
+        """
+        raise NotImplementedError
+
+
+class Subscription:
+    def __init__(self, user_id, maxsize):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning('Dropping event for slow subscriber %s',
+                           self.user_id)
+
+
+class InProcessFanout(BaseFanout):
+    """Fan-out between connections served by the current process."""
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, self.queue_size)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_ids, event):
+        with self.lock:
+            targets = [subscription
+                       for user_id in set(user_ids)
+                       for subscription in self.subscriptions.get(user_id, ())]
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put,
+                                                       event)
+            except RuntimeError:
+                # The loop of a dropped connection has already been closed.
+                self.unsubscribe(subscription)
+
+    def subscribed(self, user_ids):
+        with self.lock:
+            return {user_id for user_id in set(user_ids)
+                    if user_id in self.subscriptions}
+
+
+@lru_cache(maxsize=None)
+def get_fanout():
+    return import_string(settings.CHAT_FANOUT_BACKEND)()
@@ -0,0 +1,16 @@
+from rest_framework.filters import OrderingFilter
+
+
+class ChatOrderingFilter(OrderingFilter):
+    """
+    ``OrderingFilter`` that breaks ties by ``id`` in the direction of the
+    last requested field, so that pages stay stable and match the
+    ``(…, last_activity_at, id)`` indexes.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if ordering and ordering[-1].lstrip('-') != 'id':
+            descending = ordering[-1].startswith('-')
+            ordering = [*ordering, '-id' if descending else 'id']
+        return ordering
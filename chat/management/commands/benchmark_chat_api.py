@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import SCENARIOS, compare, run
+
+
+class Command(BaseCommand):
+    help = ("Measure latency percentiles and SQL query counts of the chat "
+            "API against the configured database (see seed_chat_data). "
+            "Write endpoints change the data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            choices=[scenario.name for scenario in SCENARIOS],
+                            help='Only run this endpoint; may be repeated.')
+        parser.add_argument('--output', help='Write results to this file.')
+        parser.add_argument('--compare', metavar='BASELINE',
+                            help='Fail on regressions against this file.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed relative latency growth.')
+
+    def handle(self, *args, **options):
+        try:
+            results = run(iterations=options['iterations'],
+                          warmup=options['warmup'],
+                          names=options['endpoints'], seed=options['seed'],
+                          log=self.stdout.write)
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, ensure_ascii=False)
+        else:
+            self.stdout.write(json.dumps(results, indent=2,
+                                         ensure_ascii=False))
+
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                regressions = compare(results, json.load(baseline),
+                                      options['threshold'])
+            if regressions:
+                raise CommandError('Regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions.'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import serialization_throughput
+from chat.renderers import orjson
+
+
+class Command(BaseCommand):
+    help = ("Compare rendering a message page through MessageSerializer "
+            "with the .values() fast path and FastJSONRenderer.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write('orjson is not installed: FastJSONRenderer '
+                              'uses the stdlib encoder.')
+        try:
+            results = serialization_throughput(options['messages'],
+                                               options['repeat'])
+        except ValueError as error:
+            raise CommandError(error)
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name}: {result['messages_per_second']} messages/s "
+                f"({result['seconds'] * 1000:.1f}ms, "
+                f"x{result['speedup']})")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chat.benchmarks import throttle_overhead
+
+
+class Command(BaseCommand):
+    help = ("Measure the cost of the token-bucket throttle checks done on "
+            "every message sent.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        results = throttle_overhead(options['iterations'])
+        for name, microseconds in results.items():
+            self.stdout.write(f'{name}: {microseconds}us per message')
@@ -0,0 +1,57 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import export_rows, parse_export_cursor, render_export
+from chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = ("Export the messages of chats as NDJSON or CSV, ordered by chat "
+            "and message id.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', default=[],
+                            help='Chat id; may be repeated.')
+        parser.add_argument('--manager',
+                            help="Username of a manager whose chats are "
+                                 "exported.")
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            default='ndjson')
+        parser.add_argument('--output', help='File path; stdout by default.')
+        parser.add_argument('--after',
+                            help='Resume after "<chat_id>:<message_id>", the '
+                                 'last exported message.')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        chat_ids = set(options['chat'])
+        if options['manager']:
+            try:
+                manager = User.objects.get(username=options['manager'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user {options['manager']!r}.")
+            chat_ids.update(Chat.objects.filter(manager=manager)
+                            .values_list('id', flat=True))
+        if not chat_ids:
+            raise CommandError('Give --chat or --manager.')
+        after = None
+        if options['after']:
+            try:
+                after = parse_export_cursor(options['after'])
+            except ValueError:
+                raise CommandError(f"Invalid cursor {options['after']!r}.")
+
+        records = export_rows(chat_ids, after, options['chunk_size'])
+        # A resumed export is appended to the file it continues.
+        append = bool(options['output']) and after is not None
+        pieces = render_export(records, options['format'],
+                               options['chunk_size'], header=not append)
+        if options['output']:
+            mode = 'a' if append else 'w'
+            with open(options['output'], mode, encoding='utf-8',
+                      newline='') as output:
+                for piece in pieces:
+                    output.write(piece)
+        else:
+            for piece in pieces:
+                self.stdout.write(piece, ending='')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from chat.retention import (FileArchive, TableArchive, prune_sync_events,
+                            purge_expired)
+
+
+class Command(BaseCommand):
+    help = ("Archive and delete messages older than their retention policy "
+            "(Chat.retention_days or CHAT_MESSAGE_RETENTION_DAYS) and /sync/ "
+            "events older than CHAT_SYNC_EVENT_RETENTION_DAYS in small "
+            "batches. Safe to interrupt and run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive-file',
+                            help='Append purged messages to this gzip '
+                                 'NDJSON file instead of the archive table.')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--pause', type=float,
+                            help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        if options['archive_file']:
+            archive = FileArchive(options['archive_file'])
+        else:
+            archive = TableArchive()
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        try:
+            purged = purge_expired(archive, options['batch_size'],
+                                   options['pause'], log=log)
+        finally:
+            archive.close()
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} messages.'))
+        pruned = prune_sync_events(options['batch_size'], options['pause'],
+                                   log=log)
+        self.stdout.write(self.style.SUCCESS(
+            f'Pruned {pruned} sync events.'))
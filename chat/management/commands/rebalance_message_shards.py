@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from chat import sharding
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = ("Move chat_message rows into the shard of their chat, e.g. "
+            "after CHAT_MESSAGE_SHARDS has changed. Run migrate on every "
+            "shard first. Copies are made before deletes, so the command "
+            "can be interrupted and run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--source', action='append', dest='sources',
+                            help='Only move rows out of this database; '
+                                 'may be repeated. Defaults to default and '
+                                 'every shard.')
+
+    def handle(self, *args, **options):
+        sources = options['sources'] or list(dict.fromkeys(
+            [DEFAULT_DB_ALIAS, *settings.CHAT_MESSAGE_SHARDS]))
+        for source in sources:
+            if source not in settings.DATABASES:
+                raise CommandError(f'Unknown database {source!r}.')
+            moved = self.move_out_of(source, options['batch_size'])
+            self.stdout.write(f'{source}: moved {moved} messages')
+
+    def move_out_of(self, source, batch_size):
+        moved = 0
+        last_id = 0
+        while True:
+            batch = list(Message.objects.using(source).filter(
+                id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                return moved
+            last_id = batch[-1].id
+            targets = {}
+            for message in batch:
+                target = (sharding.shard_for_chat(message.chat_id)
+                          or DEFAULT_DB_ALIAS)
+                if target != source:
+                    targets.setdefault(target, []).append(message)
+            for target, messages in targets.items():
+                self.copy(messages, target)
+                with transaction.atomic(using=source):
+                    Message.objects.using(source).filter(
+                        id__in=[message.id for message in messages]).delete()
+                moved += len(messages)
+
+    def copy(self, messages, target):
+        # Rows left by an interrupted run are already there; an id taken by
+        # another chat means that the shards allocated ids on their own, as
+        # they did before MessageIdSequence.
+        existing = dict(Message.objects.using(target).filter(
+            id__in=[message.id for message in messages]
+        ).values_list('id', 'chat_id'))
+        for message in messages:
+            if existing.get(message.id, message.chat_id) != message.chat_id:
+                raise CommandError(
+                    f'Message {message.id} already exists in {target} '
+                    f'for another chat.')
+        with transaction.atomic(using=target):
+            Message.objects.using(target).bulk_create(
+                [message for message in messages
+                 if message.id not in existing])
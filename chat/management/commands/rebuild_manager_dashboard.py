@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import dashboard
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the manager dashboard tables (ChatStats, ManagerStats) "
+            "from the messages, or with --verify compare them with the "
+            "messages without writing.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Only report differences; fail if any.')
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        if options['verify']:
+            problems = dashboard.verify(log)
+            for problem in problems:
+                self.stdout.write(problem)
+            if problems:
+                raise CommandError(
+                    f'{len(problems)} differences; run without --verify '
+                    f'to rebuild.')
+            self.stdout.write(self.style.SUCCESS(
+                'The dashboard matches the messages.'))
+            return
+        chats, managers = dashboard.rebuild(log)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the dashboard of {chats} chats and {managers} '
+            f'managers.'))
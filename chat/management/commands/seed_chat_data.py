@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.benchmarks import seed
+
+
+class Command(BaseCommand):
+    help = ("Fill the configured database with generated managers, chats "
+            "and messages for benchmarking. Use a dedicated database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--managers', type=int, default=500)
+        parser.add_argument('--chats', type=int, default=50000)
+        parser.add_argument('--messages', type=int, default=5000000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Seeding {connection.settings_dict['NAME']}")
+        counts = seed(options['managers'], options['chats'],
+                      options['messages'], batch_size=options['batch_size'],
+                      seed=options['seed'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            'Created {managers} managers, {clients} clients, {chats} chats '
+            'and {messages} messages.'.format(**counts)))
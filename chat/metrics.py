@@ -0,0 +1,202 @@
+import bisect
+import hmac
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Prometheus-style histogram; bucket counts are cumulated on output."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """
+    In-process registry of per-endpoint request metrics. Every worker
+    process keeps its own numbers, so each one has to be scraped.
+    """
+
+    histograms = (
+        ('chat_http_request_duration_seconds',
+         'Wall time of a request.', DURATION_BUCKETS),
+        ('chat_http_request_db_duration_seconds',
+         'Time spent in SQL queries during a request.', DURATION_BUCKETS),
+        ('chat_http_request_queries',
+         'Number of SQL queries made during a request.', QUERY_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.values = {name: {} for name, _, _ in self.histograms}
+
+    def observe(self, view, action, method, status, duration, db_duration,
+                queries):
+        labels = (view, action, method)
+        with self.lock:
+            key = labels + (str(status),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for (name, _, buckets), value in zip(
+                    self.histograms, (duration, db_duration, queries)):
+                histogram = self.values[name].get(labels)
+                if histogram is None:
+                    histogram = self.values[name][labels] = Histogram(buckets)
+                histogram.observe(value)
+
+    def render(self):
+        lines = [
+            '# HELP chat_http_requests_total Requests by endpoint and status.',
+            '# TYPE chat_http_requests_total counter',
+        ]
+        with self.lock:
+            for key, count in sorted(self.requests.items()):
+                label_text = format_labels(
+                    zip(('view', 'action', 'method', 'status'), key))
+                lines.append(f'chat_http_requests_total{{{label_text}}} '
+                             f'{count}')
+            for name, help_text, buckets in self.histograms:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(self.values[name].items()):
+                    pairs = list(zip(('view', 'action', 'method'), labels))
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',),
+                                            histogram.counts):
+                        cumulative += count
+                        label_text = format_labels(pairs + [('le', bound)])
+                        lines.append(f'{name}_bucket{{{label_text}}} '
+                                     f'{cumulative}')
+                    label_text = format_labels(pairs)
+                    lines.append(f'{name}_sum{{{label_text}}} '
+                                 f'{histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{label_text}}} '
+                                 f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(pairs):
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+
+
+request_metrics = RequestMetrics()
+
+
+class QueryRecorder:
+    """
+    ``execute_wrapper`` counting and timing SQL queries. The statements
+    themselves are kept only when ``keep_sql`` is set.
+    """
+
+    def __init__(self, keep_sql=False):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = [] if keep_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.duration += elapsed
+            if self.queries is not None:
+                self.queries.append((elapsed, sql))
+
+
+def resolve_view(view_func, method):
+    """``(view, action)`` labels of a resolved view function."""
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__qualname__', 'unknown'), method.lower()
+    actions = getattr(view_func, 'actions', None) or {}
+    return cls.__name__, actions.get(method.lower(), method.lower())
+
+
+class RequestMetricsMiddleware:
+    """
+    Records wall time, SQL time and query count of every request under the
+    resolved DRF view and action, and logs requests slower than
+    ``CHAT_SLOW_REQUEST_THRESHOLD`` seconds together with their slowest
+    queries.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = settings.CHAT_SLOW_REQUEST_THRESHOLD
+
+    def __call__(self, request):
+        recorder = QueryRecorder(keep_sql=self.slow_threshold is not None)
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view, action = getattr(request, '_metrics_view',
+                               ('unresolved', request.method.lower()))
+        request_metrics.observe(view, action, request.method,
+                                response.status_code, duration,
+                                recorder.duration, recorder.count)
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            self.log_slow_request(request, response, view, action, duration,
+                                  recorder)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = resolve_view(view_func, request.method)
+
+    def log_slow_request(self, request, response, view, action, duration,
+                         recorder):
+        slowest = sorted(recorder.queries, key=lambda query: query[0],
+                         reverse=True)
+        slowest = slowest[:settings.CHAT_SLOW_REQUEST_MAX_QUERIES]
+        logger.warning(
+            'Slow request %s %s (%s.%s) %s: %.1fms, %d queries in %.1fms%s',
+            request.method, request.path, view, action, response.status_code,
+            duration * 1000, recorder.count, recorder.duration * 1000,
+            ''.join(f'\n  {elapsed * 1000:.1f}ms {sql}'
+                    for elapsed, sql in slowest),
+        )
+
+
+def metrics_view(request):
+    """Prometheus text exposition of ``request_metrics``."""
+    token = settings.CHAT_METRICS_TOKEN
+    if token is not None:
+        expected = f'Bearer {token}'
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode(), expected.encode()):
+            return HttpResponse(status=403)
+    return HttpResponse(request_metrics.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.7 on 2026-10-17 21:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_read_states(apps, schema_editor):
+    # The newest message read by a participant becomes their cursor. Only
+    # the migrated database is read: a message shard migrated after
+    # ``default`` has neither chats nor the is_read column there.
+    db = schema_editor.connection.alias
+    Chat = apps.get_model('chat', 'Chat')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+    Message = apps.get_model('chat', 'Message')
+    states = []
+    for chat in Chat.objects.using(db).iterator():
+        for reader, sender in ((chat.manager_id, chat.client_id),
+                               (chat.client_id, chat.manager_id)):
+            last_read = Message.objects.using(db).filter(
+                chat=chat, sender_id=sender, is_read=True
+            ).aggregate(last_read=Max('id'))['last_read']
+            if last_read is not None:
+                states.append(ChatReadState(chat=chat, user_id=reader,
+                                            last_read_message_id=last_read))
+    ChatReadState.objects.using(db).bulk_create(states, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_chat_message_history_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('chat', 'user')},
+            },
+        ),
+        migrations.RunPython(seed_read_states, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
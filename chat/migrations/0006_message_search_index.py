@@ -0,0 +1,82 @@
+# Generated by Django 5.1.7 on 2026-10-17 22:02
+
+from django.db import migrations
+
+# External-content FTS5 index over chat_message.text, kept in sync by
+# triggers. Django rebuilds SQLite tables for some ALTER operations, which
+# drops the triggers: migrations that remake chat_message must call
+# create_search_triggers() again.
+CREATE_INDEX = """
+CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+    text,
+    content='chat_message',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+)
+"""
+
+CREATE_TRIGGERS = [
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message
+    BEGIN
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message
+    BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF text
+    ON chat_message
+    BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO chat_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+]
+
+DROP_TRIGGERS = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+]
+
+
+def create_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_TRIGGERS + CREATE_TRIGGERS:
+        schema_editor.execute(statement)
+    schema_editor.execute(
+        "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_INDEX)
+    create_search_triggers(apps, schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_TRIGGERS:
+        schema_editor.execute(statement)
+    schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
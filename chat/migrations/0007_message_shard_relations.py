@@ -0,0 +1,37 @@
+# Generated by Django 5.1.7 on 2026-10-17 22:14
+
+import django.db.models.deletion
+from django.conf import settings
+from importlib import import_module
+
+from django.db import migrations, models
+
+create_search_triggers = import_module(
+    'chat.migrations.0006_message_search_index').create_search_triggers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # SQLite remakes chat_message for the changes below, which drops
+        # the search index triggers; they are created again either way.
+        migrations.RunPython(migrations.RunPython.noop,
+                             create_search_triggers),
+        migrations.AlterField(
+            model_name='message',
+            name='chat',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.chat'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(create_search_triggers,
+                             migrations.RunPython.noop),
+    ]
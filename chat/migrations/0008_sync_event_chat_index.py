@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 22:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_shard_relations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='syncevent',
+            index=models.Index(fields=['user', 'chat', 'id'], name='chat_sync_user_chat_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.1.7 on 2026-10-17 22:26
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+# Same as chat.models.LAST_MESSAGE_PREVIEW_LENGTH at the time of writing.
+PREVIEW_LENGTH = 200
+
+
+def backfill_last_messages(apps, schema_editor):
+    # Only messages stored in the migrated database are considered, which
+    # is all of them unless CHAT_MESSAGE_SHARDS is already in use.
+    db = schema_editor.connection.alias
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    newest = Message.objects.using(db).filter(
+        chat=OuterRef('pk')).order_by('-timestamp', '-id').values('id')[:1]
+    chats = Chat.objects.using(db).annotate(
+        newest_id=Subquery(newest)).order_by('id')
+    batch = []
+    for chat in chats.iterator(chunk_size=1000):
+        batch.append(chat)
+        if len(batch) == 1000:
+            update_chats(Chat, Message, db, batch)
+            batch = []
+    update_chats(Chat, Message, db, batch)
+
+
+def update_chats(Chat, Message, db, chats):
+    messages = Message.objects.using(db).in_bulk(
+        [chat.newest_id for chat in chats if chat.newest_id])
+    for chat in chats:
+        message = messages.get(chat.newest_id)
+        if message is None:
+            chat.last_message = None
+            chat.last_activity_at = chat.created_at
+        else:
+            chat.last_message = {
+                'id': message.id,
+                'sender': message.sender_id,
+                'text': message.text[:PREVIEW_LENGTH],
+            }
+            chat.last_activity_at = message.timestamp
+    Chat.objects.using(db).bulk_update(
+        chats, ['last_message', 'last_activity_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_sync_event_chat_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_last_messages,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['manager', 'last_activity_at', 'id'], name='chat_manager_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['client', 'last_activity_at', 'id'], name='chat_client_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-17 23:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0012_message_attachments'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManagerStats',
+            fields=[
+                ('manager', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dashboard_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('response_count', models.PositiveIntegerField(default=0)),
+                ('response_seconds', models.FloatField(default=0)),
+                ('response_histogram', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChatStats',
+            fields=[
+                ('chat', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='chat.chat')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_client_message_id', models.BigIntegerField(default=0)),
+                ('awaiting_since', models.DateTimeField(blank=True, null=True)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('manager', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['manager', 'unread_count'], name='chat_stats_manager_unread_idx')],
+            },
+        ),
+    ]
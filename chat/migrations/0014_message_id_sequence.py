@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-17 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_manager_dashboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
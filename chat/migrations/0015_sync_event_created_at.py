@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 23:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_id_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncevent',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,6 +1,14 @@
-from django.db import models
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.utils import timezone
+from django.db.models import (Case, Count, F, Max, OuterRef, Subquery, Value,
+                              When)
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 
+from . import sharding
+from .signals import read_cursor_advanced
+
 
 class Profile(models.Model):
     ROLE_CHOICES = (
@@ -14,6 +22,93 @@ class Profile(models.Model):
                             choices=ROLE_CHOICES)
 
 
+# Characters of the last message kept on its chat for the inbox preview.
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+# Chats updated per query by ChatQuerySet.record_last_messages().
+LAST_MESSAGE_UPDATE_CHUNK_SIZE = 200
+
+
+def message_preview(message):
+    return {
+        'id': message.id,
+        'sender': message.sender_id,
+        'text': message.text[:LAST_MESSAGE_PREVIEW_LENGTH],
+    }
+
+
+class ChatQuerySet(models.QuerySet):
+    def for_participant(self, user):
+        """
+        Chats of ``user`` annotated with ``unread_count``: messages from the
+        other party after the user's read cursor.
+        """
+        role = user.profile.role
+        if role == 'manager':
+            queryset = self.filter(manager=user)
+            other = 'client'
+        elif role == 'client':
+            queryset = self.filter(client=user)
+            other = 'manager'
+        else:
+            return self.none()
+        last_read = ChatReadState.objects.filter(
+            chat=OuterRef('pk'), user=user
+        ).values('last_read_message_id')[:1]
+        queryset = queryset.annotate(
+            last_read_message_id=Coalesce(Subquery(last_read), 0))
+        if sharding.is_sharded():
+            # Messages live in other databases; unread counts are gathered
+            # from the shards by unread.attach_unread_counts().
+            return queryset
+        unread = Message.objects.filter(
+            chat=OuterRef('pk'), sender=OuterRef(other),
+            id__gt=OuterRef('last_read_message_id')
+        ).values('chat').annotate(count=Count('id')).values('count')
+        return queryset.annotate(unread_count=Coalesce(Subquery(unread), 0))
+
+    def record_last_messages(self, messages):
+        """
+        Make the newest of ``messages`` the last message of its chat, unless
+        the chat has recorded a newer one in the meantime.
+        """
+        latest = {}
+        for message in messages:
+            current = latest.get(message.chat_id)
+            if current is None or ((message.timestamp, message.id)
+                                   > (current.timestamp, current.id)):
+                latest[message.chat_id] = message
+        # One UPDATE per chunk of chats, each row getting its own values.
+        latest = list(latest.values())
+        for start in range(0, len(latest), LAST_MESSAGE_UPDATE_CHUNK_SIZE):
+            chunk = latest[start:start + LAST_MESSAGE_UPDATE_CHUNK_SIZE]
+            timestamps = Case(
+                *[When(pk=message.chat_id, then=Value(message.timestamp))
+                  for message in chunk],
+                output_field=models.DateTimeField())
+            previews = Case(
+                *[When(pk=message.chat_id,
+                       then=Value(message_preview(message),
+                                  output_field=models.JSONField()))
+                  for message in chunk],
+                output_field=models.JSONField())
+            self.filter(
+                pk__in=[message.chat_id for message in chunk],
+                last_activity_at__lte=timestamps,
+            ).update(last_message=previews, last_activity_at=timestamps)
+
+    def refresh_last_message(self, chat):
+        """Recompute the last message of ``chat`` from its history."""
+        message = Message.objects.for_chat(chat).order_by(
+            '-timestamp', '-id').first()
+        if message is None:
+            self.filter(pk=chat.pk).update(last_message=None,
+                                           last_activity_at=chat.created_at)
+        else:
+            self.filter(pk=chat.pk).update(
+                last_message=message_preview(message),
+                last_activity_at=message.timestamp)
+
+
 class Chat(models.Model):
     manager = models.ForeignKey(User,
                                 on_delete=models.CASCADE,
@@ -22,17 +117,346 @@ class Chat(models.Model):
                                on_delete=models.CASCADE,
                                related_name='client_chats')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized for the activity-sorted inbox: a preview of the newest
+    # message and its time (the creation time while the chat is empty).
+    last_message = models.JSONField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Days after which messages are archived (see chat.retention); None
+    # falls back to CHAT_MESSAGE_RETENTION_DAYS.
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+
+    objects = ChatQuerySet.as_manager()
 
     class Meta:
         unique_together = ('manager', 'client')
+        indexes = [
+            models.Index(fields=['manager', 'last_activity_at', 'id'],
+                         name='chat_manager_activity_idx'),
+            models.Index(fields=['client', 'last_activity_at', 'id'],
+                         name='chat_client_activity_idx'),
+        ]
+
+
+class MessageQuerySet(models.QuerySet):
+    """
+    Messages are stored in the shard of their chat (see ``chat.sharding``):
+    queries name the chat through ``for_chat`` and inserts are routed by
+    ``chat_id`` unless a database is given explicitly.
+    """
+
+    def for_chat(self, chat):
+        chat_id = getattr(chat, 'pk', chat)
+        return self.using(sharding.shard_for_chat(chat_id)).filter(
+            chat_id=chat_id)
+
+    def create(self, **kwargs):
+        if self._db is None and sharding.is_sharded():
+            chat = kwargs.get('chat')
+            chat_id = kwargs.get('chat_id', getattr(chat, 'pk', None))
+            return self.using(sharding.shard_for_chat(chat_id)).create(
+                **kwargs)
+        return super().create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if not sharding.is_sharded():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        new = [obj for obj in objs if obj.pk is None]
+        if new:
+            first_id = MessageIdSequence.objects.allocate(len(new))
+            for offset, obj in enumerate(new):
+                obj.pk = first_id + offset
+        if self._db is not None:
+            return super().bulk_create(objs, *args, **kwargs)
+        groups = {}
+        for obj in objs:
+            groups.setdefault(sharding.shard_for_chat(obj.chat_id),
+                              []).append(obj)
+        for alias, group in groups.items():
+            self.using(alias).bulk_create(group, *args, **kwargs)
+        return objs
+
+
+class MessageIdSequenceQuerySet(models.QuerySet):
+    def allocate(self, count):
+        """
+        Reserve ``count`` consecutive message ids and return the first one.
+        The sequence row stays locked until the caller's transaction ends,
+        so ids keep growing with time across all shards.
+        """
+        sequence = self.using(DEFAULT_DB_ALIAS).filter(pk=1)
+        with transaction.atomic(using=DEFAULT_DB_ALIAS, savepoint=False):
+            if not sequence.update(last_id=F('last_id') + count):
+                # The first sharded insert: continue above every id in use.
+                start = max(
+                    Message.objects.using(alias).aggregate(
+                        last_id=Max('id'))['last_id'] or 0
+                    for alias in dict.fromkeys(
+                        [DEFAULT_DB_ALIAS, *settings.CHAT_MESSAGE_SHARDS]))
+                self.using(DEFAULT_DB_ALIAS).bulk_create(
+                    [MessageIdSequence(pk=1, last_id=start)],
+                    ignore_conflicts=True)
+                sequence.update(last_id=F('last_id') + count)
+            last_id = sequence.values_list('last_id', flat=True).get()
+        return last_id - count + 1
+
+
+class MessageIdSequence(models.Model):
+    """
+    Source of message ids once messages are sharded: every shard would
+    otherwise count from 1, and ids would neither be unique across chats
+    nor movable between shards. A single row in the primary database holds
+    the last id handed out.
+    """
+    last_id = models.BigIntegerField(default=0)
+
+    objects = MessageIdSequenceQuerySet.as_manager()
 
 
 class Message(models.Model):
+    # No database constraints: with sharding the chat and the sender live
+    # in another database. Deletes still cascade in the ORM.
     chat = models.ForeignKey(Chat,
                              on_delete=models.CASCADE,
-                             related_name='messages')
+                             related_name='messages',
+                             db_constraint=False)
     sender = models.ForeignKey(User,
-                               on_delete=models.CASCADE)
+                               on_delete=models.CASCADE,
+                               db_constraint=False)
     text = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # Client-supplied key that makes retried bulk imports idempotent.
+    idempotency_key = models.CharField(max_length=64,
+                                       null=True,
+                                       blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and sharding.is_sharded():
+            self.pk = MessageIdSequence.objects.allocate(1)
+            kwargs.setdefault('force_insert', True)
+        super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'timestamp', 'id'],
+                         name='chat_message_history_idx'),
+            # Unread counts: messages of the other participant after the
+            # read cursor, answered from the index alone.
+            models.Index(fields=['chat', 'sender', 'id'],
+                         name='chat_message_unread_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['sender', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='chat_message_idempotency_key'),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """
+    Message moved out of ``chat_message`` by the retention purge. Kept in
+    the primary database, also after its chat has been deleted.
+    """
+    chat = models.ForeignKey(Chat,
+                             on_delete=models.DO_NOTHING,
+                             db_constraint=False,
+                             related_name='+')
+    # Id of the message in its shard; unique within the chat.
+    message_id = models.BigIntegerField()
+    sender = models.ForeignKey(User,
+                               on_delete=models.DO_NOTHING,
+                               db_constraint=False,
+                               related_name='+')
+    text = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'message_id'],
+                                    name='chat_archived_message_unique'),
+        ]
+
+
+class AttachmentBlob(models.Model):
+    """
+    Content of uploaded files, stored once under its SHA-256 (see
+    ``chat.attachments``) however many attachments share it.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    # Filled in by the background processor: sniffed content type and,
+    # for images, dimensions.
+    metadata = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class Attachment(models.Model):
+    # Kept in the primary database; the message is named by its id, which
+    # is unique within the chat.
+    chat = models.ForeignKey(Chat,
+                             on_delete=models.CASCADE,
+                             related_name='attachments')
+    message_id = models.BigIntegerField()
+    uploader = models.ForeignKey(User,
+                                 on_delete=models.CASCADE,
+                                 related_name='+')
+    blob = models.ForeignKey(AttachmentBlob,
+                             on_delete=models.PROTECT,
+                             related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'message_id'],
+                         name='chat_attachment_message_idx'),
+        ]
+
+
+class ChatReadStateQuerySet(models.QuerySet):
+    def cursors(self, chat_ids):
+        """Map ``chat_id -> {user_id: last_read_message_id}``."""
+        cursors = {}
+        for chat_id, user_id, last_read in self.filter(
+                chat_id__in=chat_ids).values_list(
+                'chat_id', 'user_id', 'last_read_message_id'):
+            cursors.setdefault(chat_id, {})[user_id] = last_read
+        return cursors
+
+    def advance(self, chat, user, message_id):
+        """
+        Move the read cursor of ``user`` in ``chat`` forward to
+        ``message_id``. The cursor never moves backwards. Returns ``True``
+        if the cursor has moved; receivers of ``read_cursor_advanced`` also
+        get the cursor it has moved from as ``previous_message_id``.
+        """
+        state = self.filter(chat=chat, user=user)
+        while True:
+            previous = state.values_list('last_read_message_id',
+                                         flat=True).first()
+            if previous is None:
+                _, created = self.get_or_create(
+                    chat=chat, user=user,
+                    defaults={'last_read_message_id': message_id})
+                if created:
+                    previous = 0
+                    break
+                # Created concurrently in the meantime: move it.
+                continue
+            if previous >= message_id:
+                return False
+            # Moved only from the cursor read above, so that the messages
+            # read in between are known; a concurrent move is retried.
+            if state.filter(last_read_message_id=previous).update(
+                    last_read_message_id=message_id):
+                break
+        read_cursor_advanced.send(sender=ChatReadState, chat=chat, user=user,
+                                  last_read_message_id=message_id,
+                                  previous_message_id=previous)
+        return True
+
+
+class ChatReadState(models.Model):
+    chat = models.ForeignKey(Chat,
+                             on_delete=models.CASCADE,
+                             related_name='read_states')
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ChatReadStateQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('chat', 'user')
+
+
+class SyncEventQuerySet(models.QuerySet):
+    def record(self, user_ids, chat_id, kind, object_id):
+        return self.bulk_create([
+            SyncEvent(user_id=user_id, chat_id=chat_id, kind=kind,
+                      object_id=object_id)
+            for user_id in set(user_ids)
+        ])
+
+
+class SyncEvent(models.Model):
+    """
+    Per-user change log behind ``/sync/``. The id of the last event a client
+    has seen is its sync cursor.
+    """
+    KIND_CHOICES = (
+        ('chat', 'Chat'),
+        ('message', 'Message'),
+        ('read', 'Read state'),
+    )
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='+')
+    # Events outlive deleted chats so that clients learn about deletions.
+    chat = models.ForeignKey(Chat,
+                             on_delete=models.DO_NOTHING,
+                             db_constraint=False,
+                             related_name='+')
+    kind = models.CharField(max_length=10,
+                            choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = SyncEventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='chat_sync_user_id_idx'),
+            models.Index(fields=['user', 'chat', 'id'],
+                         name='chat_sync_user_chat_idx'),
+        ]
+
+
+class ChatStats(models.Model):
+    """
+    Dashboard counters of a chat, kept up to date by ``chat.dashboard`` as
+    messages are created and read. Participants are copied from the chat so
+    that a manager's rows are read without joining it.
+    """
+    chat = models.OneToOneField(Chat,
+                                on_delete=models.CASCADE,
+                                primary_key=True,
+                                related_name='stats')
+    manager = models.ForeignKey(User,
+                                on_delete=models.CASCADE,
+                                related_name='+')
+    client = models.ForeignKey(User,
+                               on_delete=models.CASCADE,
+                               related_name='+')
+    # Client messages after the manager's read cursor.
+    unread_count = models.PositiveIntegerField(default=0)
+    last_client_message_id = models.BigIntegerField(default=0)
+    # Time of the first client message the manager has not answered yet.
+    awaiting_since = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['manager', 'unread_count'],
+                         name='chat_stats_manager_unread_idx'),
+        ]
+
+
+class ManagerStats(models.Model):
+    """
+    First-response times of a manager: the time from the first unanswered
+    client message of a chat to the manager's next message in it, as a
+    histogram over ``chat.dashboard.RESPONSE_TIME_BUCKETS``.
+    """
+    manager = models.OneToOneField(User,
+                                   on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name='dashboard_stats')
+    response_count = models.PositiveIntegerField(default=0)
+    response_seconds = models.FloatField(default=0)
+    response_histogram = models.JSONField(default=list)
@@ -0,0 +1,138 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ChatPagination(PageNumberPagination):
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination of a chat history on ``(timestamp, id)``.
+
+    Without a cursor the latest page is returned, ``before`` pages towards
+    older messages and ``after`` towards newer ones. Messages inside a page
+    are always in chronological order.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Некорректный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request, self.before_query_param)
+        after = self.decode_cursor(request, self.after_query_param)
+        if before is not None and after is not None:
+            raise NotFound(self.invalid_cursor_message)
+
+        if after is not None:
+            timestamp, pk = after
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+            ).order_by('timestamp', 'id')
+            rows = list(queryset[:self.page_size + 1])
+            self.has_older = True
+            rows = rows[:self.page_size]
+        else:
+            if before is not None:
+                timestamp, pk = before
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp)
+                    | Q(timestamp=timestamp, id__lt=pk)
+                )
+            queryset = queryset.order_by('-timestamp', '-id')
+            rows = list(queryset[:self.page_size + 1])
+            self.has_older = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            rows.reverse()
+
+        self.after = after
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True,
+                         'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True,
+                             'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        # The link to newer messages is given whenever there is an anchor,
+        # so that a client can keep polling it until new messages arrive.
+        if self.page:
+            cursor = self.encode_cursor(self.page[-1])
+        elif self.after is not None:
+            cursor = self.request.query_params[self.after_query_param]
+        else:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, cursor)
+
+    def get_previous_link(self):
+        if not self.has_older or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param,
+                                   self.encode_cursor(self.page[0]))
+
+    def encode_cursor(self, message):
+        # Pages hold model instances or rows from ``.values()``.
+        if isinstance(message, dict):
+            timestamp, pk = message['timestamp'], message['id']
+        else:
+            timestamp, pk = message.timestamp, message.pk
+        raw = f'{timestamp.isoformat()}|{pk}'
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, request, param):
+        encoded = request.query_params.get(param)
+        if encoded is None:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode()).decode()
+            timestamp, pk = raw.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
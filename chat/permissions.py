@@ -1,16 +1,41 @@
+from django.db.models import BooleanField, ExpressionWrapper, Q
 from rest_framework import permissions
+from rest_framework.exceptions import NotFound
 from .models import Chat
 
 
+def resolve_chat(request, chat_id):
+    """
+    Chat of a nested ``/chats/<chat_id>/...`` request. It is fetched once
+    per request together with the participation check, and shared by the
+    permission and the view.
+    """
+    resolved = getattr(request, '_resolved_chats', None)
+    if resolved is None:
+        resolved = request._resolved_chats = {}
+    key = str(chat_id)
+    if key not in resolved:
+        user = request.user
+        chat = Chat.objects.annotate(is_participant=ExpressionWrapper(
+            Q(manager=user) | Q(client=user), output_field=BooleanField()
+        )).filter(pk=chat_id).first()
+        if chat is None:
+            raise NotFound("Чат не найден.")
+        resolved[key] = chat
+    return resolved[key]
+
+
 class IsParticipant(permissions.BasePermission):
     def has_permission(self, request, view):
         if 'chat_id' in view.kwargs:
-            chat = Chat.objects.get(id=view.kwargs['chat_id'])
-            return request.user in [chat.manager, chat.client]
+            return resolve_chat(request, view.kwargs['chat_id']).is_participant
         return True
 
     def has_object_permission(self, request, view, obj):
-        return request.user in [obj.chat.manager, obj.chat.client]
+        if 'chat_id' in view.kwargs:
+            chat = resolve_chat(request, view.kwargs['chat_id'])
+            return obj.chat_id == chat.pk and chat.is_participant
+        return request.user.pk in (obj.chat.manager_id, obj.chat.client_id)
 
 
 class IsManagerOrReadOnly(permissions.BasePermission):
@@ -0,0 +1,68 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .background import BackgroundQueue
+from .models import ChatReadState
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptWriter(BackgroundQueue):
+    """
+    Applies the read cursor moves of history GETs off the request path.
+
+    Submitted moves are coalesced per ``(chat, user)``, keeping the furthest
+    one, and applied every ``CHAT_READ_RECEIPT_INTERVAL`` seconds in
+    transactions of at most ``CHAT_READ_RECEIPT_BATCH_SIZE`` cursors. A
+    move that fails, e.g. for a chat deleted since, is logged and skipped.
+    """
+    thread_name = 'chat-read-receipts'
+
+    def submit(self, chat, user, message_id):
+        super().submit((chat.pk, user.pk), (chat, user, message_id))
+
+    def get_interval(self):
+        return settings.CHAT_READ_RECEIPT_INTERVAL
+
+    def merge(self, queued, item):
+        return item if item[2] > queued[2] else queued
+
+    def apply(self, batch):
+        moves = list(batch.values())
+        if len(moves) == 1:
+            # A single move (always the case inline) needs no transaction.
+            ChatReadState.objects.advance(*moves[0])
+            return
+        size = settings.CHAT_READ_RECEIPT_BATCH_SIZE
+        for start in range(0, len(moves), size):
+            chunk = moves[start:start + size]
+            try:
+                with transaction.atomic():
+                    for move in chunk:
+                        # A failing move only loses its own savepoint.
+                        try:
+                            with transaction.atomic():
+                                ChatReadState.objects.advance(*move)
+                        except Exception:
+                            self.log_failure(move)
+            except Exception:
+                # Deferred foreign keys are only checked at commit, which
+                # fails for the whole chunk: its moves are applied alone.
+                logger.warning('Failed to commit %d read receipts, '
+                               'applying them one by one', len(chunk))
+                for move in chunk:
+                    try:
+                        with transaction.atomic():
+                            ChatReadState.objects.advance(*move)
+                    except Exception:
+                        self.log_failure(move)
+
+    def log_failure(self, move):
+        chat, user, message_id = move
+        logger.exception('Failed to move the read cursor of user %s in '
+                         'chat %s to %s', user.pk, chat.pk, message_id)
+
+
+receipt_writer = ReadReceiptWriter()
@@ -0,0 +1,169 @@
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from . import dashboard, sharding, unread
+from .authentication import token_cache
+from .fanout import get_fanout
+from .models import Chat, ChatStats, Message, Profile, SyncEvent
+from .serializers import MessageSerializer
+from .signals import messages_created, read_cursor_advanced
+
+
+def unread_changed_event(user_id):
+    total = unread.cached_total_unread(user_id)
+    if total is None:
+        user = User.objects.select_related('profile').get(pk=user_id)
+        total = unread.rebuild_total_unread(user)
+    return {'type': 'unread.changed', 'unread_count': total}
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        messages_created.send(sender=Message, messages=[instance])
+
+
+@receiver(messages_created)
+def count_unread_messages(sender, messages, **kwargs):
+    recipients = Counter(unread.recipient_id(message, message.chat)
+                         for message in messages)
+    recipients.pop(None, None)
+
+    def increment():
+        for user_id, count in recipients.items():
+            unread.increment(user_id, count)
+
+    transaction.on_commit(increment)
+
+
+@receiver(messages_created)
+def push_new_messages(sender, messages, **kwargs):
+    # Connected after count_unread_messages, so the pushed unread counts
+    # already include these messages.
+    serializer = MessageSerializer(context={'read_cursors': {}})
+    events = [
+        ((message.chat.manager_id, message.chat.client_id),
+         {'type': 'message.created',
+          'message': serializer.to_representation(message)})
+        for message in messages
+    ]
+    recipients = {unread.recipient_id(message, message.chat)
+                  for message in messages} - {None}
+
+    def push():
+        fanout = get_fanout()
+        for participants, event in events:
+            fanout.publish(participants, event)
+        # Totals are only looked up, and rebuilt if need be, for the
+        # recipients that are connected: a broadcast to offline clients
+        # costs no query per recipient.
+        for user_id in fanout.subscribed(recipients):
+            fanout.publish([user_id], unread_changed_event(user_id))
+
+    transaction.on_commit(push)
+
+
+@receiver(read_cursor_advanced)
+def count_read_messages(sender, chat, user, last_read_message_id,
+                        previous_message_id=0, **kwargs):
+    if user.pk == chat.manager_id:
+        peer_id = chat.client_id
+    elif user.pk == chat.client_id:
+        peer_id = chat.manager_id
+    else:
+        return
+    # Answered from the (chat, sender, id) index.
+    read = Message.objects.for_chat(chat).filter(
+        sender_id=peer_id, id__gt=previous_message_id,
+        id__lte=last_read_message_id).count()
+    if read:
+        transaction.on_commit(lambda: unread.decrement(user.pk, read))
+
+
+@receiver(read_cursor_advanced)
+def push_read_cursor(sender, chat, user, last_read_message_id, **kwargs):
+    event = {'type': 'messages.read', 'chat': chat.pk, 'user': user.pk,
+             'last_read_message_id': last_read_message_id}
+
+    def push():
+        fanout = get_fanout()
+        fanout.publish((chat.manager_id, chat.client_id), event)
+        if fanout.subscribed([user.pk]):
+            fanout.publish([user.pk], unread_changed_event(user.pk))
+
+    transaction.on_commit(push)
+
+
+@receiver(messages_created)
+def record_last_message(sender, messages, **kwargs):
+    Chat.objects.record_last_messages(messages)
+
+
+@receiver(messages_created)
+def record_dashboard_messages(sender, messages, **kwargs):
+    dashboard.record_messages(messages)
+
+
+@receiver(read_cursor_advanced)
+def record_dashboard_read(sender, chat, user, last_read_message_id,
+                          **kwargs):
+    dashboard.record_read(chat, user, last_read_message_id)
+
+
+@receiver(post_save, sender=Chat)
+def create_chat_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ChatStats.objects.get_or_create(
+            chat=instance, defaults={'manager_id': instance.manager_id,
+                                     'client_id': instance.client_id})
+
+
+@receiver(messages_created)
+def log_new_messages(sender, messages, **kwargs):
+    SyncEvent.objects.bulk_create([
+        SyncEvent(user_id=user_id, chat_id=message.chat_id, kind='message',
+                  object_id=message.id)
+        for message in messages
+        for user_id in (message.chat.manager_id, message.chat.client_id)
+    ])
+
+
+@receiver(read_cursor_advanced)
+def log_read_cursor(sender, chat, user, **kwargs):
+    SyncEvent.objects.record((chat.manager_id, chat.client_id), chat.pk,
+                             'read', user.pk)
+
+
+@receiver([post_save, post_delete], sender=Chat)
+def log_chat_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        SyncEvent.objects.record((instance.manager_id, instance.client_id),
+                                 instance.pk, 'chat', instance.pk)
+
+
+@receiver(pre_delete, sender=Chat)
+def delete_sharded_messages(sender, instance, using, **kwargs):
+    # The ORM cascade only reaches messages in the chat's own database.
+    alias = sharding.shard_for_chat(instance.pk)
+    if alias is not None and alias != using:
+        Message.objects.for_chat(instance).delete()
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # Also after commit, in case a concurrent request re-cached the token
+    # before the deletion became visible.
+    token_cache.invalidate(instance.key)
+    transaction.on_commit(lambda: token_cache.invalidate(instance.key))
+
+
+@receiver([post_save, post_delete], sender=Profile)
+@receiver([post_save, post_delete], sender=User)
+def forget_changed_user(sender, instance, **kwargs):
+    user_id = instance.user_id if sender is Profile else instance.pk
+    transaction.on_commit(lambda: token_cache.invalidate_user(user_id))
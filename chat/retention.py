@@ -0,0 +1,192 @@
+import gzip
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import dashboard, sharding, unread
+from .export import render_export
+from .models import ArchivedMessage, Attachment, Chat, Message, SyncEvent
+from .serializers import format_timestamp
+
+
+class TableArchive:
+    """Keeps purged messages in the ``ArchivedMessage`` table."""
+
+    def store(self, messages):
+        # Rows left by an interrupted run are already there.
+        ArchivedMessage.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+            ArchivedMessage(chat_id=message.chat_id, message_id=message.id,
+                            sender_id=message.sender_id, text=message.text,
+                            timestamp=message.timestamp)
+            for message in messages
+        ], ignore_conflicts=True)
+
+    def close(self):
+        pass
+
+
+class FileArchive:
+    """
+    Appends purged messages to a gzip-compressed NDJSON file in the format
+    of ``chat.export``. Every run adds a gzip member, which readers
+    decompress as one stream.
+    """
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+
+    def store(self, messages):
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        for piece in render_export(
+                ({'chat': message.chat_id, 'id': message.id,
+                  'sender': message.sender_id,
+                  'timestamp': format_timestamp(message.timestamp, tz),
+                  'text': message.text} for message in messages),
+                'ndjson'):
+            self.file.write(piece)
+        # On disk before the rows are deleted.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def retention_policies(now):
+    """
+    ``(default_cutoff, {chat_id: cutoff})``: messages older than the cutoff
+    of their chat are expired. The default cutoff is None when
+    ``CHAT_MESSAGE_RETENTION_DAYS`` is unset.
+    """
+    days = settings.CHAT_MESSAGE_RETENTION_DAYS
+    default_cutoff = now - timedelta(days=days) if days is not None else None
+    overrides = {
+        chat_id: now - timedelta(days=chat_days)
+        for chat_id, chat_days in Chat.objects.using(DEFAULT_DB_ALIAS)
+        .exclude(retention_days=None)
+        .values_list('id', 'retention_days')
+    }
+    return default_cutoff, overrides
+
+
+def expired_querysets(alias, default_cutoff, overrides):
+    """Querysets of the expired messages in database ``alias``."""
+    messages = Message.objects.using(alias)
+    for chat_id, cutoff in overrides.items():
+        if (sharding.shard_for_chat(chat_id) or DEFAULT_DB_ALIAS) == alias:
+            yield messages.filter(chat_id=chat_id, timestamp__lt=cutoff)
+    if default_cutoff is not None:
+        yield messages.filter(timestamp__lt=default_cutoff).exclude(
+            chat_id__in=list(overrides))
+
+
+def forget_messages(messages):
+    """
+    Clean up after deleted ``messages`` as deleting one through the API
+    does: drop their attachments, move the chats' last messages back,
+    refresh the dashboard and unread counters and tell the participants
+    through ``/sync/``.
+    """
+    message_ids = {}
+    for message in messages:
+        message_ids.setdefault(message.chat_id, []).append(message.id)
+    chats = list(Chat.objects.using(DEFAULT_DB_ALIAS).filter(
+        pk__in=message_ids))
+    attachments = Q()
+    for chat_id, ids in message_ids.items():
+        attachments |= Q(chat_id=chat_id, message_id__in=ids)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # The stored files stay: their content may be shared.
+        Attachment.objects.using(DEFAULT_DB_ALIAS).filter(
+            attachments).delete()
+        for chat in chats:
+            if (chat.last_message
+                    and chat.last_message['id'] in message_ids[chat.pk]):
+                Chat.objects.refresh_last_message(chat)
+            dashboard.refresh_chat(chat)
+        SyncEvent.objects.bulk_create([
+            SyncEvent(user_id=user_id, chat_id=chat.pk, kind='message',
+                      object_id=message_id)
+            for chat in chats
+            for message_id in message_ids[chat.pk]
+            for user_id in (chat.manager_id, chat.client_id)
+        ])
+    # Purged messages may have been counted as unread.
+    unread.reset(*{user_id for chat in chats
+                   for user_id in (chat.manager_id, chat.client_id)})
+
+
+def purge_expired(archive, batch_size=None, pause=None, now=None, log=None):
+    """
+    Move expired messages to ``archive`` and delete them, in batches of
+    ``batch_size`` rows each deleted in its own short transaction, sleeping
+    ``pause`` seconds between batches so that writers are not held up.
+    Every batch is archived before it is deleted, so an interrupted purge
+    can simply be run again. Returns the number of purged messages.
+    """
+    batch_size = batch_size or settings.CHAT_RETENTION_BATCH_SIZE
+    pause = settings.CHAT_RETENTION_PAUSE if pause is None else pause
+    default_cutoff, overrides = retention_policies(now or timezone.now())
+    purged = 0
+    for alias in sharding.shard_aliases():
+        alias = alias or DEFAULT_DB_ALIAS
+        for queryset in expired_querysets(alias, default_cutoff, overrides):
+            while True:
+                # Ids grow with time, so the oldest rows are found by
+                # walking the primary key rather than a timestamp index.
+                batch = list(queryset.order_by('id')[:batch_size])
+                if not batch:
+                    break
+                archive.store(batch)
+                with transaction.atomic(using=alias):
+                    Message.objects.using(alias).filter(
+                        id__in=[message.id for message in batch]).delete()
+                purged += len(batch)
+                forget_messages(batch)
+                if log is not None:
+                    log(f'{alias}: purged {purged} messages')
+                if pause:
+                    time.sleep(pause)
+    return purged
+
+
+def prune_sync_events(batch_size=None, pause=None, now=None, log=None):
+    """
+    Delete the ``/sync/`` events older than ``CHAT_SYNC_EVENT_RETENTION_DAYS``
+    in batches like ``purge_expired``. Only a prefix of the ids is deleted,
+    stopping at the first newer event, and the latest event is always kept:
+    a cursor below the smallest remaining id is then known to have missed
+    events. Returns the number of deleted events.
+    """
+    days = settings.CHAT_SYNC_EVENT_RETENTION_DAYS
+    if days is None:
+        return 0
+    batch_size = batch_size or settings.CHAT_RETENTION_BATCH_SIZE
+    pause = settings.CHAT_RETENTION_PAUSE if pause is None else pause
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    latest = SyncEvent.objects.order_by('-id').values_list(
+        'id', flat=True).first()
+    pruned = 0
+    while latest is not None:
+        batch = list(SyncEvent.objects.filter(id__lt=latest).order_by(
+            'id').values_list('id', 'created_at')[:batch_size])
+        # The prefix ends at the first event that has not expired.
+        expired = []
+        for event_id, created_at in batch:
+            if created_at >= cutoff:
+                break
+            expired.append(event_id)
+        if not expired:
+            break
+        SyncEvent.objects.filter(id__lte=expired[-1]).delete()
+        pruned += len(expired)
+        if log is not None:
+            log(f'pruned {pruned} sync events')
+        if len(expired) < len(batch) or len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return pruned
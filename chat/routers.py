@@ -0,0 +1,126 @@
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from . import sharding
+
+
+class RoutingState:
+    __slots__ = ('user_id', 'read_alias', 'pinned')
+
+    def __init__(self, user_id, read_alias):
+        self.user_id = user_id
+        self.read_alias = read_alias
+        self.pinned = False
+
+
+_state = ContextVar('chat_routing_state', default=None)
+
+
+def pin_key(user_id):
+    return f'chat:db_primary:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """Keep the reads of ``user_id`` on the primary for a while."""
+    cache.set(pin_key(user_id), True,
+              settings.CHAT_READ_YOUR_WRITES_WINDOW)
+
+
+def replica_alias():
+    """
+    ``CHAT_READ_REPLICA``, or None when it is unset or names the primary's
+    database (as it does by default and in tests).
+    """
+    alias = settings.CHAT_READ_REPLICA
+    if not alias or alias == DEFAULT_DB_ALIAS:
+        return None
+    if (str(connections[alias].settings_dict['NAME'])
+            == str(connections[DEFAULT_DB_ALIAS].settings_dict['NAME'])):
+        return None
+    return alias
+
+
+def start_request(request, replica_reads=True):
+    """
+    Route the reads of a DRF request: safe requests go to
+    ``CHAT_READ_REPLICA`` unless the user wrote something recently.
+    Returns a token for ``end_request``.
+    """
+    user = request.user
+    user_id = user.pk if user.is_authenticated else None
+    read_alias = None
+    replica = replica_alias()
+    if (replica and replica_reads and request.method in SAFE_METHODS
+            and not (user_id and cache.get(pin_key(user_id)))):
+        read_alias = replica
+    return _state.set(RoutingState(user_id, read_alias))
+
+
+def end_request(token):
+    _state.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Sends reads made inside a routed request (see ``start_request``) to the
+    replica and everything else to the primary. The first write made on
+    behalf of a user pins the user's reads to the primary for
+    ``CHAT_READ_YOUR_WRITES_WINDOW`` seconds.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None:
+            return None
+        return state.read_alias
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and state.user_id and not state.pinned:
+            state.pinned = True
+            pin_to_primary(state.user_id)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, settings.CHAT_READ_REPLICA}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class MessageShardRouter:
+    """
+    Sends ``Message`` rows to the shard of their chat when the instance is
+    known (saves, deletes, ``chat.messages``), and keeps relations loaded
+    from a message on the primary. Querysets are routed by
+    ``Message.objects.for_chat``.
+    """
+
+    def route(self, model, instance):
+        if not sharding.is_sharded() or instance is None:
+            return None
+        if model._meta.label == 'chat.Message':
+            if instance._meta.label == 'chat.Message':
+                return sharding.shard_for_chat(instance.chat_id)
+            if instance._meta.label == 'chat.Chat':
+                return sharding.shard_for_chat(instance.pk)
+            return None
+        if instance._meta.label == 'chat.Message':
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if sharding.is_sharded() and 'chat.Message' in (
+                obj1._meta.label, obj2._meta.label):
+            return True
+        return None
@@ -0,0 +1,111 @@
+from django.db import connections, router
+from django.db.models import Q
+
+from . import sharding
+from .models import Chat, Message
+
+
+def match_expression(query):
+    """
+    Turn free text into an FTS5 query: every word is a quoted phrase, so
+    operators and punctuation typed by users are matched literally.
+    """
+    terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+    return ' '.join(terms)
+
+
+def search_messages(user, query, limit, offset, chat_id=None):
+    """
+    Messages in chats of ``user`` matching ``query``, best match first.
+    With sharding the shards holding chats of the user are searched
+    concurrently and their results merged by rank.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if sharding.is_sharded():
+        # The shards have no chats to join against: pass the ids instead.
+        chat_ids = Chat.objects.filter(
+            Q(manager=user) | Q(client=user)).values_list('id', flat=True)
+        if chat_id is not None:
+            chat_ids = chat_ids.filter(id=chat_id)
+        groups = sharding.group_by_shard(chat_ids)
+    else:
+        groups = {None: None}
+
+    # A single database applies the offset itself; several are merged.
+    skip = 0 if len(groups) == 1 else offset
+
+    def search(alias, chat_ids):
+        return search_shard(alias, user, query, expression, chat_ids,
+                            chat_id, limit + skip, offset - skip)
+
+    rows = sorted(
+        (rank, -pk, alias)
+        for alias, shard_rows in sharding.scatter(search, groups).items()
+        for rank, pk in shard_rows
+    )[skip:skip + limit]
+
+    ids_by_alias = {}
+    for _, pk, alias in rows:
+        ids_by_alias.setdefault(alias, []).append(-pk)
+    found = {
+        (alias, pk): message
+        for alias, ids in ids_by_alias.items()
+        for pk, message in Message.objects.using(alias).in_bulk(ids).items()
+    }
+    return [found[alias, -pk] for _, pk, alias in rows
+            if (alias, -pk) in found]
+
+
+def search_shard(using, user, query, expression, chat_ids, chat_id, limit,
+                 offset=0):
+    """
+    ``(rank, id)`` of the best matches in one database, lower rank first.
+    ``chat_ids`` limits the chats searched; without it chats are joined to
+    check that ``user`` takes part in them.
+    """
+    if using is None:
+        using = router.db_for_read(Message)
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        # Only the SQLite FTS5 index exists; elsewhere fall back to a scan.
+        queryset = Message.objects.using(using).filter(
+            text__icontains=query).order_by('-id')
+        if chat_ids is None:
+            queryset = queryset.filter(chat__in=Chat.objects.filter(
+                Q(manager=user) | Q(client=user)))
+        else:
+            queryset = queryset.filter(chat_id__in=chat_ids)
+        if chat_id is not None:
+            queryset = queryset.filter(chat_id=chat_id)
+        return [(0, pk) for pk in queryset.values_list('id', flat=True)[
+            offset:offset + limit]]
+
+    sql = """
+        SELECT chat_message_fts.rank, m.id
+        FROM chat_message_fts
+        JOIN chat_message m ON m.id = chat_message_fts.rowid
+    """
+    params = []
+    if chat_ids is None:
+        sql += """
+        JOIN chat_chat c ON c.id = m.chat_id
+        WHERE chat_message_fts MATCH %s
+          AND (c.manager_id = %s OR c.client_id = %s)
+        """
+        params += [expression, user.pk, user.pk]
+    else:
+        sql += """
+        WHERE chat_message_fts MATCH %s
+          AND m.chat_id IN ({})
+        """.format(', '.join(['%s'] * len(chat_ids)))
+        params += [expression, *chat_ids]
+    if chat_id is not None:
+        sql += ' AND m.chat_id = %s'
+        params.append(chat_id)
+    sql += ' ORDER BY chat_message_fts.rank, m.id DESC LIMIT %s OFFSET %s'
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
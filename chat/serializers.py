@@ -1,5 +1,9 @@
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Chat, Message
+from . import unread
+from .models import (ArchivedMessage, Attachment, Chat, ChatReadState,
+                     Message)
 
 
 class ChatSerializer(serializers.ModelSerializer):
@@ -7,22 +11,191 @@ class ChatSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Chat
-        fields = ['id', 'manager', 'client', 'created_at', 'unread_count']
-        read_only_fields = ['manager', 'created_at']
+        fields = ['id', 'manager', 'client', 'created_at', 'last_message',
+                  'last_activity_at', 'retention_days', 'unread_count']
+        # retention_days is a policy set by staff in the admin.
+        read_only_fields = ['manager', 'created_at', 'last_message',
+                            'last_activity_at', 'retention_days']
 
     def get_unread_count(self, obj):
+        # ChatViewSet annotates the whole list in one query; the fallback
+        # only serves freshly created instances.
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
         user = self.context['request'].user
-        if user == obj.manager:
-            return obj.messages.filter(sender=obj.client,
-                                       is_read=False).count()
-        elif user == obj.client:
-            return obj.messages.filter(sender=obj.manager,
-                                       is_read=False).count()
-        return 0
+        chats = list(Chat.objects.for_participant(user).filter(pk=obj.pk))
+        unread.attach_unread_counts(user, chats)
+        return chats[0].unread_count if chats else 0
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
         fields = ['id', 'chat', 'sender', 'text', 'timestamp', 'is_read']
-        read_only_fields = ['chat', 'sender', 'timestamp', 'is_read']
+        read_only_fields = ['chat', 'sender', 'timestamp']
+
+    def get_is_read(self, obj):
+        # A message is read once the cursor of any other participant has
+        # reached it. Views pass the cursors of the chats in the context.
+        read_cursors = self.context.get('read_cursors')
+        if read_cursors is None:
+            read_cursors = ChatReadState.objects.cursors([obj.chat_id])
+        return any(last_read >= obj.id
+                   for user_id, last_read
+                   in read_cursors.get(obj.chat_id, {}).items()
+                   if user_id != obj.sender_id)
+
+
+class ArchivedMessageSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='message_id')
+
+    class Meta:
+        model = ArchivedMessage
+        fields = ['id', 'chat', 'sender', 'text', 'timestamp']
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    message = serializers.IntegerField(source='message_id', read_only=True)
+    size = serializers.IntegerField(source='blob.size', read_only=True)
+    sha256 = serializers.CharField(source='blob.sha256', read_only=True)
+    metadata = serializers.JSONField(source='blob.metadata', read_only=True)
+
+    class Meta:
+        model = Attachment
+        fields = ['id', 'message', 'uploader', 'filename', 'content_type',
+                  'size', 'sha256', 'metadata', 'created_at']
+        read_only_fields = ['uploader', 'content_type', 'created_at']
+
+
+class AttachmentUploadSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=255)
+
+    def validate_filename(self, value):
+        # Only the base name is kept; it ends up in Content-Disposition.
+        value = value.replace('\\', '/').rsplit('/', 1)[-1]
+        if not value or value in ('.', '..') or '"' in value:
+            raise serializers.ValidationError("Некорректное имя файла.")
+        return value
+
+
+# Columns read by serialize_message_rows().
+MESSAGE_ROW_FIELDS = ('id', 'chat_id', 'sender_id', 'text', 'timestamp')
+
+
+def format_timestamp(value, tz):
+    """``DateTimeField.to_representation`` for a known timezone ``tz``."""
+    if tz is not None:
+        value = value.astimezone(tz)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def serialize_message_rows(rows, read_cursors):
+    """
+    Fast path equivalent to ``MessageSerializer(many=True).data`` for rows
+    of ``Message.objects.values(*MESSAGE_ROW_FIELDS)``: no model instances
+    or field objects, and the same output as DRF's field formatting.
+    """
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    data = []
+    for row in rows:
+        message_id = row['id']
+        sender_id = row['sender_id']
+        data.append({
+            'id': message_id,
+            'chat': row['chat_id'],
+            'sender': sender_id,
+            'text': row['text'],
+            'timestamp': format_timestamp(row['timestamp'], tz),
+            'is_read': any(last_read >= message_id
+                           for user_id, last_read
+                           in read_cursors.get(row['chat_id'], {}).items()
+                           if user_id != sender_id),
+        })
+    return data
+
+
+class BulkMessageSerializer(serializers.ModelSerializer):
+    # Participation in all chats of a batch is checked with one query.
+    chat = serializers.IntegerField(min_value=1)
+    idempotency_key = serializers.CharField(max_length=64, required=False,
+                                            allow_blank=True)
+
+    class Meta:
+        model = Message
+        fields = ['chat', 'text', 'idempotency_key']
+
+
+class BulkMessageListSerializer(serializers.Serializer):
+    messages = serializers.ListField(child=serializers.DictField(),
+                                     allow_empty=False)
+
+    def validate_messages(self, value):
+        limit = settings.CHAT_BULK_MAX_MESSAGES
+        if len(value) > limit:
+            raise serializers.ValidationError(
+                f"Не больше {limit} сообщений за запрос.")
+        return value
+
+
+class BroadcastSerializer(serializers.Serializer):
+    text = serializers.CharField()
+    clients = serializers.ListField(child=serializers.IntegerField(
+        min_value=1), allow_empty=False, required=False)
+    all_clients = serializers.BooleanField(default=False)
+    create_missing = serializers.BooleanField(default=False)
+
+    def validate_clients(self, value):
+        limit = settings.CHAT_BROADCAST_MAX_CLIENTS
+        if len(value) > limit:
+            raise serializers.ValidationError(
+                f"Не больше {limit} клиентов за запрос.")
+        return value
+
+    def validate(self, attrs):
+        if attrs['all_clients'] == ('clients' in attrs):
+            raise serializers.ValidationError(
+                "Укажите либо clients, либо all_clients.")
+        return attrs
+
+
+class ReadCursorSerializer(serializers.Serializer):
+    last_read_message_id = serializers.IntegerField(min_value=0,
+                                                    required=False)
+
+
+class SyncQuerySerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000,
+                                     default=500)
+
+
+class MessageSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=200)
+    chat = serializers.IntegerField(min_value=1, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20)
+    offset = serializers.IntegerField(min_value=0, max_value=10000,
+                                      default=0)
+
+
+class ArchiveQuerySerializer(serializers.Serializer):
+    after = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(min_value=1, max_value=200, default=50)
+
+
+class ExportQuerySerializer(serializers.Serializer):
+    export_format = serializers.ChoiceField(choices=['ndjson', 'csv'],
+                                            default='ndjson')
+    after = serializers.CharField(required=False)
+
+    def validate_after(self, value):
+        from .export import parse_export_cursor
+
+        try:
+            return parse_export_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError("Некорректный курсор.")
@@ -0,0 +1,93 @@
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_sharded():
+    return list(settings.CHAT_MESSAGE_SHARDS) != [DEFAULT_DB_ALIAS]
+
+
+def shard_aliases():
+    """
+    Databases holding messages. ``[None]`` without sharding, which leaves
+    the choice to the other routers (e.g. the read replica).
+    """
+    if not is_sharded():
+        return [None]
+    return list(settings.CHAT_MESSAGE_SHARDS)
+
+
+def shard_for_chat(chat_id):
+    """Database of the messages of ``chat_id``: a stable hash of the id."""
+    if not is_sharded():
+        return None
+    aliases = settings.CHAT_MESSAGE_SHARDS
+    return aliases[zlib.crc32(str(chat_id).encode()) % len(aliases)]
+
+
+def group_by_shard(chat_ids):
+    """Map ``alias -> [chat_id, ...]``."""
+    groups = {}
+    for chat_id in chat_ids:
+        groups.setdefault(shard_for_chat(chat_id), []).append(chat_id)
+    return groups
+
+
+@contextmanager
+def atomic(chat_ids=None):
+    """
+    A transaction on the primary database with nested transactions on the
+    shards holding the messages of ``chat_ids`` (every shard when None).
+    An error anywhere rolls back all of them. The shards commit just before
+    the primary database, so its on_commit callbacks see the messages; only
+    a failure of that last commit leaves them behind.
+    """
+    if chat_ids is None:
+        aliases = shard_aliases()
+    else:
+        aliases = group_by_shard(dict.fromkeys(chat_ids))
+    with transaction.atomic(using=DEFAULT_DB_ALIAS), ExitStack() as stack:
+        for alias in aliases:
+            if alias not in (None, DEFAULT_DB_ALIAS):
+                stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def _run(func, alias, argument):
+    try:
+        return func(alias, argument)
+    finally:
+        connections.close_all()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CHAT_SHARD_WORKERS,
+                thread_name_prefix='chat-shard')
+        return _executor
+
+
+def scatter(func, arguments):
+    """
+    Call ``func(alias, argument)`` for every item of ``arguments`` (a map
+    ``alias -> argument``) and return ``alias -> result``. Several shards
+    are queried concurrently, each in a worker thread with its own
+    connection; a single one is queried in the calling thread.
+    """
+    if len(arguments) <= 1:
+        return {alias: func(alias, argument)
+                for alias, argument in arguments.items()}
+    executor = _get_executor()
+    futures = {alias: executor.submit(_run, func, alias, argument)
+               for alias, argument in arguments.items()}
+    return {alias: future.result() for alias, future in futures.items()}
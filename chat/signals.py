@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+# Sent with ``messages`` for every batch of newly created messages,
+# including bulk inserts that bypass ``post_save``.
+messages_created = Signal()
+
+# Sent with ``chat``, ``user``, ``last_read_message_id`` and
+# ``previous_message_id`` (the cursor before the move) whenever a read cursor
+# moves forward.
+read_cursor_advanced = Signal()
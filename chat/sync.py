@@ -0,0 +1,105 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from . import sharding, unread
+from .models import Chat, ChatReadState, Message, SyncEvent
+from .serializers import ChatSerializer, MessageSerializer
+
+
+class CursorExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'Курсор устарел, требуется полная синхронизация.'
+    default_code = 'cursor_expired'
+
+
+def latest_cursor(user, chat_id=None):
+    """
+    Id of the last event of ``user``, optionally in one chat only. It
+    changes on every message, read state or chat change the user can see,
+    which also makes it a version token for the chat list and history.
+    """
+    events = SyncEvent.objects.filter(user=user)
+    if chat_id is not None:
+        events = events.filter(chat_id=chat_id)
+    return events.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def fetch_messages(message_ids):
+    """
+    Messages for ``chat_id -> {message_id, ...}`` in chronological order,
+    one query per shard.
+    """
+
+    def fetch(alias, chat_ids):
+        return list(Message.objects.using(alias).filter(
+            chat_id__in=chat_ids,
+            id__in=set().union(*(message_ids[chat_id]
+                                 for chat_id in chat_ids))))
+
+    messages = [
+        message
+        for shard_messages in sharding.scatter(
+            fetch, sharding.group_by_shard(message_ids)).values()
+        for message in shard_messages
+        if message.id in message_ids[message.chat_id]
+    ]
+    messages.sort(key=lambda message: (message.timestamp, message.id))
+    return messages
+
+
+def build_delta(user, since, limit, context):
+    """
+    Collect everything that changed for ``user`` after the cursor
+    ``since``. Runs a fixed number of queries whose size depends only on
+    the number of events returned. Raises ``CursorExpired`` when events
+    after ``since`` have been pruned.
+    """
+    oldest = SyncEvent.objects.order_by('id').values_list(
+        'id', flat=True).first()
+    if oldest is not None and since < oldest - 1:
+        raise CursorExpired()
+    events = list(SyncEvent.objects.filter(
+        user=user, id__gt=since
+    ).order_by('id').values_list('id', 'chat_id', 'kind', 'object_id')[
+        :limit + 1])
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    chat_ids = {chat_id for _, chat_id, _, _ in events}
+    message_ids = {}
+    for _, chat_id, kind, object_id in events:
+        if kind == 'message':
+            message_ids.setdefault(chat_id, set()).add(object_id)
+    read_chat_ids = {chat_id for _, chat_id, kind, _ in events
+                     if kind == 'read'}
+
+    chats = list(Chat.objects.for_participant(user).filter(
+        id__in=chat_ids).order_by('id')) if chat_ids else []
+    unread.attach_unread_counts(user, chats)
+    visible_ids = {chat.id for chat in chats}
+    message_ids = {chat_id: ids for chat_id, ids in message_ids.items()
+                   if chat_id in visible_ids}
+    messages = fetch_messages(message_ids)
+    read_cursors = ChatReadState.objects.cursors(
+        visible_ids) if visible_ids else {}
+
+    context = dict(context, read_cursors=read_cursors)
+    return {
+        'cursor': str(events[-1][0] if events else since),
+        'has_more': has_more,
+        'chats': ChatSerializer(chats, many=True, context=context).data,
+        'deleted_chats': sorted(chat_ids - visible_ids),
+        'messages': MessageSerializer(messages, many=True,
+                                      context=context).data,
+        # Messages deleted or purged after their event was recorded.
+        'deleted_messages': sorted(
+            set().union(*message_ids.values())
+            - {message.id for message in messages}),
+        'read_states': [
+            {'chat': chat_id, 'user': user_id,
+             'last_read_message_id': last_read}
+            for chat_id in sorted(read_chat_ids & visible_ids)
+            for user_id, last_read in sorted(
+                read_cursors.get(chat_id, {}).items())
+        ],
+    }
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class ChatTestRunner(DiscoverRunner):
+    """
+    Runs background work inline: the test databases live in transactions
+    that a worker thread cannot see.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.saved_background_async = settings.CHAT_BACKGROUND_ASYNC
+        settings.CHAT_BACKGROUND_ASYNC = False
+
+    def teardown_test_environment(self, **kwargs):
+        settings.CHAT_BACKGROUND_ASYNC = self.saved_background_async
+        super().teardown_test_environment(**kwargs)
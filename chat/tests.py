@@ -1,12 +1,51 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
-from rest_framework.test import APIClient
+from django.core.cache import cache
+from django.db import IntegrityError, connection, connections, router
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Count, Q, Sum
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
-from .models import Chat, Message, Profile
+from . import (attachments, benchmarks, dashboard, receivers, renderers,
+               retention, routers, sharding, throttling, unread, urls)
+from .authentication import TokenCache, token_cache
+from .consumers import websocket_application
+from .metrics import request_metrics
+from .models import (ArchivedMessage, Attachment, AttachmentBlob, Chat,
+                     ChatReadState, ChatReadStateQuerySet, ChatStats,
+                     ManagerStats, Message, Profile, SyncEvent)
+from .receipts import ReadReceiptWriter
+from .renderers import FastJSONRenderer
+from .serializers import (MESSAGE_ROW_FIELDS, MessageSerializer,
+                          serialize_message_rows)
+from .signals import messages_created, read_cursor_advanced
 
 
 class ChatViewSetTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.manager = User.objects.create_user(username='manager',
                                                 password='password')
@@ -44,16 +83,16 @@ class ChatViewSetTests(TestCase):
         response = self.client.get('/chats/')
         self.assertEqual(response.status_code, status.HTTP_200_OK,
                          msg="Менеджер должен иметь возможность видеть свои чаты")
-        self.assertEqual(len(response.data), 2,
+        self.assertEqual(len(response.data['results']), 2,
                          msg="Менеджер должен видеть два чата")
 
     def test_total_unread_count_for_manager(self):
         chat = Chat.objects.create(manager=self.manager,
                                    client=self.client_user)
         Message.objects.create(chat=chat, sender=self.client_user,
-                               text="client msg1", is_read=False)
+                               text="client msg1")
         Message.objects.create(chat=chat, sender=self.client_user,
-                               text="client msg2", is_read=False)
+                               text="client msg2")
         self.client.login(username='manager', password='password')
         response = self.client.get('/chats/total_unread_count/')
         self.assertEqual(response.status_code, status.HTTP_200_OK,
@@ -66,9 +105,9 @@ class ChatViewSetTests(TestCase):
         chat = Chat.objects.create(manager=self.manager,
                                    client=self.client_user)
         Message.objects.create(chat=chat, sender=self.manager,
-                               text="manager msg1", is_read=False)
+                               text="manager msg1")
         Message.objects.create(chat=chat, sender=self.manager,
-                               text="manager msg2", is_read=False)
+                               text="manager msg2")
         self.client.login(username='client', password='password')
         response = self.client.get('/chats/total_unread_count/')
         self.assertEqual(response.status_code, status.HTTP_200_OK,
@@ -91,6 +130,19 @@ class ChatViewSetTests(TestCase):
         self.assertEqual(chat.client.id, self.another_client.id,
                          msg="Клиент чата должен измениться на another_client")
 
+    def test_retention_days_is_read_only(self):
+        self.client.login(username='manager', password='password')
+        chat = Chat.objects.create(manager=self.manager,
+                                   client=self.client_user)
+        response = self.client.patch(f'/chats/{chat.id}/',
+                                     {'retention_days': 1}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.data['retention_days'])
+        chat.refresh_from_db()
+        self.assertIsNone(chat.retention_days,
+                          msg="Срок хранения задаётся только в админке")
+
     def test_client_cannot_update_chat(self):
         self.client.login(username='client', password='password')
         chat = Chat.objects.create(manager=self.manager,
@@ -130,6 +182,7 @@ class ChatViewSetTests(TestCase):
 
 class ChatMessageViewSetTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
 
         self.manager = User.objects.create_user(username='manager',
@@ -160,52 +213,2475 @@ class ChatMessageViewSetTests(TestCase):
         message = Message.objects.create(chat=self.chat,
                                          sender=self.client_user,
                                          text="Непрочитанное "
-                                              "сообщение клиента",
-                                         is_read=False)
+                                              "сообщение клиента")
 
         self.client.logout()  # Logout client
         self.client.login(username='manager', password='password')
         response = self.client.get(f'/chats/{self.chat.id}/messages/')
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertTrue(Message.objects.get(id=message.id).is_read)
+        self.assertGreaterEqual(self.last_read(self.manager), message.id)
 
     def test_client_can_read_messages(self):
         self.client.login(username='manager', password='password')
         message = Message.objects.create(chat=self.chat, sender=self.manager,
                                          text="Непрочитанное "
-                                              "сообщение менеджера",
-                                         is_read=False)
+                                              "сообщение менеджера")
 
         self.client.logout()
         self.client.login(username='client', password='password')
         response = self.client.get(f'/chats/{self.chat.id}/messages/')
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertTrue(Message.objects.get(id=message.id).is_read)
+        self.assertGreaterEqual(self.last_read(self.client_user), message.id)
 
     def test_messages_marked_as_read_on_list(self):
         Message.objects.create(chat=self.chat, sender=self.client_user,
-                               text="Непрочитанное сообщение клиента 1",
-                               is_read=False)
+                               text="Непрочитанное сообщение клиента 1")
         Message.objects.create(chat=self.chat, sender=self.manager,
-                               text="Непрочитанное сообщение менеджера 1",
-                               is_read=False)
+                               text="Непрочитанное сообщение менеджера 1")
 
         self.client.login(username='client', password='password')
         self.client.get(f'/chats/{self.chat.id}/messages/')
 
-        self.assertTrue(all(msg.is_read for msg in
-                            Message.objects.filter(chat=self.chat,
-                                                   sender=self.manager)))
+        self.assertTrue(all(msg.id <= self.last_read(self.client_user)
+                            for msg in Message.objects.filter(
+                                chat=self.chat, sender=self.manager)))
 
         Message.objects.create(chat=self.chat, sender=self.client_user,
-                               text="Непрочитанное сообщение клиента 2",
-                               is_read=False)
+                               text="Непрочитанное сообщение клиента 2")
 
         self.client.logout()
         self.client.login(username='manager', password='password')
         self.client.get(f'/chats/{self.chat.id}/messages/')
-        self.assertTrue(all(msg.is_read for msg in
-                            Message.objects.filter(chat=self.chat,
-                                                   sender=self.client_user)))
+        self.assertTrue(all(msg.id <= self.last_read(self.manager)
+                            for msg in Message.objects.filter(
+                                chat=self.chat, sender=self.client_user)))
+
+    def last_read(self, user):
+        return ChatReadState.objects.get(
+            chat=self.chat, user=user).last_read_message_id
+
+    def test_read_endpoint_advances_cursor(self):
+        first = Message.objects.create(chat=self.chat,
+                                       sender=self.client_user, text="1")
+        second = Message.objects.create(chat=self.chat,
+                                        sender=self.client_user, text="2")
+        self.client.force_authenticate(self.manager)
+        url = f'/chats/{self.chat.id}/messages/read/'
+
+        response = self.client.post(url, {'last_read_message_id': first.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['last_read_message_id'], first.id)
+        unread = self.client.get('/chats/total_unread_count/')
+        self.assertEqual(unread.data['unread_count'], 1)
+
+        self.client.post(url, {'last_read_message_id': 0})
+        self.assertEqual(self.last_read(self.manager), first.id,
+                         msg="Курсор не должен двигаться назад")
+
+        response = self.client.post(url, {'last_read_message_id': 10 ** 9})
+        self.assertEqual(response.data['last_read_message_id'], second.id,
+                         msg="Курсор не должен уходить дальше "
+                             "последнего сообщения")
+
+    def test_is_read_is_computed_from_peer_cursor(self):
+        message = Message.objects.create(chat=self.chat, sender=self.manager,
+                                         text="Сообщение менеджера")
+        self.client.force_authenticate(self.manager)
+        response = self.client.get(f'/chats/{self.chat.id}/messages/')
+        self.assertFalse(response.data['results'][0]['is_read'])
+
+        ChatReadState.objects.advance(self.chat, self.client_user,
+                                      message.id)
+        response = self.client.get(f'/chats/{self.chat.id}/messages/')
+        self.assertTrue(response.data['results'][0]['is_read'])
+
+    def test_cursor_created_concurrently_is_advanced(self):
+        message = Message.objects.create(chat=self.chat, sender=self.manager,
+                                         text="Сообщение менеджера")
+        get_or_create = ChatReadStateQuerySet.get_or_create
+
+        def create_lower_first(queryset, **kwargs):
+            # Another request creates the row between the update and the
+            # insert of this one.
+            ChatReadState.objects.create(chat=self.chat,
+                                         user=self.client_user,
+                                         last_read_message_id=0)
+            return get_or_create(queryset, **kwargs)
+
+        with mock.patch.object(ChatReadStateQuerySet, 'get_or_create',
+                               autospec=True,
+                               side_effect=create_lower_first):
+            self.assertTrue(ChatReadState.objects.advance(
+                self.chat, self.client_user, message.id))
+        self.assertEqual(ChatReadState.objects.get(
+            chat=self.chat, user=self.client_user).last_read_message_id,
+            message.id)
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.client_user,
+                                   text=f"Сообщение {i}")
+            for i in range(7)
+        ]
+        self.url = f'/chats/{self.chat.id}/messages/'
+        self.client.force_authenticate(self.manager)
+
+    def ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_first_page_is_latest_messages_in_order(self):
+        response = self.client.get(self.url, {'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.ids(response),
+                         [m.id for m in self.messages[4:]])
+        self.assertIsNotNone(response.data['previous'])
+
+    def test_before_and_after_cursors(self):
+        first = self.client.get(self.url, {'page_size': 3})
+        older = self.client.get(first.data['previous'])
+        self.assertEqual(self.ids(older), [m.id for m in self.messages[1:4]])
+
+        oldest = self.client.get(older.data['previous'])
+        self.assertEqual(self.ids(oldest), [self.messages[0].id])
+        self.assertIsNone(oldest.data['previous'])
+
+        newer = self.client.get(oldest.data['next'])
+        self.assertEqual(self.ids(newer), [m.id for m in self.messages[1:4]])
+
+    def test_after_cursor_returns_new_messages(self):
+        first = self.client.get(self.url)
+        empty = self.client.get(first.data['next'])
+        self.assertEqual(self.ids(empty), [])
+        self.assertEqual(empty.data['next'], first.data['next'])
+
+        message = Message.objects.create(chat=self.chat, sender=self.manager,
+                                         text="Новое сообщение")
+        response = self.client.get(first.data['next'])
+        self.assertEqual(self.ids(response), [message.id])
+
+    def test_page_size_is_bounded(self):
+        response = self.client.get(self.url, {'page_size': 10 ** 6})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 7)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'before': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_cursor_stops_at_returned_page(self):
+        latest = self.client.get(self.url, {'page_size': 4})
+        ChatReadState.objects.all().delete()
+
+        self.client.get(latest.data['previous'])
+        state = ChatReadState.objects.get(chat=self.chat, user=self.manager)
+        self.assertEqual(state.last_read_message_id, self.messages[2].id)
+        response = self.client.get('/chats/total_unread_count/')
+        self.assertEqual(response.data['unread_count'], 4)
+
+
+class ChatListQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client.force_authenticate(self.manager)
+
+    def create_chats(self, count):
+        for _ in range(count):
+            client_user = User.objects.create_user(
+                username=f'client{User.objects.count()}')
+            Profile.objects.create(user=client_user, role='client')
+            chat = Chat.objects.create(manager=self.manager,
+                                       client=client_user)
+            read = Message.objects.create(chat=chat, sender=client_user,
+                                          text="Прочитанное")
+            ChatReadState.objects.advance(chat, self.manager, read.id)
+            Message.objects.create(chat=chat, sender=client_user,
+                                   text="Непрочитанное")
+            Message.objects.create(chat=chat, sender=self.manager,
+                                   text="Ответ менеджера")
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_list_query_count_does_not_depend_on_chat_count(self):
+        self.create_chats(1)
+        self.count_list_queries()
+        _, single = self.count_list_queries()
+
+        self.create_chats(20)
+        response, many = self.count_list_queries()
+        self.assertEqual(response.data['count'], 21)
+        self.assertEqual(single, many)
+
+    def test_unread_count_is_annotated(self):
+        self.create_chats(3)
+        response, _ = self.count_list_queries()
+        self.assertEqual(
+            [chat['unread_count'] for chat in response.data['results']],
+            [1, 1, 1])
+
+    def test_list_is_paginated(self):
+        self.create_chats(3)
+        response = self.client.get('/chats/', {'page_size': 2})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.client.force_authenticate(self.manager)
+
+    def total_unread(self):
+        response = self.client.get('/chats/total_unread_count/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['unread_count']
+
+    def database_total(self, user):
+        cache.delete(unread.cache_key(user.pk))
+        return unread.rebuild_total_unread(user)
+
+    def send(self, count, sender=None):
+        return [Message.objects.create(chat=self.chat,
+                                       sender=sender or self.client_user,
+                                       text=f"Сообщение {i}")
+                for i in range(count)]
+
+    def test_steady_state_does_no_queries(self):
+        self.assertEqual(self.total_unread(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.total_unread(), 2)
+
+    def test_own_messages_are_not_counted(self):
+        self.total_unread()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(3, sender=self.manager)
+        self.assertEqual(self.total_unread(), 0)
+
+    def test_counter_is_reset_on_read(self):
+        self.total_unread()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(3)
+            self.client.get(f'/chats/{self.chat.id}/messages/')
+        self.assertEqual(self.total_unread(), 0)
+
+    def test_reads_decrement_the_counter(self):
+        self.total_unread()
+        with self.captureOnCommitCallbacks(execute=True):
+            messages = self.send(3)
+            self.send(1, sender=self.manager)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(ChatReadState.objects.advance(
+                self.chat, self.manager, messages[1].id))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.total_unread(), 1)
+
+        # Reading the history counts the newly read messages only.
+        with CaptureQueriesContext(connection) as queries, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f'/chats/{self.chat.id}/messages/')
+        self.assertFalse([query for query in queries
+                          if 'SUM(' in query['sql'].upper()])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.total_unread(), 0)
+        self.assertEqual(self.database_total(self.manager), 0)
+
+    def test_rebuild_racing_a_new_message_is_discarded(self):
+        add = cache.add
+        racing = [True]
+
+        def send_then_add(key, *args, **kwargs):
+            # The message is committed after the count, before its result
+            # is cached; the increment finds no counter yet.
+            if key == unread.cache_key(self.manager.pk) and racing:
+                racing.clear()
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.send(1)
+            return add(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'add', side_effect=send_then_add):
+            self.assertEqual(unread.get_total_unread(self.manager), 0)
+        self.assertFalse(racing)
+        self.assertIsNone(unread.cached_total_unread(self.manager.pk))
+        self.assertEqual(self.total_unread(), 1)
+
+    def without_push(self):
+        # Push callbacks query the database, which the worker threads of
+        # the concurrency tests cannot share with the test transaction.
+        for signal, handler in ((messages_created,
+                                 receivers.push_new_messages),
+                                (read_cursor_advanced,
+                                 receivers.push_read_cursor)):
+            signal.disconnect(handler)
+            self.addCleanup(signal.connect, handler)
+
+    def test_concurrent_sends(self):
+        self.without_push()
+        self.total_unread()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.send(40)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda callback: callback(), callbacks))
+        self.assertEqual(self.total_unread(), 40)
+        self.assertEqual(self.database_total(self.manager), 40)
+
+    def test_concurrent_sends_and_reads(self):
+        self.without_push()
+        self.total_unread()
+        with self.captureOnCommitCallbacks() as callbacks:
+            messages = self.send(20)
+            ChatReadState.objects.advance(self.chat, self.manager,
+                                          messages[9].id)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda callback: callback(),
+                              reversed(callbacks)))
+        self.assertEqual(self.total_unread(), 10)
+        self.assertEqual(self.database_total(self.manager), 10)
+
+
+class WebSocketTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+
+    def connect(self, user=None, path='/ws/chats/'):
+        headers = []
+        if user is not None:
+            self.client.force_login(user)
+            session = self.client.cookies[settings.SESSION_COOKIE_NAME]
+            headers.append(
+                (b'cookie', f'{session.key}={session.value}'.encode()))
+        communicator = ApplicationCommunicator(websocket_application, {
+            'type': 'websocket', 'path': path, 'query_string': b'',
+            'headers': headers,
+        })
+        return communicator
+
+    async def handshake(self, communicator):
+        await communicator.send_input({'type': 'websocket.connect'})
+        return await communicator.receive_output(timeout=1)
+
+    async def receive_event(self, communicator):
+        output = await communicator.receive_output(timeout=1)
+        self.assertEqual(output['type'], 'websocket.send')
+        return json.loads(output['text'])
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect',
+                                       'code': 1000})
+        await communicator.wait(timeout=1)
+
+    def post_message(self, user, text):
+        self.client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/chats/{self.chat.id}/messages/',
+                                        {'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data
+
+    def read_messages(self, user):
+        self.client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/chats/{self.chat.id}/messages/read/')
+
+    async def test_anonymous_connection_is_rejected(self):
+        communicator = self.connect()
+        output = await self.handshake(communicator)
+        self.assertEqual(output, {'type': 'websocket.close', 'code': 4403})
+
+    async def test_unknown_path_is_rejected(self):
+        communicator = await sync_to_async(self.connect)(self.manager,
+                                                         '/ws/other/')
+        output = await self.handshake(communicator)
+        self.assertEqual(output['code'], 4404)
+
+    async def test_new_message_is_pushed_to_participants(self):
+        communicator = await sync_to_async(self.connect)(self.manager)
+        output = await self.handshake(communicator)
+        self.assertEqual(output['type'], 'websocket.accept')
+
+        message = await sync_to_async(self.post_message)(self.client_user,
+                                                         "Привет")
+        event = await self.receive_event(communicator)
+        self.assertEqual(event['type'], 'message.created')
+        self.assertEqual(event['message']['id'], message['id'])
+        self.assertEqual(event['message']['text'], "Привет")
+        event = await self.receive_event(communicator)
+        self.assertEqual(event, {'type': 'unread.changed',
+                                 'unread_count': 1})
+        await self.disconnect(communicator)
+
+    async def test_read_cursor_is_pushed_to_peer(self):
+        communicator = await sync_to_async(self.connect)(self.client_user)
+        await self.handshake(communicator)
+        message = await sync_to_async(self.post_message)(self.client_user,
+                                                         "Вопрос")
+        await self.receive_event(communicator)
+
+        await sync_to_async(self.read_messages)(self.manager)
+        event = await self.receive_event(communicator)
+        self.assertEqual(event, {'type': 'messages.read',
+                                 'chat': self.chat.id,
+                                 'user': self.manager.id,
+                                 'last_read_message_id': message['id']})
+        await self.disconnect(communicator)
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.client.force_authenticate(self.manager)
+
+    def sync(self, **params):
+        response = self.client.get('/sync/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_initial_sync_returns_current_cursor(self):
+        Message.objects.create(chat=self.chat, sender=self.client_user,
+                               text="Старое сообщение")
+        data = self.sync()
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(self.sync(since=data['cursor'])['messages'], [])
+
+    def test_delta_contains_new_messages_chats_and_read_states(self):
+        cursor = self.sync()['cursor']
+        message = Message.objects.create(chat=self.chat,
+                                         sender=self.client_user,
+                                         text="Новое сообщение")
+        ChatReadState.objects.advance(self.chat, self.client_user,
+                                      message.id)
+
+        data = self.sync(since=cursor)
+        self.assertEqual([m['id'] for m in data['messages']], [message.id])
+        self.assertEqual([c['id'] for c in data['chats']], [self.chat.id])
+        self.assertEqual(data['chats'][0]['unread_count'], 1)
+        self.assertEqual(data['read_states'], [
+            {'chat': self.chat.id, 'user': self.client_user.id,
+             'last_read_message_id': message.id},
+        ])
+        self.assertNotEqual(data['cursor'], cursor)
+        self.assertEqual(self.sync(since=data['cursor'])['messages'], [])
+
+    def test_other_users_changes_are_not_visible(self):
+        other_manager = User.objects.create_user(username='other')
+        Profile.objects.create(user=other_manager, role='manager')
+        other_chat = Chat.objects.create(manager=other_manager,
+                                         client=self.client_user)
+        Message.objects.create(chat=other_chat, sender=self.client_user,
+                               text="Чужой чат")
+        data = self.sync(since=0)
+        self.assertEqual([c['id'] for c in data['chats']], [self.chat.id])
+        self.assertEqual(data['messages'], [])
+
+    def test_deleted_chat_is_reported(self):
+        cursor = self.sync()['cursor']
+        chat_id = self.chat.id
+        self.client.delete(f'/chats/{chat_id}/')
+        data = self.sync(since=cursor)
+        self.assertEqual(data['deleted_chats'], [chat_id])
+
+    def test_deleted_message_is_reported(self):
+        message = Message.objects.create(chat=self.chat,
+                                         sender=self.manager,
+                                         text="Удалённое сообщение")
+        cursor = self.sync()['cursor']
+        response = self.client.delete(
+            f'/chats/{self.chat.id}/messages/{message.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        data = self.sync(since=cursor)
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(data['deleted_messages'], [message.id])
+
+    def test_has_more_pages_through_the_delta(self):
+        cursor = self.sync()['cursor']
+        messages = [Message.objects.create(chat=self.chat,
+                                           sender=self.client_user,
+                                           text=f"Сообщение {i}")
+                    for i in range(5)]
+        first = self.sync(since=cursor, limit=3)
+        self.assertTrue(first['has_more'])
+        second = self.sync(since=first['cursor'], limit=3)
+        self.assertFalse(second['has_more'])
+        self.assertEqual(
+            [m['id'] for m in first['messages'] + second['messages']],
+            [m.id for m in messages])
+
+    def test_query_count_does_not_depend_on_delta_size(self):
+        cursor = self.sync()['cursor']
+        Message.objects.create(chat=self.chat, sender=self.client_user,
+                               text="Одно сообщение")
+        with CaptureQueriesContext(connection) as single:
+            self.sync(since=cursor)
+        for i in range(20):
+            Message.objects.create(chat=self.chat, sender=self.client_user,
+                                   text=f"Сообщение {i}")
+        with CaptureQueriesContext(connection) as many:
+            self.sync(since=cursor)
+        self.assertEqual(len(single), len(many))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/sync/', {'since': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChatResolutionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.stranger = User.objects.create_user(username='stranger')
+        Profile.objects.create(user=self.stranger, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.message = Message.objects.create(chat=self.chat,
+                                              sender=self.client_user,
+                                              text="Сообщение")
+        ChatReadState.objects.create(chat=self.chat, user=self.manager)
+        self.url = f'/chats/{self.chat.id}/messages/'
+        # Warm the profile cache of the authenticated user instance.
+        self.manager.profile
+        self.client.force_authenticate(self.manager)
+
+    def test_unknown_chat_returns_404(self):
+        response = self.client.get('/chats/999999/messages/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_non_participant_is_forbidden(self):
+        self.client.force_authenticate(self.stranger)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(f'{self.url}{self.message.id}/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_message_from_another_chat_is_not_found(self):
+        other_chat = Chat.objects.create(manager=self.manager,
+                                         client=self.stranger)
+        response = self.client.get(
+            f'/chats/{other_chat.id}/messages/{self.message.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_query_count(self):
+        # chat + version + page + read cursors + cursor read and update +
+        # newly read messages + dashboard backlog + change log
+        with self.assertNumQueries(9):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_retrieve_query_count(self):
+        # chat + message + read cursors
+        with self.assertNumQueries(3):
+            response = self.client.get(f'{self.url}{self.message.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_create_query_count(self):
+        # chat + read cursors + savepoint + insert + last message + chat
+        # stats + their update + manager stats + their update + change log
+        # + savepoint release; the reply answers the client's message.
+        ManagerStats.objects.create(manager=self.manager)
+        with self.assertNumQueries(11):
+            response = self.client.post(self.url, {'text': "Ответ"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        self.profile = Profile.objects.create(user=self.manager,
+                                              role='manager')
+        self.token = Token.objects.create(user=self.manager)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get_unread(self):
+        return self.client.get('/chats/total_unread_count/')
+
+    def test_user_and_profile_are_loaded_in_one_query(self):
+        unread.get_total_unread(self.manager)
+        with self.assertNumQueries(1):
+            response = self.get_unread()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            self.get_unread()
+
+    def test_invalid_token_is_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        response = self.get_unread()
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_deleted_token_is_invalidated(self):
+        self.get_unread()
+        self.token.delete()
+        response = self.get_unread()
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_role_change_is_invalidated(self):
+        self.get_unread()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.role = 'client'
+            self.profile.save()
+        self.assertIsNone(token_cache.get(self.token.key))
+        response = self.client.post('/chats/', {'client': self.manager.id})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_inactive_user_is_rejected(self):
+        self.get_unread()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manager.is_active = False
+            self.manager.save()
+        response = self.get_unread()
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TokenCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set('a', 1, 'A')
+        self.cache.set('b', 2, 'B')
+        self.cache.get('a')
+        self.cache.set('c', 3, 'C')
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 'C')
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1, 'A')
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_invalidate_user(self):
+        self.cache.set('a', 1, 'A')
+        self.cache.set('b', 2, 'B')
+        self.cache.invalidate_user(1)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 'B')
+
+
+class BulkMessageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.clients = []
+        self.chats = []
+        for i in range(2):
+            client_user = User.objects.create_user(username=f'client{i}')
+            Profile.objects.create(user=client_user, role='client')
+            self.clients.append(client_user)
+            self.chats.append(Chat.objects.create(manager=self.manager,
+                                                  client=client_user))
+        other_manager = User.objects.create_user(username='other')
+        Profile.objects.create(user=other_manager, role='manager')
+        self.foreign_chat = Chat.objects.create(manager=other_manager,
+                                                client=self.clients[0])
+        self.client.force_authenticate(self.manager)
+
+    def post(self, messages):
+        response = self.client.post('/messages/bulk/',
+                                    {'messages': messages}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results']
+
+    def test_messages_for_many_chats_are_created(self):
+        results = self.post([
+            {'chat': self.chats[0].id, 'text': "Первый"},
+            {'chat': self.chats[1].id, 'text': "Второй"},
+            {'chat': self.chats[0].id, 'text': "Третий"},
+        ])
+        self.assertEqual([r['status'] for r in results], ['created'] * 3)
+        self.assertEqual(
+            list(Message.objects.filter(chat=self.chats[0]).order_by(
+                'id').values_list('text', flat=True)),
+            ["Первый", "Третий"])
+        self.assertEqual(Message.objects.get(id=results[1]['id']).sender,
+                         self.manager)
+
+    def test_per_item_errors(self):
+        results = self.post([
+            {'chat': self.chats[0].id, 'text': ""},
+            {'chat': self.foreign_chat.id, 'text': "Чужой чат"},
+            {'chat': 999999, 'text': "Нет такого чата"},
+            {'chat': self.chats[1].id, 'text': "Нормальное"},
+        ])
+        self.assertEqual([r['status'] for r in results],
+                         ['invalid', 'forbidden', 'forbidden', 'created'])
+        self.assertIn('text', results[0]['errors'])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_idempotency_key_prevents_duplicates_on_retry(self):
+        batch = [
+            {'chat': self.chats[0].id, 'text': "Один", 'idempotency_key': 'a'},
+            {'chat': self.chats[0].id, 'text': "Два", 'idempotency_key': 'b'},
+            {'chat': self.chats[0].id, 'text': "Снова один",
+             'idempotency_key': 'a'},
+        ]
+        first = self.post(batch)
+        self.assertEqual([r['status'] for r in first],
+                         ['created', 'created', 'duplicate'])
+        self.assertEqual(first[2]['id'], first[0]['id'])
+
+        retry = self.post(batch)
+        self.assertEqual([r['status'] for r in retry], ['duplicate'] * 3)
+        self.assertEqual([r['id'] for r in retry],
+                         [first[0]['id'], first[1]['id'], first[0]['id']])
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_batch_size_is_limited(self):
+        with self.settings(CHAT_BULK_MAX_MESSAGES=2):
+            response = self.client.post('/messages/bulk/', {'messages': [
+                {'chat': self.chats[0].id, 'text': str(i)} for i in range(3)
+            ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        def count(size):
+            # The pushes after the commit are counted as well.
+            with CaptureQueriesContext(connection) as queries, \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.post([{'chat': self.chats[i % 2].id, 'text': str(i),
+                            'idempotency_key': f'{size}-{i}'}
+                           for i in range(size)])
+            return len(queries)
+
+        unread.get_total_unread(self.clients[0])
+        self.assertEqual(count(2), count(50))
+
+    def test_bulk_messages_update_unread_counters(self):
+        unread.get_total_unread(self.clients[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post([{'chat': self.chats[0].id, 'text': str(i)}
+                       for i in range(3)])
+        self.assertEqual(unread.get_total_unread(self.clients[0]), 3)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.client.force_authenticate(self.manager)
+
+    def send(self, text, chat=None):
+        return Message.objects.create(chat=chat or self.chat,
+                                      sender=self.client_user, text=text)
+
+    def search(self, **params):
+        response = self.client.get('/messages/search/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def ids(self, data):
+        return [item['id'] for item in data['results']]
+
+    def test_results_are_ranked(self):
+        once = self.send("Пришлите счёт за доставку и упаковку")
+        twice = self.send("Счёт, счёт и ещё раз счёт")
+        self.send("Совсем другое сообщение")
+        self.assertEqual(self.ids(self.search(q="счёт")), [twice.id, once.id])
+
+    def test_results_are_scoped_to_own_chats(self):
+        other_manager = User.objects.create_user(username='other')
+        Profile.objects.create(user=other_manager, role='manager')
+        other_chat = Chat.objects.create(manager=other_manager,
+                                         client=self.client_user)
+        own = self.send("Накладная номер один")
+        self.send("Накладная номер два", chat=other_chat)
+        self.assertEqual(self.ids(self.search(q="накладная")), [own.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = self.send("Старый текст")
+        message.text = "Новый текст"
+        message.save()
+        self.assertEqual(self.ids(self.search(q="старый")), [])
+        self.assertEqual(self.ids(self.search(q="новый")), [message.id])
+        message.delete()
+        self.assertEqual(self.ids(self.search(q="новый")), [])
+
+    def test_pagination(self):
+        messages = [self.send(f"Заказ {i}") for i in range(5)]
+        first = self.search(q="заказ", limit=3)
+        self.assertEqual(len(first['results']), 3)
+        second = self.client.get(first['next']).data
+        self.assertIsNone(second['next'])
+        self.assertEqual(sorted(self.ids(first) + self.ids(second)),
+                         [m.id for m in messages])
+
+    def test_query_syntax_is_escaped(self):
+        message = self.send('Цена "со скидкой" OR NOT')
+        self.assertEqual(self.ids(self.search(q='"скидкой" NOT*(')),
+                         [message.id])
+        self.assertEqual(self.ids(self.search(q='AND')), [])
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_seed_creates_requested_dataset(self):
+        counts = benchmarks.seed(managers=2, chats=5, messages=40,
+                                 batch_size=7)
+
+        self.assertEqual(counts['chats'], 5)
+        self.assertEqual(Chat.objects.count(), 5)
+        self.assertEqual(Message.objects.count(), 40)
+        self.assertEqual(Profile.objects.filter(role='manager').count(), 2)
+        self.assertEqual(ChatReadState.objects.count(), 10)
+        self.assertEqual(ChatStats.objects.count(), 5)
+        active = set(Message.objects.values_list('chat_id', flat=True))
+        self.assertEqual(
+            Chat.objects.filter(last_message__isnull=True).count(),
+            5 - len(active))
+
+    def test_run_reports_every_endpoint_without_errors(self):
+        benchmarks.seed(managers=2, chats=4, messages=60)
+
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(CHAT_ATTACHMENT_ROOT=root):
+            results = benchmarks.run(iterations=3, warmup=1)
+
+        self.assertEqual(set(results['endpoints']),
+                         {scenario.name for scenario in benchmarks.SCENARIOS})
+        for name, endpoint in results['endpoints'].items():
+            self.assertEqual(endpoint['errors'], 0, name)
+            if name != 'metrics':
+                self.assertGreater(endpoint['queries_max'], 0, name)
+            self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+
+    def test_scenarios_cover_every_endpoint(self):
+        benchmarks.seed(managers=1, chats=1, messages=5)
+        chat = Chat.objects.get()
+        rng = random.Random(0)
+        for attribute in ('bench_before_cursor', 'bench_last_message_id',
+                          'bench_sync_cursor'):
+            setattr(chat, attribute, 0)
+        covered = set()
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(CHAT_ATTACHMENT_ROOT=root):
+            for scenario in benchmarks.SCENARIOS:
+                if scenario.prepare:
+                    scenario.prepare(chat, rng)
+                match = resolve(scenario.path(chat, rng).split('?')[0])
+                covered.add((match.url_name, scenario.method))
+        expected = set()
+        patterns = list(urls.urlpatterns)
+        while patterns:
+            pattern = patterns.pop()
+            if hasattr(pattern, 'url_patterns'):
+                patterns.extend(pattern.url_patterns)
+                continue
+            if pattern.name == 'api-root' or 'format' in str(pattern.pattern):
+                continue
+            view = pattern.callback
+            if hasattr(view, 'actions'):
+                methods = view.actions
+            elif hasattr(view, 'view_class'):
+                methods = [method for method
+                           in view.view_class.http_method_names
+                           if hasattr(view.view_class, method)]
+            else:
+                methods = ['get']
+            # PUT is a full-body variant of PATCH.
+            expected.update((pattern.name, method.upper())
+                            for method in methods
+                            if method not in ('put', 'options', 'head'))
+        self.assertEqual(expected - covered, set())
+
+    def test_throttle_overhead_reports_every_case(self):
+        results = benchmarks.throttle_overhead(iterations=20)
+
+        self.assertEqual(set(results), {'unconfigured', 'allowed',
+                                        'rejected'})
+        self.assertTrue(all(value > 0 for value in results.values()))
+        self.assertIsNone(cache.get('chat:throttle:user:-1'))
+
+    def test_compare_flags_latency_and_query_regressions(self):
+        baseline = {'endpoints': {
+            'chat-list': {'p50_ms': 10.0, 'p90_ms': 20.0, 'queries_max': 3},
+            'sync': {'p50_ms': 10.0, 'p90_ms': 20.0, 'queries_max': 4},
+        }}
+        current = {'endpoints': {
+            'chat-list': {'p50_ms': 11.0, 'p90_ms': 21.0, 'queries_max': 3},
+            'sync': {'p50_ms': 13.0, 'p90_ms': 20.0, 'queries_max': 5},
+            'search': {'p50_ms': 1.0, 'p90_ms': 1.0, 'queries_max': 3},
+        }}
+
+        regressions = benchmarks.compare(current, baseline, threshold=0.2)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(line.startswith('sync:') for line in regressions))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        request_metrics.reset()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager',
+                                                password='password')
+        Profile.objects.create(user=self.manager, role='manager')
+        client_user = User.objects.create_user(username='client',
+                                               password='password')
+        Profile.objects.create(user=client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=client_user)
+        self.client.force_authenticate(user=self.manager)
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_view_and_action(self):
+        self.client.get('/chats/')
+        self.client.get('/chats/')
+        self.client.get(f'/chats/{self.chat.id}/messages/')
+        self.client.get('/chats/total_unread_count/')
+
+        body = self.metrics()
+        self.assertIn('chat_http_requests_total{view="ChatViewSet",'
+                      'action="list",method="GET",status="200"} 2', body)
+        self.assertIn('chat_http_requests_total{view="ChatMessageViewSet",'
+                      'action="list",method="GET",status="200"} 1', body)
+        self.assertIn('action="total_unread_count"', body)
+        self.assertIn('chat_http_request_duration_seconds_count{'
+                      'view="ChatViewSet",action="list",method="GET"} 2',
+                      body)
+        self.assertIn('chat_http_request_queries_bucket{view="ChatViewSet",'
+                      'action="list",method="GET",le="+Inf"} 2', body)
+
+    def test_query_counts_match_executed_queries(self):
+        executed = []
+        with connection.execute_wrapper(
+                lambda execute, sql, *args: executed.append(sql)
+                or execute(sql, *args)):
+            self.client.get('/chats/')
+
+        body = self.metrics()
+        expected = ('chat_http_request_queries_sum{view="ChatViewSet",'
+                    f'action="list",method="GET"}} {len(executed):.6f}')
+        self.assertIn(expected, body)
+
+    @override_settings(CHAT_METRICS_TOKEN='secret')
+    def test_metrics_token_is_required_when_configured(self):
+        self.assertEqual(self.client.get('/metrics').status_code,
+                         status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics',
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(CHAT_SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_requests_are_logged_with_sql(self):
+        with self.assertLogs('chat.metrics', level='WARNING') as logs:
+            self.client.get('/chats/')
+
+        self.assertIn('ChatViewSet.list', logs.output[0])
+        self.assertIn('"chat_chat"', logs.output[0])
+
+
+@mock.patch.object(routers, 'replica_alias', lambda: 'replica')
+class ReadRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = APIRequestFactory()
+        self.manager = User.objects.create_user(username='manager',
+                                                password='password')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client',
+                                                    password='password')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+
+    def route(self, method, user):
+        request = getattr(self.factory, method)('/chats/')
+        request.user = user
+        return routers.start_request(request)
+
+    def test_safe_requests_read_from_replica(self):
+        token = self.route('get', self.manager)
+        try:
+            self.assertEqual(Chat.objects.all().db, 'replica')
+            self.assertEqual(router.db_for_write(Chat), 'default')
+        finally:
+            routers.end_request(token)
+        self.assertEqual(Chat.objects.all().db, 'default')
+
+    def test_unsafe_requests_read_from_primary(self):
+        token = self.route('post', self.manager)
+        try:
+            self.assertEqual(Chat.objects.all().db, 'default')
+        finally:
+            routers.end_request(token)
+
+    def test_writer_reads_from_primary_until_window_passes(self):
+        token = self.route('post', self.manager)
+        try:
+            Message.objects.create(chat=self.chat, sender=self.manager,
+                                   text='Hi')
+        finally:
+            routers.end_request(token)
+
+        for user, alias in ((self.manager, 'default'),
+                            (self.client_user, 'replica')):
+            token = self.route('get', user)
+            try:
+                self.assertEqual(Chat.objects.all().db, alias)
+            finally:
+                routers.end_request(token)
+
+        cache.delete(routers.pin_key(self.manager.pk))
+        token = self.route('get', self.manager)
+        try:
+            self.assertEqual(Chat.objects.all().db, 'replica')
+        finally:
+            routers.end_request(token)
+
+    def test_chat_endpoints_route_reads(self):
+        aliases = []
+        route = routers.ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            aliases.append(route(router, model, **hints))
+            # The test database has no real replica behind it.
+            return None
+
+        client = APIClient()
+        client.force_authenticate(user=self.client_user)
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read',
+                               autospec=True, side_effect=record):
+            client.get('/chats/')
+            self.assertEqual(set(aliases), {'replica'})
+
+            aliases.clear()
+            client.post(f'/chats/{self.chat.id}/messages/', {'text': 'Hi'})
+            self.assertEqual(set(aliases), {None})
+
+            aliases.clear()
+            client.get('/chats/')
+            self.assertEqual(set(aliases), {None})
+
+
+SHARDS = ['default', 'messages_1', 'messages_2']
+
+
+@override_settings(CHAT_MESSAGE_SHARDS=SHARDS)
+class MessageShardingTests(TransactionTestCase):
+    databases = set(SHARDS)
+
+    def setUp(self):
+        cache.clear()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.chats = []
+        for index in range(6):
+            client_user = User.objects.create_user(
+                username=f'client{index}')
+            Profile.objects.create(user=client_user, role='client')
+            self.chats.append(Chat.objects.create(manager=self.manager,
+                                                  client=client_user))
+        self.assertGreater(
+            len({sharding.shard_for_chat(chat.pk) for chat in self.chats}),
+            1)
+
+    def api(self, user):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return client
+
+    def send_from_clients(self, count=1):
+        for chat in self.chats:
+            api = self.api(chat.client)
+            for _ in range(count):
+                response = api.post(f'/chats/{chat.id}/messages/',
+                                    {'text': f'Hello from chat {chat.id}'})
+                self.assertEqual(response.status_code,
+                                 status.HTTP_201_CREATED)
+
+    def test_messages_are_stored_in_the_shard_of_their_chat(self):
+        self.send_from_clients()
+
+        for chat in self.chats:
+            for alias in SHARDS:
+                expected = int(alias == sharding.shard_for_chat(chat.pk))
+                self.assertEqual(Message.objects.using(alias).filter(
+                    chat=chat).count(), expected)
+            response = self.api(self.manager).get(
+                f'/chats/{chat.id}/messages/')
+            self.assertEqual([message['text'] for message
+                              in response.data['results']],
+                             [f'Hello from chat {chat.id}'])
+
+    def test_unread_counts_are_gathered_from_every_shard(self):
+        self.send_from_clients(count=2)
+        api = self.api(self.manager)
+
+        response = api.get('/chats/')
+        self.assertEqual({chat['unread_count']
+                          for chat in response.data['results']}, {2})
+        response = api.get('/chats/total_unread_count/')
+        self.assertEqual(response.data['unread_count'], 12)
+
+        api.get(f'/chats/{self.chats[0].id}/messages/')
+        response = api.get('/chats/total_unread_count/')
+        self.assertEqual(response.data['unread_count'], 10)
+        cache.clear()
+        response = api.get('/chats/total_unread_count/')
+        self.assertEqual(response.data['unread_count'], 10)
+
+    def test_deleting_chat_deletes_its_messages(self):
+        self.send_from_clients()
+        chat = self.chats[1]
+        alias = sharding.shard_for_chat(chat.pk)
+
+        response = self.api(self.manager).delete(f'/chats/{chat.id}/')
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Message.objects.using(alias).filter(
+            chat_id=chat.id).exists())
+        self.assertEqual(sum(Message.objects.using(alias).count()
+                             for alias in SHARDS), 5)
+
+    def test_bulk_sync_and_search_span_shards(self):
+        api = self.api(self.manager)
+        response = api.post('/messages/bulk/', {'messages': [
+            {'chat': chat.id, 'text': f'invoice {chat.id}',
+             'idempotency_key': f'key-{chat.id}'}
+            for chat in self.chats
+        ]}, format='json')
+        self.assertEqual({result['status'] for result
+                          in response.data['results']}, {'created'})
+
+        response = api.post('/messages/bulk/', {'messages': [
+            {'chat': chat.id, 'text': 'again',
+             'idempotency_key': f'key-{chat.id}'}
+            for chat in self.chats
+        ]}, format='json')
+        self.assertEqual({result['status'] for result
+                          in response.data['results']}, {'duplicate'})
+
+        response = api.get('/messages/search/?q=invoice')
+        self.assertEqual(sorted(message['chat'] for message
+                                in response.data['results']),
+                         [chat.id for chat in self.chats])
+        response = api.get('/messages/search/?q=invoice&limit=4&offset=4')
+        self.assertEqual(len(response.data['results']), 2)
+
+        response = self.api(self.chats[2].client).get('/sync/?since=0')
+        self.assertEqual([message['text'] for message
+                          in response.data['messages']],
+                         [f'invoice {self.chats[2].id}'])
+
+    def test_message_ids_are_unique_across_shards(self):
+        with override_settings(CHAT_MESSAGE_SHARDS=['default']):
+            self.send_from_clients()
+        unsharded = max(Message.objects.using('default').values_list(
+            'id', flat=True))
+        self.send_from_clients(count=2)
+        api = self.api(self.manager)
+        api.post('/messages/bulk/', {'messages': [
+            {'chat': chat.id, 'text': 'bulk'} for chat in self.chats
+        ]}, format='json')
+
+        ids = [message_id for alias in SHARDS
+               for message_id in Message.objects.using(alias).values_list(
+                   'id', flat=True)]
+        self.assertEqual(len(ids), 24)
+        self.assertEqual(len(set(ids)), 24)
+        for chat in self.chats:
+            history = list(Message.objects.for_chat(chat).order_by(
+                'timestamp', 'id').values_list('id', flat=True))
+            self.assertEqual(history, sorted(history))
+            self.assertGreater(history[1], unsharded)
+
+        # Ids stay valid when the messages move to other shards.
+        with override_settings(CHAT_MESSAGE_SHARDS=['messages_1',
+                                                    'messages_2']):
+            call_command('rebalance_message_shards', stdout=io.StringIO())
+            self.assertEqual(sorted(
+                message_id for chat in self.chats
+                for message_id in Message.objects.for_chat(chat)
+                .values_list('id', flat=True)), sorted(ids))
+        self.assertFalse(Message.objects.using('default').exists())
+
+    def test_failure_on_default_rolls_back_the_shards(self):
+        record_messages = dashboard.record_messages
+        failures = [IntegrityError('dashboard')]
+
+        def fail_once(messages):
+            if failures:
+                raise failures.pop()
+            record_messages(messages)
+
+        with mock.patch.object(dashboard, 'record_messages',
+                               side_effect=fail_once):
+            response = self.api(self.manager).post('/messages/bulk/', {
+                'messages': [{'chat': chat.id, 'text': 'once'}
+                             for chat in self.chats]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({result['status'] for result in response.data[
+            'results']}, {'created'})
+        for chat in self.chats:
+            self.assertEqual(Message.objects.for_chat(chat).count(), 1)
+
+        failures.append(IntegrityError('dashboard'))
+        chat = self.chats[0]
+        with mock.patch.object(dashboard, 'record_messages',
+                               side_effect=fail_once), \
+                self.assertRaises(IntegrityError):
+            self.api(chat.client).post(f'/chats/{chat.id}/messages/',
+                                       {'text': 'lost'})
+        self.assertEqual(Message.objects.for_chat(chat).count(), 1)
+
+    def test_shard_migrates_after_a_populated_default(self):
+        with override_settings(CHAT_MESSAGE_SHARDS=['default']):
+            self.send_from_clients()
+        executor = MigrationExecutor(connections['messages_1'])
+        leaves = executor.loader.graph.leaf_nodes('chat')
+        executor.migrate([('chat', '0002_message_chat_message_history_idx')])
+
+        # As in the documented rollout: default first, then every shard.
+        executor = MigrationExecutor(connections['messages_1'])
+        executor.migrate(leaves)
+
+        self.assertFalse(ChatReadState.objects.using('messages_1').exists())
+        self.assertEqual(Message.objects.using('default').count(), 6)
+
+    def test_rebalance_moves_messages_into_their_shards(self):
+        with override_settings(CHAT_MESSAGE_SHARDS=['default']):
+            self.send_from_clients(count=3)
+        self.assertEqual(Message.objects.using('default').count(), 18)
+
+        call_command('rebalance_message_shards', batch_size=5,
+                     stdout=io.StringIO())
+
+        for chat in self.chats:
+            self.assertEqual(Message.objects.for_chat(chat).count(), 3)
+            self.assertEqual(sum(Message.objects.using(alias).filter(
+                chat=chat).count() for alias in SHARDS), 3)
+        response = self.api(self.manager).get('/messages/search/?q=Hello')
+        self.assertEqual(len(response.data['results']), 18)
+
+        output = io.StringIO()
+        call_command('rebalance_message_shards', stdout=output)
+        self.assertNotIn('moved 1', output.getvalue())
+        self.assertEqual(output.getvalue().count('moved 0'), 3)
+
+
+class ConditionalListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager',
+                                                password='password')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client',
+                                                    password='password')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.message = Message.objects.create(chat=self.chat,
+                                              sender=self.client_user,
+                                              text='Hello')
+        self.messages_url = f'/chats/{self.chat.id}/messages/'
+        self.client.force_authenticate(user=self.manager)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_chat_list_is_not_modified(self):
+        etag = self.client.get('/chats/')['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.revalidate('/chats/', etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_chat_list_changes_with_messages_and_query(self):
+        etag = self.client.get('/chats/')['ETag']
+        self.assertNotEqual(self.client.get('/chats/?page_size=1')['ETag'],
+                            etag)
+
+        Message.objects.create(chat=self.chat, sender=self.client_user,
+                               text='Again')
+        response = self.revalidate('/chats/', etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['unread_count'], 2)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_unchanged_history_is_not_modified(self):
+        self.client.get(self.messages_url)
+        etag = self.client.get(self.messages_url)['ETag']
+
+        # chat + version
+        with self.assertNumQueries(2):
+            response = self.revalidate(self.messages_url, etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_history_changes_with_reads_edits_and_deletes(self):
+        self.client.get(self.messages_url)
+        etag = self.client.get(self.messages_url)['ETag']
+
+        other = APIClient()
+        other.force_authenticate(user=self.client_user)
+        other.post(f'{self.messages_url}read/')
+        response = self.revalidate(self.messages_url, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = response['ETag']
+        other.patch(f'{self.messages_url}{self.message.id}/',
+                    {'text': 'Edited'})
+        response = self.revalidate(self.messages_url, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['text'], 'Edited')
+
+        etag = response['ETag']
+        self.client.delete(f'{self.messages_url}{self.message.id}/')
+        response = self.revalidate(self.messages_url, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+    def test_etag_is_per_user(self):
+        etag = self.client.get(self.messages_url)['ETag']
+
+        other = APIClient()
+        other.force_authenticate(user=self.client_user)
+        response = other.get(self.messages_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ChatActivityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.chats = []
+        for index in range(3):
+            client_user = User.objects.create_user(username=f'client{index}')
+            Profile.objects.create(user=client_user, role='client')
+            self.chats.append(Chat.objects.create(manager=self.manager,
+                                                  client=client_user))
+        self.client.force_authenticate(user=self.manager)
+
+    def send(self, chat, text):
+        response = self.client.post(f'/chats/{chat.id}/messages/',
+                                    {'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data
+
+    def test_new_message_becomes_last_message(self):
+        message = self.send(self.chats[0], 'x' * 300)
+
+        response = self.client.get(f'/chats/{self.chats[0].id}/')
+        self.assertEqual(response.data['last_message'], {
+            'id': message['id'], 'sender': self.manager.id,
+            'text': 'x' * 200,
+        })
+        self.assertEqual(response.data['last_activity_at'],
+                         message['timestamp'])
+
+    def test_inbox_is_sorted_by_activity(self):
+        self.send(self.chats[1], 'first')
+        self.send(self.chats[0], 'second')
+
+        response = self.client.get('/chats/?ordering=-last_activity_at')
+        self.assertEqual([chat['id'] for chat in response.data['results']],
+                         [self.chats[0].id, self.chats[1].id,
+                          self.chats[2].id])
+        response = self.client.get('/chats/')
+        self.assertEqual([chat['id'] for chat in response.data['results']],
+                         [chat.id for chat in self.chats])
+
+    def test_bulk_messages_update_last_message(self):
+        response = self.client.post('/messages/bulk/', {'messages': [
+            {'chat': self.chats[2].id, 'text': 'one'},
+            {'chat': self.chats[2].id, 'text': 'two'},
+        ]}, format='json')
+
+        self.chats[2].refresh_from_db()
+        self.assertEqual(self.chats[2].last_message['id'],
+                         response.data['results'][1]['id'])
+
+    def test_deleting_last_message_restores_previous_one(self):
+        first = self.send(self.chats[0], 'first')
+        second = self.send(self.chats[0], 'second')
+        url = f'/chats/{self.chats[0].id}/messages/'
+
+        self.client.patch(f"{url}{second['id']}/", {'text': 'edited'})
+        self.chats[0].refresh_from_db()
+        self.assertEqual(self.chats[0].last_message['text'], 'edited')
+
+        self.client.delete(f"{url}{second['id']}/")
+        self.chats[0].refresh_from_db()
+        self.assertEqual(self.chats[0].last_message['id'], first['id'])
+
+        self.client.delete(f"{url}{first['id']}/")
+        self.chats[0].refresh_from_db()
+        self.assertIsNone(self.chats[0].last_message)
+        self.assertEqual(self.chats[0].last_activity_at,
+                         self.chats[0].created_at)
+
+    def test_activity_ordering_uses_index(self):
+        queryset = Chat.objects.for_participant(self.manager).order_by(
+            '-last_activity_at', '-id')
+        plan = queryset.explain()
+        self.assertIn('chat_manager_activity_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class MessageFastPathTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        for text in ('Привет', 'line\u2028separator\u2029', '"quoted" \\',
+                     'emoji 🎉', '<script>&</script>'):
+            Message.objects.create(chat=self.chat, sender=self.client_user,
+                                   text=text)
+        self.client.force_authenticate(user=self.manager)
+
+    def legacy_render(self, messages, read_cursors):
+        return JSONRenderer().render(MessageSerializer(
+            messages, many=True, context={'read_cursors': read_cursors}).data)
+
+    def test_rows_render_like_serializer(self):
+        messages = list(Message.objects.for_chat(self.chat).order_by('id'))
+        rows = list(Message.objects.for_chat(self.chat).order_by('id')
+                    .values(*MESSAGE_ROW_FIELDS))
+        read_cursors = {self.chat.pk: {self.manager.pk: messages[2].pk}}
+        expected = self.legacy_render(messages, read_cursors)
+        data = serialize_message_rows(rows, read_cursors)
+        self.assertEqual(JSONRenderer().render(data), expected)
+        self.assertEqual(FastJSONRenderer().render(data), expected)
+        self.assertIn(b'\\u2028', expected)
+
+    def test_renderer_falls_back_without_orjson(self):
+        data = {'text': 'emoji 🎉\u2028', 'timestamp': timezone.now()}
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data),
+                             JSONRenderer().render(data))
+
+    def test_history_response_matches_serializer(self):
+        response = self.client.get(f'/chats/{self.chat.pk}/messages/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        messages = list(Message.objects.for_chat(self.chat).order_by('id'))
+        # The page is rendered as already read by the manager.
+        expected = self.legacy_render(
+            messages, {self.chat.pk: {self.manager.pk: messages[-1].pk}})
+        results = response.content.split(b'"results":', 1)[1][:-1]
+        self.assertEqual(results, expected)
+
+
+@override_settings(CHAT_BACKGROUND_ASYNC=True,
+                   CHAT_READ_RECEIPT_INTERVAL=0.01)
+class ReadReceiptWriterTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.client_user,
+                                   text=f'Message {index}')
+            for index in range(3)
+        ]
+        self.writer = ReadReceiptWriter()
+        self.addCleanup(self.writer.stop)
+
+    def cursor(self):
+        return ChatReadState.objects.filter(
+            chat=self.chat, user=self.manager).values_list(
+            'last_read_message_id', flat=True).first()
+
+    def test_reads_are_coalesced(self):
+        advanced = []
+
+        def record(sender, last_read_message_id, **kwargs):
+            advanced.append(last_read_message_id)
+
+        read_cursor_advanced.connect(record)
+        self.addCleanup(read_cursor_advanced.disconnect, record)
+        with self.writer.condition:
+            # Held so that the worker cannot pick up the first move alone.
+            for message in (self.messages[1], self.messages[2],
+                            self.messages[0]):
+                self.writer.submit(self.chat, self.manager, message.pk)
+        self.writer.flush()
+        self.assertEqual(advanced, [self.messages[2].pk])
+        self.assertEqual(self.cursor(), self.messages[2].pk)
+
+    def test_worker_applies_moves_in_background(self):
+        self.writer.submit(self.chat, self.manager, self.messages[1].pk)
+        with self.writer.condition:
+            # The test database cannot be read while the worker writes.
+            self.assertTrue(self.writer.condition.wait_for(
+                lambda: not self.writer.pending and not self.writer.in_flight,
+                timeout=5))
+        self.assertIsNotNone(self.writer.thread)
+        self.assertEqual(self.cursor(), self.messages[1].pk)
+
+    def test_stop_flushes_pending_moves(self):
+        self.writer.submit(self.chat, self.manager, self.messages[2].pk)
+        self.writer.stop()
+        self.assertIsNone(self.writer.thread)
+        self.assertEqual(self.cursor(), self.messages[2].pk)
+
+    def test_history_reports_post_read_state(self):
+        client = APIClient()
+        client.force_authenticate(user=self.manager)
+        with mock.patch('chat.views.receipt_writer', self.writer):
+            with self.writer.condition:
+                response = client.get(f'/chats/{self.chat.pk}/messages/')
+                # Not written yet, but the page is reported as read.
+                self.assertIsNone(self.cursor())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(all(message['is_read']
+                            for message in response.data['results']))
+        self.writer.flush()
+        self.assertEqual(self.cursor(), self.messages[2].pk)
+
+    def test_failing_move_does_not_lose_its_chunk(self):
+        other_client = User.objects.create_user(username='other')
+        Profile.objects.create(user=other_client, role='client')
+        deleted = Chat.objects.create(manager=self.manager,
+                                      client=other_client)
+        Chat.objects.filter(pk=deleted.pk).delete()
+
+        with self.assertLogs('chat.receipts', 'ERROR') as logs:
+            self.writer.apply({
+                (deleted.pk, self.manager.pk): (deleted, self.manager,
+                                                self.messages[0].pk),
+                (self.chat.pk, self.manager.pk): (self.chat, self.manager,
+                                                  self.messages[1].pk),
+            })
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(self.cursor(), self.messages[1].pk)
+        self.assertFalse(ChatReadState.objects.filter(
+            chat_id=deleted.pk).exists())
+
+
+class ChatExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.chats = []
+        self.messages = {}
+        for index in range(2):
+            client_user = User.objects.create_user(username=f'client{index}')
+            Profile.objects.create(user=client_user, role='client')
+            chat = Chat.objects.create(manager=self.manager,
+                                       client=client_user)
+            self.chats.append(chat)
+            self.messages[chat.pk] = [
+                Message.objects.create(chat=chat, sender=client_user,
+                                       text=f'Сообщение {number}, "ok"\n')
+                for number in range(3)
+            ]
+        self.client.force_authenticate(user=self.manager)
+
+    def read_ndjson(self, response):
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_export_chat_as_ndjson(self):
+        chat = self.chats[0]
+        response = self.client.get(f'/chats/{chat.pk}/export/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'],
+                         'application/x-ndjson; charset=utf-8')
+        self.assertIn(f'chat-{chat.pk}.ndjson',
+                      response['Content-Disposition'])
+        records = self.read_ndjson(response)
+        self.assertEqual([record['id'] for record in records],
+                         [message.pk for message in self.messages[chat.pk]])
+        self.assertEqual(records[0]['text'], 'Сообщение 0, "ok"\n')
+
+    def test_export_chat_as_csv(self):
+        chat = self.chats[1]
+        response = self.client.get(f'/chats/{chat.pk}/export/',
+                                   {'export_format': 'csv'})
+        content = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], ['chat', 'id', 'sender', 'timestamp',
+                                   'text'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][4], 'Сообщение 0, "ok"\n')
+
+    def test_export_all_chats_resumes_after_cursor(self):
+        first, second = self.chats
+        cursor = f'{first.pk}:{self.messages[first.pk][1].pk}'
+        response = self.client.get('/chats/export/', {'after': cursor})
+        records = self.read_ndjson(response)
+        self.assertEqual(
+            [(record['chat'], record['id']) for record in records],
+            [(first.pk, self.messages[first.pk][2].pk)]
+            + [(second.pk, message.pk)
+               for message in self.messages[second.pk]])
+
+        response = self.client.get('/chats/export/', {'after': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_access(self):
+        outsider = User.objects.create_user(username='outsider')
+        Profile.objects.create(user=outsider, role='client')
+        self.client.force_authenticate(user=outsider)
+        response = self.client.get(f'/chats/{self.chats[0].pk}/export/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/chats/export/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_command_resumes_into_file(self):
+        first, second = self.chats
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+            call_command('export_chat_history', manager='manager',
+                         format='csv', output=path)
+            with open(path, encoding='utf-8', newline='') as export:
+                complete = export.read()
+            # An export interrupted after the first chat and resumed.
+            call_command('export_chat_history', chat=[first.pk],
+                         format='csv', output=path)
+            last = self.messages[first.pk][-1]
+            call_command('export_chat_history', manager='manager',
+                         format='csv', output=path,
+                         after=f'{first.pk}:{last.pk}')
+            with open(path, encoding='utf-8', newline='') as export:
+                self.assertEqual(export.read(), complete)
+        self.assertEqual(len(list(csv.reader(io.StringIO(complete)))), 7)
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.clients = []
+        for index in range(4):
+            client_user = User.objects.create_user(username=f'client{index}')
+            Profile.objects.create(user=client_user, role='client')
+            self.clients.append(client_user)
+        self.chats = [Chat.objects.create(manager=self.manager, client=client)
+                      for client in self.clients[:2]]
+        self.client.force_authenticate(user=self.manager)
+
+    def broadcast(self, **data):
+        return self.client.post('/chats/broadcast/',
+                                dict({'text': 'Новости'}, **data),
+                                format='json')
+
+    def test_broadcast_to_listed_clients(self):
+        response = self.broadcast(clients=[self.clients[0].pk,
+                                           self.clients[2].pk])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['chat'] for item in response.data['messages']],
+                         [self.chats[0].pk])
+        self.assertEqual(response.data['missing_clients'],
+                         [self.clients[2].pk])
+        self.assertEqual(response.data['created_chats'], [])
+        message = Message.objects.for_chat(self.chats[0]).get()
+        self.assertEqual((message.sender, message.text),
+                         (self.manager, 'Новости'))
+        self.assertFalse(Message.objects.for_chat(self.chats[1]).exists())
+        self.chats[0].refresh_from_db()
+        self.assertEqual(self.chats[0].last_message['id'], message.pk)
+
+    def test_broadcast_to_all_clients(self):
+        unread.get_total_unread(self.clients[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.broadcast(all_clients=True)
+        self.assertEqual(len(response.data['messages']), 2)
+        self.assertEqual(unread.get_total_unread(self.clients[1]), 1)
+
+    def test_missing_chats_are_created(self):
+        response = self.broadcast(
+            clients=[client.pk for client in self.clients] + [self.manager.pk],
+            create_missing=True)
+        self.assertEqual(len(response.data['messages']), 4)
+        created = Chat.objects.filter(client__in=self.clients[2:])
+        self.assertEqual(sorted(response.data['created_chats']),
+                         sorted(chat.pk for chat in created))
+        self.assertEqual(response.data['missing_clients'], [self.manager.pk])
+        self.client.force_authenticate(user=self.clients[3])
+        chats = self.client.get('/chats/').data['results']
+        self.assertEqual(chats[0]['last_message']['text'], 'Новости')
+        self.assertEqual(chats[0]['unread_count'], 1)
+
+    def test_query_count_does_not_depend_on_recipients(self):
+        def count(clients):
+            # The pushes after the commit are counted as well.
+            with CaptureQueriesContext(connection) as queries, \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.broadcast(clients=[client.pk for client in clients],
+                               create_missing=True)
+            return len(queries)
+
+        for client in self.clients[::2]:
+            unread.get_total_unread(client)
+
+        self.assertEqual(count(self.clients[:1] + self.clients[2:3]),
+                         count(self.clients[1:2] + self.clients[3:]))
+        self.assertEqual(count(self.clients[:1]), count(self.clients))
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.broadcast().status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.broadcast(clients=[self.clients[0].pk],
+                           all_clients=True).status_code,
+            status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=self.clients[0])
+        self.assertEqual(self.broadcast(all_clients=True).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(CHAT_MESSAGE_RETENTION_DAYS=30, CHAT_RETENTION_PAUSE=0)
+class RetentionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.chats = []
+        for index in range(2):
+            client_user = User.objects.create_user(username=f'client{index}')
+            Profile.objects.create(user=client_user, role='client')
+            self.chats.append(Chat.objects.create(manager=self.manager,
+                                                  client=client_user))
+        now = timezone.now()
+        self.old = {}
+        for chat in self.chats:
+            messages = [Message.objects.create(chat=chat, sender=chat.client,
+                                               text=f'Message {age}')
+                        for age in (60, 45, 10, 0)]
+            for message, age in zip(messages, (60, 45, 10, 0)):
+                Message.objects.filter(pk=message.pk).update(
+                    timestamp=now - timedelta(days=age))
+            self.old[chat.pk] = messages
+        self.client.force_authenticate(user=self.manager)
+
+    def purge(self, **options):
+        return retention.purge_expired(retention.TableArchive(), **options)
+
+    def remaining(self, chat):
+        return list(Message.objects.for_chat(chat).order_by('id')
+                    .values_list('text', flat=True))
+
+    def test_expired_messages_are_moved_to_archive_table(self):
+        self.chats[1].retention_days = 7
+        self.chats[1].save()
+        unread.get_total_unread(self.manager)
+        purged = self.purge(batch_size=1)
+        self.assertEqual(purged, 5)
+        self.assertEqual(self.remaining(self.chats[0]),
+                         ['Message 10', 'Message 0'])
+        self.assertEqual(self.remaining(self.chats[1]), ['Message 0'])
+        archived = ArchivedMessage.objects.filter(chat=self.chats[0])
+        self.assertEqual(
+            sorted(archived.values_list('message_id', flat=True)),
+            [message.pk for message in self.old[self.chats[0].pk][:2]])
+        self.assertEqual(unread.get_total_unread(self.manager), 3)
+
+    def test_purge_is_resumable(self):
+        # An interrupted run archived the batch but did not delete it.
+        retention.TableArchive().store(
+            Message.objects.for_chat(self.chats[0]).order_by('id')[:1])
+        self.assertEqual(self.purge(), 4)
+        self.assertEqual(ArchivedMessage.objects.count(), 4)
+
+    def test_file_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.ndjson.gz')
+            call_command('purge_expired_messages', archive_file=path,
+                         stdout=io.StringIO())
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                records = [json.loads(line) for line in archive]
+        self.assertEqual(sorted(record['text'] for record in records),
+                         ['Message 45', 'Message 45', 'Message 60',
+                          'Message 60'])
+        self.assertFalse(ArchivedMessage.objects.exists())
+        self.assertEqual(self.remaining(self.chats[0]),
+                         ['Message 10', 'Message 0'])
+
+    def test_archive_endpoint(self):
+        self.purge()
+        chat = self.chats[0]
+        url = f'/chats/{chat.pk}/messages/archive/'
+        response = self.client.get(url, {'limit': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['text'], 'Message 60')
+        self.assertEqual(response.data['results'][0]['id'],
+                         self.old[chat.pk][0].pk)
+        response = self.client.get(response.data['next'])
+        self.assertEqual([item['text'] for item in response.data['results']],
+                         ['Message 45'])
+        self.assertIsNone(response.data['next'])
+
+        self.client.force_authenticate(user=self.chats[1].client)
+        self.assertEqual(self.client.get(url).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+    def test_purge_cleans_up_after_the_messages(self):
+        first, second = self.chats
+        blob = AttachmentBlob.objects.create(sha256='0' * 64, size=1)
+        old, kept = self.old[first.pk][0], self.old[first.pk][-1]
+        for message in (old, kept):
+            Attachment.objects.create(chat=first, message_id=message.pk,
+                                      uploader=first.client, blob=blob,
+                                      filename='a.txt',
+                                      content_type='text/plain')
+        # Only expired messages are left in the second chat.
+        Message.objects.filter(pk=self.old[second.pk][-1].pk).delete()
+        Chat.objects.refresh_last_message(second)
+        second.retention_days = 7
+        second.save()
+        cursor = self.client.get('/sync/').data['cursor']
+
+        self.purge()
+
+        self.assertEqual(list(Attachment.objects.values_list(
+            'message_id', flat=True)), [kept.pk])
+        second.refresh_from_db()
+        self.assertIsNone(second.last_message)
+        first.refresh_from_db()
+        self.assertEqual(first.last_message['id'], kept.pk)
+        self.assertEqual(ChatStats.objects.get(chat=second).unread_count, 0)
+        data = self.client.get('/sync/', {'since': cursor}).data
+        self.assertEqual(sorted(chat['id'] for chat in data['chats']),
+                         [first.pk, second.pk])
+        self.assertEqual(data['messages'], [])
+        self.client.force_authenticate(user=second.client)
+        data = self.client.get('/sync/', {'since': cursor}).data
+        self.assertEqual([chat['id'] for chat in data['chats']],
+                         [second.pk])
+
+    @override_settings(CHAT_SYNC_EVENT_RETENTION_DAYS=30)
+    def test_old_sync_events_are_pruned(self):
+        events = list(SyncEvent.objects.order_by('id'))
+        now = timezone.now()
+        # The newest events are old as well: the latest one is still kept.
+        SyncEvent.objects.filter(pk__in=[event.pk for event in events[:3]]
+                                 + [events[-1].pk]).update(
+            created_at=now - timedelta(days=40))
+        old_cursor = events[0].pk
+        self.assertEqual(retention.prune_sync_events(batch_size=2), 3)
+        self.assertEqual(list(SyncEvent.objects.order_by('id')),
+                         events[3:])
+        self.assertEqual(retention.prune_sync_events(), 0)
+
+        response = self.client.get('/sync/', {'since': old_cursor})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertEqual(response.data['detail'].code, 'cursor_expired')
+        response = self.client.get('/sync/', {'since': events[2].pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        SyncEvent.objects.update(created_at=now - timedelta(days=40))
+        retention.prune_sync_events()
+        self.assertEqual(list(SyncEvent.objects.all()), events[-1:])
+
+
+class QueryPlanTests(TestCase):
+    """
+    The hot read queries must be answered from indexes: a ``SCAN`` of a
+    table in SQLite's query plan means a full table scan.
+    """
+
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+
+    def assertIndexed(self, queryset, index=None):
+        plan = queryset.explain()
+        scans = [line for line in plan.splitlines()
+                 if re.search(r'\bSCAN\b', line)]
+        self.assertEqual(scans, [], plan)
+        if index is not None:
+            self.assertIn(index, plan)
+
+    def test_unread_counts(self):
+        for user in (self.manager, self.client_user):
+            with self.subTest(user=user.username):
+                self.assertIndexed(
+                    Chat.objects.for_participant(user).order_by('id')[:50],
+                    'COVERING INDEX chat_message_unread_idx')
+
+    def test_total_unread_count(self):
+        queryset = Chat.objects.for_participant(self.client_user)
+        with CaptureQueriesContext(connection) as queries:
+            queryset.aggregate(total=Sum('unread_count'))
+        plan = connection.cursor().execute(
+            'EXPLAIN QUERY PLAN ' + queries[0]['sql']).fetchall()
+        plan = '\n'.join(str(row[-1]) for row in plan)
+        self.assertNotRegex(plan, r'\bSCAN\b')
+        self.assertIn('chat_message_unread_idx', plan)
+
+    def test_sharded_unread_counts(self):
+        condition = (Q(chat_id=self.chat.pk, sender_id=self.client_user.pk,
+                       id__gt=10)
+                     | Q(chat_id=self.chat.pk + 1, sender_id=self.manager.pk,
+                         id__gt=0))
+        self.assertIndexed(
+            Message.objects.filter(condition).values('chat_id').annotate(
+                count=Count('id')).values_list('chat_id', 'count'),
+            'COVERING INDEX chat_message_unread_idx')
+
+    def test_history_page(self):
+        self.assertIndexed(
+            Message.objects.for_chat(self.chat).order_by(
+                '-timestamp', '-id')[:51], 'chat_message_history_idx')
+        self.assertIndexed(
+            Message.objects.for_chat(self.chat).values('id').order_by(
+                '-id')[:1])
+
+    def test_read_state_and_sync(self):
+        self.assertIndexed(ChatReadState.objects.filter(
+            chat_id__in=[self.chat.pk]).values_list(
+            'chat_id', 'user_id', 'last_read_message_id'))
+        self.assertIndexed(SyncEvent.objects.filter(
+            user=self.manager, chat_id=self.chat.pk).order_by('-id')[:1],
+            'chat_sync_user_chat_idx')
+
+
+class AttachmentTests(TestCase):
+    # Header of a 3x2 PNG, enough for the metadata extraction.
+    PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x03'
+           b'\x00\x00\x00\x02\x08\x02\x00\x00\x00' + bytes(range(64)))
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        settings_override = override_settings(CHAT_ATTACHMENT_ROOT=self.root,
+                                              CHAT_ATTACHMENT_CHUNK_SIZE=16)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chat = Chat.objects.create(manager=self.manager,
+                                        client=self.client_user)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.client_user,
+                                   text=f'Invoice {index}')
+            for index in range(2)
+        ]
+        self.client.force_authenticate(user=self.client_user)
+
+    def url(self, message, suffix=''):
+        return (f'/chats/{self.chat.pk}/messages/{message.pk}/'
+                f'attachments/{suffix}')
+
+    def upload(self, message, content, filename='photo.png',
+               content_type='image/png'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                f'{self.url(message)}?filename={filename}', content,
+                content_type=content_type)
+
+    def stored_files(self):
+        return [name for _, _, names in os.walk(self.root) for name in names]
+
+    def test_upload_is_stored_by_content_and_processed(self):
+        response = self.upload(self.messages[0], self.PNG)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        sha256 = hashlib.sha256(self.PNG).hexdigest()
+        self.assertEqual(response.data['sha256'], sha256)
+        self.assertEqual(response.data['size'], len(self.PNG))
+        with open(attachments.blob_path(sha256), 'rb') as stored:
+            self.assertEqual(stored.read(), self.PNG)
+
+        listed = self.client.get(self.url(self.messages[0])).data
+        self.assertEqual(listed[0]['filename'], 'photo.png')
+        self.assertEqual(listed[0]['metadata'], {
+            'content_type': 'image/png', 'width': 3, 'height': 2})
+
+    def test_identical_uploads_share_storage(self):
+        first = self.upload(self.messages[0], self.PNG).data
+        second = self.upload(self.messages[1], self.PNG,
+                             filename='copy.png').data
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(first['sha256'], second['sha256'])
+        self.assertEqual(self.stored_files(), [first['sha256']])
+
+    def test_upload_is_read_in_chunks(self):
+        stream = io.BytesIO(b'x' * 100)
+        reads = []
+        original_read = stream.read
+
+        def read(size=-1):
+            reads.append(size)
+            return original_read(size)
+
+        stream.read = read
+        blob = attachments.store_upload(stream)
+        self.assertEqual(blob.size, 100)
+        self.assertEqual(set(reads), {16})
+
+    @override_settings(CHAT_ATTACHMENT_MAX_SIZE=50)
+    def test_too_large_upload(self):
+        response = self.upload(self.messages[0], self.PNG)
+        self.assertEqual(response.status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        stream = io.BytesIO(self.PNG)
+        with self.assertRaises(attachments.AttachmentTooLarge):
+            attachments.store_upload(stream)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_upload_needs_a_valid_length(self):
+        url = f'{self.url(self.messages[0])}?filename=empty.txt'
+        for length, expected in (
+                ('', status.HTTP_411_LENGTH_REQUIRED),
+                ('0', status.HTTP_400_BAD_REQUEST),
+                ('ten', status.HTTP_400_BAD_REQUEST),
+                ('-1', status.HTTP_400_BAD_REQUEST)):
+            with self.subTest(length=length):
+                response = self.client.post(
+                    url, b'', content_type='text/plain',
+                    CONTENT_LENGTH=length)
+                self.assertEqual(response.status_code, expected)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def test_only_the_author_attaches(self):
+        self.client.force_authenticate(user=self.manager)
+        response = self.upload(self.messages[0], self.PNG)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(
+            f'/chats/{self.chat.pk}/messages/999/attachments/?filename=a',
+            b'data', content_type='text/plain')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_download_with_ranges(self):
+        attachment = self.upload(self.messages[0], self.PNG).data
+        url = self.url(self.messages[0], f"{attachment['id']}/download/")
+        self.client.force_authenticate(user=self.manager)
+
+        response = self.client.get(url, HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.PNG)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('photo.png', response['Content-Disposition'])
+
+        size = len(self.PNG)
+        for header, start, end in (('bytes=2-40', 2, 40),
+                                   ('bytes=-3', size - 3, size - 1),
+                                   ('bytes=80-', 80, size - 1)):
+            with self.subTest(range=header):
+                response = self.client.get(url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_206_PARTIAL_CONTENT)
+                self.assertEqual(b''.join(response.streaming_content),
+                                 self.PNG[start:end + 1])
+                self.assertEqual(response['Content-Range'],
+                                 f'bytes {start}-{end}/{size}')
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code,
+                         status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_download_requires_participation(self):
+        attachment = self.upload(self.messages[0], self.PNG).data
+        outsider = User.objects.create_user(username='outsider')
+        Profile.objects.create(user=outsider, role='client')
+        self.client.force_authenticate(user=outsider)
+        response = self.client.get(
+            self.url(self.messages[0], f"{attachment['id']}/download/"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(CHAT_MESSAGE_THROTTLES={
+    'client': {'user': {'rate': '6/min', 'burst': 3},
+               'chat': {'rate': '6/min', 'burst': 2}},
+})
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.client_user = User.objects.create_user(username='client')
+        Profile.objects.create(user=self.client_user, role='client')
+        self.chats = [Chat.objects.create(manager=self.manager,
+                                          client=self.client_user)]
+        for index in range(2):
+            manager = User.objects.create_user(username=f'manager{index}')
+            Profile.objects.create(user=manager, role='manager')
+            self.chats.append(Chat.objects.create(manager=manager,
+                                                  client=self.client_user))
+        self.now = 1_000_000.0
+        patcher = mock.patch.object(throttling.time, 'time',
+                                    lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, chat, user=None):
+        self.client.force_authenticate(user=user or self.client_user)
+        return self.client.post(f'/chats/{chat.pk}/messages/',
+                                {'text': 'Hi'})
+
+    def test_burst_then_retry_after(self):
+        for _ in range(2):
+            self.assertEqual(self.send(self.chats[0]).status_code,
+                             status.HTTP_201_CREATED)
+        response = self.send(self.chats[0])
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertEqual(Message.objects.count(), 2)
+
+        self.now += 10
+        self.assertEqual(self.send(self.chats[0]).status_code,
+                         status.HTTP_201_CREATED)
+
+    def test_user_limit_spans_chats(self):
+        for chat in self.chats:
+            self.assertEqual(self.send(chat).status_code,
+                             status.HTTP_201_CREATED)
+        response = self.send(self.chats[1])
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '10')
+
+    def test_rejected_requests_take_no_token(self):
+        self.send(self.chats[0])
+        self.send(self.chats[0])
+        for _ in range(5):
+            self.assertEqual(self.send(self.chats[0]).status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+        self.now += 10
+        self.assertEqual(self.send(self.chats[0]).status_code,
+                         status.HTTP_201_CREATED)
+
+    def test_buckets_are_charged_all_or_nothing(self):
+        # The chat bucket of chats[0] runs out while the user bucket has
+        # tokens left; rejected attempts must not drain the latter.
+        self.send(self.chats[0])
+        self.send(self.chats[0])
+        for _ in range(3):
+            self.assertEqual(self.send(self.chats[0]).status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.send(self.chats[1]).status_code,
+                         status.HTTP_201_CREATED)
+
+    def test_zero_padded_ids_share_the_chat_bucket(self):
+        self.client.force_authenticate(user=self.client_user)
+        chat = self.chats[0]
+        for prefix in ('', '0'):
+            response = self.client.post(
+                f'/chats/{prefix}{chat.pk}/messages/', {'text': 'Hi'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(f'/chats/00{chat.pk}/messages/',
+                                    {'text': 'Hi'})
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_bulk_takes_a_token_per_message(self):
+        self.client.force_authenticate(user=self.client_user)
+
+        def bulk(chats):
+            return self.client.post('/messages/bulk/', {'messages': [
+                {'chat': chat.pk, 'text': 'Hi'} for chat in chats
+            ]}, format='json')
+
+        self.assertEqual(bulk(self.chats).status_code, status.HTTP_200_OK)
+        response = bulk(self.chats[:1])
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertEqual(Message.objects.count(), 3)
+        # A batch larger than a bucket is taken from a full one only.
+        self.now += 30
+        self.assertEqual(bulk(self.chats[:1] * 3).status_code,
+                         status.HTTP_200_OK)
+        self.assertEqual(self.send(self.chats[0]).status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_broadcast_takes_a_token_per_recipient(self):
+        self.client.force_authenticate(user=self.manager)
+
+        def broadcast(**data):
+            return self.client.post('/chats/broadcast/',
+                                    dict({'text': 'News'}, **data),
+                                    format='json')
+
+        with self.settings(CHAT_MESSAGE_THROTTLES={
+                'manager': {'user': {'rate': '6/min', 'burst': 3}}}):
+            # Clients without a chat are charged as well.
+            response = broadcast(clients=[self.client_user.pk, 10**6,
+                                          10**6 + 1])
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(broadcast(all_clients=True).status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+            self.now += 10
+            self.assertEqual(broadcast(all_clients=True).status_code,
+                             status.HTTP_201_CREATED)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_attachment_upload_takes_a_token(self):
+        self.send(self.chats[0])
+        message = Message.objects.get()
+        self.send(self.chats[0])
+        response = self.client.post(
+            f'/chats/{self.chats[0].pk}/messages/{message.pk}/attachments/'
+            '?filename=a.txt', b'data', content_type='text/plain')
+        self.assertEqual(response.status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_full_bucket_does_not_bank_tokens(self):
+        self.send(self.chats[0])
+        self.now += 3600
+        for expected in (status.HTTP_201_CREATED, status.HTTP_201_CREATED,
+                         status.HTTP_429_TOO_MANY_REQUESTS):
+            self.assertEqual(self.send(self.chats[0]).status_code, expected)
+
+    def test_role_without_limits_and_other_actions(self):
+        for _ in range(10):
+            self.assertEqual(self.send(self.chats[0], self.manager)
+                             .status_code, status.HTTP_201_CREATED)
+        for _ in range(3):
+            self.send(self.chats[0])
+        response = self.client.get(f'/chats/{self.chats[0].pk}/messages/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ManagerDashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.manager = User.objects.create_user(username='manager')
+        Profile.objects.create(user=self.manager, role='manager')
+        self.other_manager = User.objects.create_user(username='other')
+        Profile.objects.create(user=self.other_manager, role='manager')
+        self.clients = []
+        self.chats = []
+        for index in range(2):
+            client = User.objects.create_user(username=f'client{index}')
+            Profile.objects.create(user=client, role='client')
+            self.clients.append(client)
+            self.chats.append(Chat.objects.create(manager=self.manager,
+                                                  client=client))
+        self.start = timezone.now()
+
+    def send(self, chat, sender, minutes):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=self.start + timedelta(minutes=minutes)):
+            return Message.objects.create(chat=chat, sender=sender,
+                                          text='Hi')
+
+    def conversation(self):
+        first = self.chats[0]
+        self.send(first, self.clients[0], 0)
+        self.send(first, self.clients[0], 1)
+        self.send(first, self.manager, 3)
+        self.send(first, self.clients[0], 10)
+        self.send(first, self.manager, 20)
+        second = self.chats[1]
+        for minutes in (5, 6, 7):
+            self.send(second, self.clients[1], minutes)
+
+    def test_messages_update_stats_incrementally(self):
+        self.conversation()
+
+        first, second = (ChatStats.objects.get(chat=chat)
+                         for chat in self.chats)
+        self.assertEqual((first.unread_count, first.awaiting_since),
+                         (3, None))
+        self.assertEqual(second.unread_count, 3)
+        self.assertEqual(second.awaiting_since,
+                         self.start + timedelta(minutes=5))
+        stats = ManagerStats.objects.get(manager=self.manager)
+        self.assertEqual(stats.response_count, 2)
+        self.assertAlmostEqual(stats.response_seconds, 780)
+        # 180s and 600s: the median is where the 120-300s bucket ends.
+        self.assertEqual(dashboard.median_response_time(
+            stats.response_histogram), 300)
+
+    def test_reads_update_the_backlog(self):
+        self.conversation()
+        first = list(Message.objects.for_chat(self.chats[0]).order_by('id'))
+
+        ChatReadState.objects.advance(self.chats[0], self.manager,
+                                      first[0].pk)
+        self.assertEqual(ChatStats.objects.get(
+            chat=self.chats[0]).unread_count, 2)
+        # The client reading does not change the manager's backlog.
+        ChatReadState.objects.advance(self.chats[1], self.clients[1],
+                                      first[-1].pk)
+        self.assertEqual(ChatStats.objects.get(
+            chat=self.chats[1]).unread_count, 3)
+
+        self.client.force_authenticate(self.manager)
+        self.client.post(f'/chats/{self.chats[0].pk}/messages/read/')
+        self.assertEqual(ChatStats.objects.get(
+            chat=self.chats[0]).unread_count, 0)
+
+    def test_deleting_a_message_refreshes_the_chat(self):
+        self.conversation()
+        last = Message.objects.for_chat(self.chats[1]).order_by('id').first()
+        self.client.force_authenticate(self.clients[1])
+        response = self.client.delete(
+            f'/chats/{self.chats[1].pk}/messages/{last.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        stats = ChatStats.objects.get(chat=self.chats[1])
+        self.assertEqual(stats.unread_count, 2)
+        self.assertEqual(stats.awaiting_since,
+                         self.start + timedelta(minutes=6))
+        self.assertEqual(dashboard.verify(), [])
+
+    def test_endpoint(self):
+        self.conversation()
+        self.client.force_authenticate(self.manager)
+
+        response = self.client.get('/dashboard/managers/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['manager'] for row in response.data],
+                         [self.manager.pk])
+        response = self.client.get(f'/dashboard/managers/{self.manager.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        summary = response.data
+        self.assertEqual(
+            {key: summary[key] for key in (
+                'chats', 'open_chats', 'clients_with_unread', 'unread_count',
+                'responses', 'median_first_response_seconds',
+                'mean_first_response_seconds')},
+            {'chats': 2, 'open_chats': 1, 'clients_with_unread': 2,
+             'unread_count': 6, 'responses': 2,
+             'median_first_response_seconds': 300.0,
+             'mean_first_response_seconds': 390.0})
+        self.assertEqual([row['chat'] for row in summary['clients']],
+                         [self.chats[1].pk, self.chats[0].pk])
+        self.assertIsNotNone(summary['oldest_awaiting_since'])
+
+        response = self.client.get(
+            f'/dashboard/managers/{self.other_manager.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(self.clients[0])
+        response = self.client.get('/dashboard/managers/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        lead = User.objects.create_user(username='lead', is_staff=True)
+        self.client.force_authenticate(lead)
+        response = self.client.get('/dashboard/managers/')
+        self.assertEqual([row['manager'] for row in response.data],
+                         [self.manager.pk, self.other_manager.pk])
+        self.assertEqual(response.data[1]['chats'], 0)
+        self.assertIsNone(response.data[1]['median_first_response_seconds'])
+        response = self.client.get(f'/dashboard/managers/{lead.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebuild_and_verify(self):
+        self.conversation()
+        ChatReadState.objects.advance(
+            self.chats[0], self.manager,
+            Message.objects.for_chat(self.chats[0]).order_by('id')[1].pk)
+        self.assertEqual(dashboard.verify(), [])
+        expected = {row.pk: [getattr(row, field)
+                             for field in dashboard.CHAT_STATS_FIELDS]
+                    for row in ChatStats.objects.all()}
+
+        ChatStats.objects.filter(chat=self.chats[1]).update(unread_count=0)
+        ManagerStats.objects.all().delete()
+        output = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_manager_dashboard', verify=True,
+                         stdout=output)
+        self.assertIn(f'chat {self.chats[1].pk}: unread_count is 0',
+                      output.getvalue())
+        self.assertIn(f'manager {self.manager.pk}: 0 responses',
+                      output.getvalue())
+
+        call_command('rebuild_manager_dashboard', stdout=io.StringIO())
+        self.assertEqual(dashboard.verify(), [])
+        self.assertEqual({row.pk: [getattr(row, field)
+                                   for field in dashboard.CHAT_STATS_FIELDS]
+                          for row in ChatStats.objects.all()}, expected)
+        self.assertEqual(ManagerStats.objects.get(
+            manager=self.manager).response_count, 2)
+
+    def test_median_interpolates_within_the_bucket(self):
+        stats = ManagerStats()
+        for seconds in (10, 20, 90, 100, 5000, 10 ** 7):
+            dashboard.add_response(stats, seconds)
+        # Three responses up to 120s, the third in the 60-120s bucket.
+        self.assertEqual(dashboard.median_response_time(
+            stats.response_histogram), 90)
+        self.assertIsNone(dashboard.median_response_time([]))
@@ -0,0 +1,119 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    Seconds between two tokens of a rate written like DRF's throttle rates,
+    ``'<count>/<period>'`` with a period of ``sec``, ``min``, ``hour`` or
+    ``day``.
+    """
+    count, period = rate.split('/')
+    return PERIODS[period[0]] / int(count)
+
+
+def take_tokens(key, config, now, tokens=1):
+    """
+    Take ``tokens`` from the bucket at ``key`` with ``config`` (``{'rate':
+    ..., 'burst': ...}``) at ``now`` (milliseconds). Returns None when they
+    were taken, otherwise the seconds until they are available. More
+    tokens than the burst are only taken from a full bucket, which is left
+    in debt.
+
+    The bucket is stored as the time (in milliseconds) at which it will be
+    full again and moved with atomic ``cache.incr`` calls, so concurrent
+    requests in processes sharing the cache cannot both take the last
+    token.
+    """
+    interval = round(parse_rate(config['rate']) * 1000)
+    cost = tokens * interval
+    limit = max(config['burst'] * interval, cost)
+    try:
+        full_at = cache.incr(key, cost)
+    except ValueError:
+        if cache.add(key, now + cost, math.ceil(limit / 1000)):
+            return None
+        full_at = cache.incr(key, cost)
+    if full_at - cost < now:
+        # The bucket had been full for a while: count from now.
+        full_at = cache.incr(key, now + cost - full_at)
+
+    if full_at - now > limit:
+        give_back_tokens(key, config, tokens)
+        return (full_at - now - limit) / 1000
+    # Forgotten once the bucket is full again.
+    cache.touch(key, math.ceil((full_at - now) / 1000))
+    return None
+
+
+def give_back_tokens(key, config, tokens=1):
+    try:
+        cache.decr(key, tokens * round(parse_rate(config['rate']) * 1000))
+    except ValueError:
+        # Expired in the meantime, i.e. full.
+        pass
+
+
+class MessageThrottle(BaseThrottle):
+    """
+    Token buckets kept in the cache, configured per ``Profile.role`` by
+    ``CHAT_MESSAGE_THROTTLES[role][scope]`` as ``{'rate': '30/min',
+    'burst': 10}``: a bucket holds up to ``burst`` tokens and refills at
+    ``rate``. Every message takes a token from the sender's ``user``
+    bucket, shared by all chats, and from their ``chat`` bucket for its
+    chat. Roles or scopes without an entry are not limited.
+
+    The view tells how many messages a request sends with
+    ``get_message_charges(request)``, a map ``chat_id -> count`` where
+    messages to chats not known before the request is handled are counted
+    under None (the user bucket only). The buckets are charged all or
+    nothing: a request rejected by one of them gives back the tokens it
+    has taken from the others.
+    """
+
+    def get_config(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return None
+        profile = getattr(user, 'profile', None)
+        if profile is None:
+            return None
+        return settings.CHAT_MESSAGE_THROTTLES.get(profile.role)
+
+    def get_buckets(self, request, view):
+        """``(scope, ident, tokens)`` of the buckets charged."""
+        user_id = request.user.pk
+        charges = view.get_message_charges(request)
+        buckets = [('user', user_id, sum(charges.values()))]
+        buckets.extend(('chat', f'{user_id}:{chat_id}', count)
+                       for chat_id, count in charges.items()
+                       if chat_id is not None)
+        return buckets
+
+    def allow_request(self, request, view):
+        config = self.get_config(request)
+        if not config:
+            return True
+        now = round(time.time() * 1000)
+        taken = []
+        for scope, ident, tokens in self.get_buckets(request, view):
+            if scope not in config or not tokens:
+                continue
+            key = f'chat:throttle:{scope}:{ident}'
+            wait = take_tokens(key, config[scope], now, tokens)
+            if wait is not None:
+                for key, bucket_config, tokens in taken:
+                    give_back_tokens(key, bucket_config, tokens)
+                self.wait_seconds = wait
+                return False
+            taken.append((key, config[scope], tokens))
+        return True
+
+    def wait(self):
+        return getattr(self, 'wait_seconds', None)
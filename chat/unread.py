@@ -0,0 +1,144 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Q, Sum
+
+from . import sharding
+
+# Chats per query when counting unread messages on a shard; keeps the
+# generated OR expression well below SQLite's expression depth limit.
+COUNT_CHUNK_SIZE = 200
+
+
+def cache_key(user_id):
+    return f'chat:unread_total:{user_id}'
+
+
+def invalidations_key(user_id):
+    return f'chat:unread_invalidations:{user_id}'
+
+
+def cached_total_unread(user_id):
+    return cache.get(cache_key(user_id))
+
+
+def get_total_unread(user):
+    total = cached_total_unread(user.pk)
+    if total is None:
+        total = rebuild_total_unread(user)
+    return total
+
+
+def rebuild_total_unread(user):
+    from .models import Chat
+
+    # Bumped by the increments and resets that find no counter, which the
+    # count may or may not include.
+    invalidations = cache.get(invalidations_key(user.pk))
+    # The result is cached and then kept up to date by increments, so it is
+    # read from the primary rather than a possibly lagging replica.
+    chats = Chat.objects.using(DEFAULT_DB_ALIAS).for_participant(user)
+    if sharding.is_sharded():
+        total = sum(count_unread(user, chats).values())
+    else:
+        total = chats.aggregate(total=Sum('unread_count'))['total'] or 0
+    # ``add`` does not overwrite a counter that another request has rebuilt
+    # and started incrementing in the meantime.
+    cache.add(cache_key(user.pk), total,
+              settings.CHAT_UNREAD_CACHE_TIMEOUT)
+    if cache.get(invalidations_key(user.pk)) != invalidations:
+        # Changed while counting: the cached total may be stale, and the
+        # next read rebuilds it.
+        cache.delete(cache_key(user.pk))
+    return total
+
+
+def count_unread(user, chats):
+    """
+    Map ``chat_id -> unread messages of user`` for ``chats`` from
+    ``Chat.objects.for_participant(user)``. The shards are queried
+    concurrently.
+    """
+    from .models import Message
+
+    cursors = {}
+    for chat in chats:
+        if chat.manager_id == user.pk:
+            other = chat.client_id
+        else:
+            other = chat.manager_id
+        cursors[chat.pk] = (other, chat.last_read_message_id)
+
+    def count(alias, chat_ids):
+        counts = {}
+        for start in range(0, len(chat_ids), COUNT_CHUNK_SIZE):
+            condition = Q()
+            for chat_id in chat_ids[start:start + COUNT_CHUNK_SIZE]:
+                other, last_read = cursors[chat_id]
+                condition |= Q(chat_id=chat_id, sender_id=other,
+                               id__gt=last_read)
+            counts.update(Message.objects.using(alias).filter(
+                condition).values('chat_id').annotate(
+                count=Count('id')).values_list('chat_id', 'count'))
+        return counts
+
+    counts = dict.fromkeys(cursors, 0)
+    for shard_counts in sharding.scatter(
+            count, sharding.group_by_shard(cursors)).values():
+        counts.update(shard_counts)
+    return counts
+
+
+def attach_unread_counts(user, chats):
+    """
+    Set ``unread_count`` on chats from ``for_participant`` when sharding
+    leaves it out of the query.
+    """
+    chats = [chat for chat in chats if not hasattr(chat, 'unread_count')]
+    if chats:
+        counts = count_unread(user, chats)
+        for chat in chats:
+            chat.unread_count = counts[chat.pk]
+
+
+def increment(user_id, delta=1):
+    try:
+        cache.incr(cache_key(user_id), delta)
+    except ValueError:
+        # Not cached: the next read rebuilds the counter from the database.
+        # A rebuild running now may have counted without these messages.
+        invalidate(user_id)
+
+
+def decrement(user_id, delta):
+    try:
+        if cache.decr(cache_key(user_id), delta) < 0:
+            # Out of step with the database: rebuilt on the next read.
+            cache.delete(cache_key(user_id))
+    except ValueError:
+        # As for ``increment``: a rebuild running now may predate the read.
+        invalidate(user_id)
+
+
+def reset(*user_ids):
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
+    for user_id in user_ids:
+        invalidate(user_id)
+
+
+def invalidate(user_id):
+    """Make a rebuild of ``user_id``'s counter in progress discard it."""
+    key = invalidations_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, settings.CHAT_UNREAD_CACHE_TIMEOUT):
+            cache.incr(key)
+
+
+def recipient_id(message, chat):
+    if message.sender_id == chat.client_id:
+        return chat.manager_id
+    if message.sender_id == chat.manager_id:
+        return chat.client_id
+    return None
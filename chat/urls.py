@@ -1,12 +1,24 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatViewSet, ChatMessageViewSet
+from .metrics import metrics_view
+from .views import (AttachmentViewSet, BulkMessageView, ChatMessageViewSet,
+                    ChatViewSet, ManagerDashboardViewSet, MessageSearchView,
+                    SyncView)
 
 router = DefaultRouter()
 router.register(r'chats', ChatViewSet, basename='chat')
 router.register(r'chats/(?P<chat_id>\d+)/messages', ChatMessageViewSet,
                 basename='messages')
+router.register(r'chats/(?P<chat_id>\d+)/messages/(?P<message_id>\d+)/'
+                r'attachments', AttachmentViewSet, basename='attachments')
+router.register(r'dashboard/managers', ManagerDashboardViewSet,
+                basename='dashboard')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('messages/bulk/', BulkMessageView.as_view(), name='messages-bulk'),
+    path('messages/search/', MessageSearchView.as_view(),
+         name='messages-search'),
+    path('metrics', metrics_view, name='metrics'),
 ]
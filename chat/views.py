@@ -1,26 +1,131 @@
-from rest_framework import viewsets
+import hashlib
+from collections import Counter
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, quote_etag
+from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied, ValidationError
-from django.shortcuts import get_object_or_404
+from rest_framework.exceptions import (NotFound, ParseError,
+                                       PermissionDenied, ValidationError)
+from django.db import transaction
+from django.db.models import Max
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework.views import APIView
 
-from .models import Chat, Message
-from .serializers import ChatSerializer, MessageSerializer
-from .permissions import IsParticipant, IsManagerOrReadOnly
+from . import dashboard, routers, sharding, unread
+from .attachments import (AttachmentTooLarge, LengthRequired,
+                          RangeNotSatisfiable, attachment_processor,
+                          blob_path, iter_range, parse_range, store_upload)
+from .models import (ArchivedMessage, Attachment, Chat, ChatReadState,
+                     Message, SyncEvent)
+from .pagination import ChatPagination, MessageCursorPagination
+from .receipts import receipt_writer
+from .bulk import broadcast_message, ingest_messages
+from .export import EXPORT_FORMATS, export_rows, render_export
+from .filters import ChatOrderingFilter
+from .search import search_messages
+from .serializers import (MESSAGE_ROW_FIELDS, ArchivedMessageSerializer,
+                          ArchiveQuerySerializer, AttachmentSerializer,
+                          AttachmentUploadSerializer, BroadcastSerializer,
+                          BulkMessageListSerializer,
+                          ChatSerializer, ExportQuerySerializer,
+                          MessageSearchSerializer,
+                          MessageSerializer, ReadCursorSerializer,
+                          SyncQuerySerializer, serialize_message_rows)
+from .sync import build_delta, latest_cursor
+from .throttling import MessageThrottle
+from .permissions import IsParticipant, IsManagerOrReadOnly, resolve_chat
 from rest_framework.permissions import IsAuthenticated
 
 
-class ChatViewSet(viewsets.ModelViewSet):
+class ReadRoutingMixin:
+    """
+    Routes the database reads of a request through ``chat.routers``: safe
+    requests read from the replica unless ``replica_reads`` is off, and
+    writes pin the user to the primary.
+    """
+    replica_reads = True
+
+    def initial(self, request, *args, **kwargs):
+        self.routing_token = routers.start_request(request,
+                                                   self.replica_reads)
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, 'routing_token', None)
+        if token is not None:
+            routers.end_request(token)
+            self.routing_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+def is_last_message(chat, message_id):
+    return bool(chat.last_message) and chat.last_message['id'] == message_id
+
+
+class ConditionalListMixin:
+    """
+    Gives ``list`` responses an ``ETag`` built from ``get_list_version()``
+    and answers a matching ``If-None-Match`` with 304 before any list
+    query runs.
+    """
+
+    def get_list_version(self):
+        raise NotImplementedError
+
+    def list_etag(self, request):
+        raw = (f'{request.user.pk}:{self.get_list_version()}:'
+               f'{request.accepted_renderer.format}:'
+               f'{request.get_full_path()}')
+        return quote_etag(hashlib.md5(raw.encode()).hexdigest())
+
+    def list(self, request, *args, **kwargs):
+        etag = self.list_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+
+class MessageRowListMixin:
+    """
+    ``list`` built from ``.values()`` rows by ``serialize_message_rows``
+    instead of model instances and ``MessageSerializer``.
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            *MESSAGE_ROW_FIELDS)
+        rows = self.paginate_queryset(queryset)
+        data = serialize_message_rows(
+            rows, self.get_serializer_context()['read_cursors'])
+        return self.get_paginated_response(data)
+
+
+class ChatViewSet(ReadRoutingMixin, ConditionalListMixin,
+                  viewsets.ModelViewSet):
     serializer_class = ChatSerializer
     permission_classes = [IsAuthenticated,  IsManagerOrReadOnly]
+    pagination_class = ChatPagination
+    filter_backends = [ChatOrderingFilter]
+    ordering_fields = ['id', 'last_activity_at']
+    ordering = ['id']
 
     def get_queryset(self):
-        user = self.request.user
-        if user.profile.role == 'manager':
-            return Chat.objects.filter(manager=user)
-        elif user.profile.role == 'client':
-            return Chat.objects.filter(client=user)
-        return Chat.objects.none()
+        return Chat.objects.for_participant(self.request.user).order_by('id')
+
+    def get_list_version(self):
+        return latest_cursor(self.request.user)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            unread.attach_unread_counts(self.request.user, page)
+        return page
 
     def perform_create(self, serializer):
         if self.request.user.profile.role != 'manager':
@@ -36,52 +141,420 @@ class ChatViewSet(viewsets.ModelViewSet):
             raise ValidationError("Чат уже существует.")
         serializer.save(manager=self.request.user)
 
+    def perform_update(self, serializer):
+        participants = (serializer.instance.manager_id,
+                        serializer.instance.client_id)
+        chat = serializer.save()
+        if participants != (chat.manager_id, chat.client_id):
+            dashboard.refresh_chat(chat)
+        unread.reset(*participants, chat.manager_id, chat.client_id)
+        # Former participants learn that the chat is gone from their list.
+        SyncEvent.objects.record(
+            set(participants) - {chat.manager_id, chat.client_id},
+            chat.pk, 'chat', chat.pk)
+
+    def perform_destroy(self, instance):
+        participants = (instance.manager_id, instance.client_id)
+        instance.delete()
+        unread.reset(*participants)
+
     @action(detail=False, methods=['get'])
     def total_unread_count(self, request):
-        user = request.user
-        if user.profile.role == 'manager':
-            unread_count = Message.objects.filter(
-                chat__manager=user,
-                sender__profile__role='client',
-                is_read=False
-            ).count()
-        else:
-            unread_count = Message.objects.filter(
-                chat__client=user,
-                sender__profile__role='manager',
-                is_read=False
-            ).count()
-        return Response({'unread_count': unread_count})
+        return Response({'unread_count': unread.get_total_unread(request.user)})
+
+    def get_throttles(self):
+        if self.action == 'broadcast':
+            return [MessageThrottle()]
+        return super().get_throttles()
+
+    def get_message_charges(self, request):
+        # One message per recipient; the chats are only looked up by the
+        # broadcast itself, so the per-chat buckets are left alone. Throttles
+        # run before the view: an invalid request is charged nothing.
+        serializer = BroadcastSerializer(data=request.data)
+        if not serializer.is_valid():
+            return {}
+        data = serializer.validated_data
+        if data['all_clients']:
+            return {None: Chat.objects.filter(manager=request.user).count()}
+        return {None: len(data['clients'])}
+
+    @action(detail=False, methods=['post'])
+    def broadcast(self, request):
+        if request.user.profile.role != 'manager':
+            raise PermissionDenied(
+                "Только менеджеры могут делать рассылки.")
+        serializer = BroadcastSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        messages, created_chats, missing = broadcast_message(
+            request.user, data['text'],
+            None if data['all_clients'] else data['clients'],
+            data['create_missing'])
+        return Response({
+            'messages': [{'chat': message.chat_id,
+                          'client': message.chat.client_id,
+                          'id': message.id} for message in messages],
+            'created_chats': created_chats,
+            'missing_clients': missing,
+        }, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        chat = self.get_object()
+        return self.export_response(request, [chat.pk], f'chat-{chat.pk}')
+
+    @action(detail=False, methods=['get'], url_path='export',
+            url_name='export-all')
+    def export_all(self, request):
+        if request.user.profile.role != 'manager':
+            raise PermissionDenied(
+                "Экспорт всех чатов доступен только менеджерам.")
+        chat_ids = list(Chat.objects.filter(manager=request.user)
+                        .values_list('id', flat=True))
+        return self.export_response(request, chat_ids,
+                                    f'chats-{request.user.pk}')
+
+    def export_response(self, request, chat_ids, name):
+        serializer = ExportQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        export_format = serializer.validated_data['export_format']
+        records = export_rows(chat_ids, serializer.validated_data.get('after'))
+        response = StreamingHttpResponse(
+            render_export(records, export_format),
+            content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = (
+            f'attachment; filename="{name}.{export_format}"')
+        return response
 
 
-class ChatMessageViewSet(viewsets.ModelViewSet):
+class ChatMessageViewSet(ReadRoutingMixin, ConditionalListMixin,
+                         MessageRowListMixin, viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated, IsParticipant]
+    pagination_class = MessageCursorPagination
 
     def get_chat(self):
-        chat_id = self.kwargs.get('chat_id')
-        return get_object_or_404(Chat, id=chat_id)
+        return resolve_chat(self.request, self.kwargs['chat_id'])
 
     def get_queryset(self):
-        chat = self.get_chat()
-        return Message.objects.filter(chat=chat)
+        return Message.objects.for_chat(self.get_chat())
+
+    def get_list_version(self):
+        return latest_cursor(self.request.user, self.get_chat().pk)
+
+    def get_throttles(self):
+        if self.action == 'create':
+            return [MessageThrottle()]
+        return super().get_throttles()
+
+    def get_message_charges(self, request):
+        # The resolved key: a zero-padded id must hit the same bucket.
+        return {self.get_chat().pk: 1}
 
     def perform_create(self, serializer):
         chat = self.get_chat()
         user = self.request.user
-        if user.profile.role == 'client' and user != chat.client:
+        if user.profile.role == 'client' and user.pk != chat.client_id:
             raise PermissionDenied(
                 "Клиент может отправлять только сообщения в своем чате.")
-        serializer.save(chat=chat, sender=user)
+        # The chat's last message is recorded by a receiver of the save.
+        with sharding.atomic([chat.pk]):
+            serializer.save(chat=chat, sender=user)
+
+    def perform_update(self, serializer):
+        chat = self.get_chat()
+        with sharding.atomic([chat.pk]):
+            message = serializer.save()
+            if is_last_message(chat, message.pk):
+                Chat.objects.refresh_last_message(chat)
+        SyncEvent.objects.record((chat.manager_id, chat.client_id), chat.pk,
+                                 'message', message.pk)
+
+    def perform_destroy(self, instance):
+        chat = self.get_chat()
+        message_id = instance.pk
+        with sharding.atomic([chat.pk]):
+            instance.delete()
+            # The stored files stay: their content may be shared.
+            Attachment.objects.filter(chat=chat,
+                                      message_id=message_id).delete()
+            if is_last_message(chat, message_id):
+                Chat.objects.refresh_last_message(chat)
+            dashboard.refresh_chat(chat)
+        unread.reset(chat.manager_id, chat.client_id)
+        SyncEvent.objects.record((chat.manager_id, chat.client_id), chat.pk,
+                                 'message', message_id)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['read_cursors'] = ChatReadState.objects.cursors(
+            [self.kwargs.get('chat_id')])
+        page = getattr(self.paginator, 'page', None)
+        if self.action == 'list' and page:
+            # The page is reported as read already: the cursor move itself
+            # is written by the receipt writer after the response.
+            cursors = context['read_cursors'].setdefault(self.get_chat().pk,
+                                                         {})
+            user_id = self.request.user.pk
+            cursors[user_id] = max(cursors.get(user_id, 0), page[-1]['id'])
+        return context
 
     def list(self, request, *args, **kwargs):
         response = super().list(request, *args, **kwargs)
-        user = request.user
+        if response.status_code == status.HTTP_200_OK and self.paginator.page:
+            receipt_writer.submit(self.get_chat(), request.user,
+                                  self.paginator.page[-1]['id'])
+        return response
+
+    @action(detail=False, methods=['get'])
+    def archive(self, request, chat_id=None):
+        """
+        Messages moved to the archive table by the retention purge, in id
+        order, paged with ``after=<id>``.
+        """
+        chat = self.get_chat()
+        serializer = ArchiveQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        after = serializer.validated_data['after']
+        limit = serializer.validated_data['limit']
+        archived = list(ArchivedMessage.objects.filter(
+            chat=chat, message_id__gt=after).order_by('message_id')[:limit + 1])
+        next_url = None
+        if len(archived) > limit:
+            archived = archived[:limit]
+            next_url = replace_query_param(request.build_absolute_uri(),
+                                           'after', archived[-1].message_id)
+        return Response({
+            'next': next_url,
+            'results': ArchivedMessageSerializer(archived, many=True).data,
+        })
+
+    @action(detail=False, methods=['post'])
+    def read(self, request, chat_id=None):
         chat = self.get_chat()
-        if user.profile.role == 'manager':
-            Message.objects.filter(chat=chat, sender=chat.client,
-                                   is_read=False).update(is_read=True)
-        elif user.profile.role == 'client':
-            Message.objects.filter(chat=chat, sender=chat.manager,
-                                   is_read=False).update(is_read=True)
+        serializer = ReadCursorSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        latest = Message.objects.for_chat(chat).aggregate(
+            latest=Max('id'))['latest'] or 0
+        last_read = min(serializer.validated_data.get('last_read_message_id',
+                                                      latest), latest)
+        ChatReadState.objects.advance(chat, request.user, last_read)
+        state = ChatReadState.objects.get(chat=chat, user=request.user)
+        return Response({'last_read_message_id': state.last_read_message_id})
+
+
+class AttachmentViewSet(ReadRoutingMixin, mixins.ListModelMixin,
+                        mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Files attached to a message. The body of a POST is the raw file,
+    streamed to storage with ``?filename=`` naming it.
+    """
+    serializer_class = AttachmentSerializer
+    permission_classes = [IsAuthenticated, IsParticipant]
+    pagination_class = None
+
+    def get_chat(self):
+        return resolve_chat(self.request, self.kwargs['chat_id'])
+
+    def get_queryset(self):
+        return Attachment.objects.filter(
+            chat=self.get_chat(), message_id=self.kwargs['message_id']
+        ).select_related('blob').order_by('id')
+
+    def get_throttles(self):
+        # An upload counts as a message sent to the chat.
+        if self.action == 'create':
+            return [MessageThrottle()]
+        return super().get_throttles()
+
+    def get_message_charges(self, request):
+        # The resolved key: a zero-padded id must hit the same bucket.
+        return {self.get_chat().pk: 1}
+
+    def perform_content_negotiation(self, request, force=False):
+        # Downloads answer any Accept header; errors are rendered as JSON.
+        return super().perform_content_negotiation(
+            request, force=force or self.action == 'download')
+
+    def create(self, request, chat_id=None, message_id=None):
+        chat = self.get_chat()
+        serializer = AttachmentUploadSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        message = Message.objects.for_chat(chat).filter(
+            pk=message_id).values('sender_id').first()
+        if message is None:
+            raise NotFound("Сообщение не найдено.")
+        if message['sender_id'] != request.user.pk:
+            raise PermissionDenied(
+                "Прикреплять файлы может только автор сообщения.")
+        length = request.META.get('CONTENT_LENGTH')
+        if not length:
+            raise LengthRequired()
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ParseError("Некорректный заголовок Content-Length.")
+        if length == 0:
+            raise ValidationError("Файл пуст.")
+        if length > settings.CHAT_ATTACHMENT_MAX_SIZE:
+            raise AttachmentTooLarge()
+
+        # Read straight from Django's request, not DRF's ``stream``, which
+        # is None without a length: the body is never held in memory.
+        blob = store_upload(request._request)
+        attachment = Attachment.objects.create(
+            chat=chat, message_id=message_id, uploader=request.user,
+            blob=blob, filename=serializer.validated_data['filename'],
+            content_type=request.content_type.split(';')[0].strip()
+            or 'application/octet-stream')
+        if blob.metadata is None:
+            transaction.on_commit(
+                lambda: attachment_processor.submit(blob.pk, None))
+        return Response(self.get_serializer(attachment).data,
+                        status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, chat_id=None, message_id=None, pk=None):
+        attachment = self.get_object()
+        size = attachment.blob.size
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        path = blob_path(attachment.blob.sha256)
+        if byte_range is None:
+            response = FileResponse(open(path, 'rb'),
+                                    content_type=attachment.content_type)
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                iter_range(path, start, end),
+                status=status.HTTP_206_PARTIAL_CONTENT,
+                content_type=attachment.content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = content_disposition_header(
+            True, attachment.filename)
         return response
+
+
+class SyncView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = SyncQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        since = serializer.validated_data.get('since')
+        if since is None:
+            # A client without a cursor loads the current state through the
+            # regular endpoints and syncs from here on.
+            return Response({'cursor': str(latest_cursor(request.user)),
+                             'has_more': False, 'chats': [],
+                             'deleted_chats': [], 'messages': [],
+                             'deleted_messages': [],
+                             'read_states': []})
+        return Response(build_delta(
+            request.user, since, serializer.validated_data['limit'],
+            {'request': request}))
+
+
+class ManagerDashboardViewSet(ReadRoutingMixin, viewsets.ViewSet):
+    """
+    Per-manager statistics read from the summary tables of
+    ``chat.dashboard``. Staff users see every manager, managers only
+    themselves.
+    """
+    permission_classes = [IsAuthenticated]
+    lookup_value_regex = r'\d+'
+
+    def visible_manager_ids(self):
+        user = self.request.user
+        if user.is_staff:
+            return None
+        if getattr(getattr(user, 'profile', None), 'role', None) != 'manager':
+            raise PermissionDenied(
+                "Статистика доступна только менеджерам.")
+        return [user.pk]
+
+    def list(self, request):
+        return Response(
+            dashboard.manager_summaries(self.visible_manager_ids()))
+
+    def retrieve(self, request, pk=None):
+        visible = self.visible_manager_ids()
+        if visible is not None and int(pk) not in visible:
+            raise PermissionDenied(
+                "Статистика других менеджеров недоступна.")
+        summaries = dashboard.manager_summaries([pk])
+        if not summaries:
+            raise NotFound("Менеджер не найден.")
+        summary = summaries[0]
+        summary['clients'] = dashboard.client_backlog(pk)
+        return Response(summary)
+
+
+class BulkMessageView(ReadRoutingMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [MessageThrottle]
+    replica_reads = False
+
+    def get_message_charges(self, request):
+        # Throttles run before the view: an invalid batch is charged
+        # nothing, invalid items only to the user bucket.
+        serializer = BulkMessageListSerializer(data=request.data)
+        if not serializer.is_valid():
+            return {}
+        charges = Counter()
+        for item in serializer.validated_data['messages']:
+            try:
+                chat_id = int(item.get('chat'))
+            except (TypeError, ValueError):
+                chat_id = None
+            charges[chat_id] += 1
+        return charges
+
+    def post(self, request):
+        serializer = BulkMessageListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = ingest_messages(request.user,
+                                  serializer.validated_data['messages'])
+        return Response({'results': results})
+
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        serializer = MessageSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        limit, offset = params['limit'], params['offset']
+        found = search_messages(request.user, params['q'], limit + 1,
+                                offset, params.get('chat'))
+        messages = found[:limit]
+        context = {'request': request, 'read_cursors':
+                   ChatReadState.objects.cursors(
+                       {message.chat_id for message in messages})}
+
+        url = request.build_absolute_uri()
+        next_url = previous_url = None
+        if len(found) > limit:
+            next_url = replace_query_param(url, 'offset', offset + limit)
+        if offset:
+            previous_url = remove_query_param(url, 'offset')
+            if offset > limit:
+                previous_url = replace_query_param(url, 'offset',
+                                                   offset - limit)
+        return Response({
+            'next': next_url,
+            'previous': previous_url,
+            'results': MessageSerializer(messages, many=True,
+                                         context=context).data,
+        })
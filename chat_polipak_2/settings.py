@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -38,10 +39,12 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
+    'rest_framework.authtoken',
     'chat.apps.ChatConfig'
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,9 +83,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # Read replica for safe requests of the chat and message endpoints. It
+    # is the primary's file unless CHAT_REPLICA_DB_NAME points elsewhere.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('CHAT_REPLICA_DB_NAME',
+                               BASE_DIR / 'db.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    },
+    # Extra message shards, used once listed in CHAT_MESSAGE_SHARDS.
+    'messages_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'messages_1.sqlite3',
+    },
+    'messages_2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'messages_2.sqlite3',
+    },
 }
 
+DATABASE_ROUTERS = [
+    'chat.routers.MessageShardRouter',
+    'chat.routers.ReplicaRouter',
+]
+
+
+AUTHENTICATION_BACKENDS = [
+    'chat.authentication.ProfileModelBackend',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -125,13 +155,114 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+TEST_RUNNER = 'chat.testing.ChatTestRunner'
+
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'chat.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
-    ]
-}
\ No newline at end of file
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'chat.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Per-user total unread counters are kept in the cache and rebuilt from the
+# database on a miss; the timeout bounds how long a missed update can live.
+CHAT_UNREAD_CACHE_TIMEOUT = 60 * 60
+
+# Delivers WebSocket events to connected participants. The in-process
+# backend only reaches connections served by the same process.
+CHAT_FANOUT_BACKEND = 'chat.fanout.InProcessFanout'
+
+# Bounded per-process cache of authenticated tokens; the TTL (seconds)
+# bounds how long a change made in another process can go unnoticed.
+CHAT_AUTH_CACHE_SIZE = 10000
+CHAT_AUTH_CACHE_TTL = 60
+
+# Largest batch accepted by POST /messages/bulk/.
+CHAT_BULK_MAX_MESSAGES = 1000
+
+# Token buckets limiting the messages sent (single, bulk, broadcast and
+# attachment uploads) per Profile.role: "user" counts a user's messages over
+# all chats, "chat" a user's messages in one chat. A bucket holds "burst"
+# tokens and refills at "rate" (DRF rate syntax). Buckets live in the default
+# cache, which has to be shared by all processes for the limits to be global.
+CHAT_MESSAGE_THROTTLES = {
+    'client': {
+        'user': {'rate': '60/min', 'burst': 30},
+        'chat': {'rate': '30/min', 'burst': 20},
+    },
+    'manager': {
+        'user': {'rate': '600/min', 'burst': 120},
+        'chat': {'rate': '60/min', 'burst': 30},
+    },
+}
+
+# Most client ids listed in one POST /chats/broadcast/.
+CHAT_BROADCAST_MAX_CLIENTS = 5000
+
+# Requests slower than this many seconds are logged by chat.metrics together
+# with their slowest SQL queries; None disables the log.
+CHAT_SLOW_REQUEST_THRESHOLD = 1.0
+CHAT_SLOW_REQUEST_MAX_QUERIES = 10
+
+# When set, GET /metrics requires "Authorization: Bearer <token>".
+CHAT_METRICS_TOKEN = None
+
+# Alias that safe requests read from (None reads from the primary) and how
+# many seconds a user's reads stay on the primary after the user writes.
+CHAT_READ_REPLICA = 'replica'
+CHAT_READ_YOUR_WRITES_WINDOW = 5
+
+# Databases holding chat_message rows, picked by a stable hash of chat_id
+# (see chat.sharding). Changing the list requires moving the existing rows
+# with "manage.py rebalance_message_shards".
+CHAT_MESSAGE_SHARDS = os.environ.get('CHAT_MESSAGE_SHARDS',
+                                     'default').split(',')
+# Worker threads querying shards concurrently.
+CHAT_SHARD_WORKERS = 8
+
+# Work done off the request path by chat.background worker threads (read
+# cursor moves, attachment processing). False does it inline; the test
+# runner turns it off.
+CHAT_BACKGROUND_ASYNC = True
+# History GETs move read cursors through chat.receipts, which coalesces
+# moves per chat and user and applies them every CHAT_READ_RECEIPT_INTERVAL
+# seconds in transactions of at most CHAT_READ_RECEIPT_BATCH_SIZE cursors.
+CHAT_READ_RECEIPT_INTERVAL = 0.2
+CHAT_READ_RECEIPT_BATCH_SIZE = 500
+
+# Rows fetched per query (and records per streamed piece) by chat exports.
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Messages older than this many days are archived and deleted by
+# "manage.py purge_expired_messages" (None keeps them forever); a chat's
+# retention_days overrides it. The purge deletes CHAT_RETENTION_BATCH_SIZE
+# rows per transaction and sleeps CHAT_RETENTION_PAUSE seconds in between.
+CHAT_MESSAGE_RETENTION_DAYS = None
+CHAT_RETENTION_BATCH_SIZE = 500
+CHAT_RETENTION_PAUSE = 0.1
+
+# The same command prunes the /sync/ change log older than this many days
+# (None keeps it). Clients whose cursor predates the remaining log get
+# 410 Gone and have to reload the state.
+CHAT_SYNC_EVENT_RETENTION_DAYS = 30
+
+# Message attachments are stored under content-addressed paths in this
+# directory. Uploads are read in CHAT_ATTACHMENT_CHUNK_SIZE chunks and may
+# not exceed CHAT_ATTACHMENT_MAX_SIZE bytes.
+CHAT_ATTACHMENT_ROOT = BASE_DIR / 'attachments'
+CHAT_ATTACHMENT_MAX_SIZE = 25 * 1024 * 1024
+CHAT_ATTACHMENT_CHUNK_SIZE = 64 * 1024